@@ -10,6 +10,8 @@ import serial
 import Tkinter
 import tkMessageBox, tkFileDialog
 import threading
+import collections
+import Queue
 
 from seeder_controller import SeederController
 
@@ -24,6 +26,14 @@ class gui_interface():
     self.stream_file = ""
     self.locked = False
     self.th = None
+    # Log pane. Controller threads queue log records; the Tk thread takes
+    # them in batches on a timer and appends only the new lines.
+    self.log_queue = Queue.Queue()
+    self.log_levels = ["debug","info","warning","error"]
+    self.log_max_lines = 2000     # Older lines are dropped from the pane
+    self.log_batch = 500          # Most records taken per poll
+    self.log_poll_ms = 100
+    self.log_records = collections.deque(maxlen=self.log_max_lines)
 
   def t_print(self,string,T=None):
     if not T:
@@ -35,7 +45,56 @@ class gui_interface():
     T.update()
     self.top.update()
 
+  # Controller listener. Runs on motor threads, so it only queues.
+  def onControllerEvent(self,event):
+    if event["event"] == "log":
+      self.log_queue.put((event.get("level","info"),event["text"]))
+
+  def showLevel(self,level):
+    min_level = self.log_levels.index(self.log_level_string.get())
+    return self.log_levels.index(level) >= min_level
+
+  def appendLog(self,records):
+    T = self.T_log
+    at_end = T.yview()[1] >= 0.999
+    T.config(state=Tkinter.NORMAL)
+    # One insert per run of records with the same level
+    for level, group in itertools.groupby(records, key=lambda r: r[0]):
+      text = "".join(r[1] + "\n" for r in group)
+      T.insert(Tkinter.END,text,level)
+    lines = int(T.index("end-1c").split(".")[0])
+    if lines > self.log_max_lines:
+      T.delete("1.0","{}.0".format(lines - self.log_max_lines + 1))
+    T.config(state=Tkinter.DISABLED)
+    if at_end:
+      T.see(Tkinter.END)
+
+  def pollLog(self):
+    records = []
+    try:
+      while len(records) < self.log_batch:
+        records.append(self.log_queue.get_nowait())
+    except Queue.Empty:
+      pass
+    if records:
+      self.log_records.extend(records)
+      shown = [r for r in records if self.showLevel(r[0])]
+      if shown:
+        self.appendLog(shown)
+    # Come back sooner if the batch was full
+    delay = 1 if len(records) >= self.log_batch else self.log_poll_ms
+    self.log_after = self.top.after(delay,self.pollLog)
+
+  # Redraws the pane from the kept records when the level filter changes
+  def filterLog(self,*args):
+    self.T_log.config(state=Tkinter.NORMAL)
+    self.T_log.delete("1.0",Tkinter.END)
+    self.T_log.config(state=Tkinter.DISABLED)
+    self.appendLog([r for r in self.log_records if self.showLevel(r[0])])
+    self.T_log.see(Tkinter.END)
+
   def quit_gui(self,other=None):
+    self.top.after_cancel(self.log_after)
     self.top.withdraw()
     self.top.destroy()
     del self.top
@@ -55,7 +114,7 @@ class gui_interface():
 
   def freeze_controls(self,freeze=True):
     # Regular buttons
-    objects = [self.B_mp,self.B_mb,self.B_setr]
+    objects = [self.B_mp,self.B_resume,self.B_mb,self.B_setr]
     for o in objects:
       if freeze:
         o.config(state=Tkinter.DISABLED)
@@ -126,7 +185,21 @@ class gui_interface():
         raise ValueError
       self.process_thread = threading.Thread(target=cmd) 
       self.process_thread.start()
-      while self.process_thread.isAlive():
+      while self.process_thread.is_alive():
+          self.top.update()
+    except:
+      self.sc.log("\n  -- Error\n")
+      self.sc.log(traceback.format_exc())
+    finally:
+      self.freeze_controls(freeze=False)
+
+  def guiResumeProcess(self):
+    try:
+      self.freeze_controls()
+      self.sc.log("\nCall to guiResumeProcess\n")
+      self.process_thread = threading.Thread(target=self.sc.resume)
+      self.process_thread.start()
+      while self.process_thread.is_alive():
           self.top.update()
     except:
       self.sc.log("\n  -- Error\n")
@@ -315,6 +388,12 @@ class gui_interface():
     self.B_stop = B_stop
     self.B_stop.config(state=Tkinter.DISABLED)
 
+    # Resume button (continues a stopped process loop)
+    B_resume = Tkinter.Button(top, text=' RESUME ', bd=2,
+            command=self.guiResumeProcess)
+    B_resume.grid(row=7,column=5,sticky=Tkinter.W)
+    self.B_resume = B_resume
+
     # Relay
     L_relay = Tkinter.Label(top, text='Relay  ', justify=Tkinter.RIGHT)
     L_relay.grid(row=9,column=4,sticky=Tkinter.E)
@@ -360,6 +439,33 @@ class gui_interface():
     B_setr.grid(row=13,column=5,sticky=Tkinter.W)
     self.B_setr = B_setr
     
+    # Log pane
+    L_log = Tkinter.Label(top, text='Log level  ', justify=Tkinter.RIGHT)
+    L_log.grid(row=14,column=1,sticky=Tkinter.E)
+    L_log["bg"] = "grey"
+    log_level_string = Tkinter.StringVar()
+    self.log_level_string = log_level_string
+    log_level_port = Tkinter.OptionMenu(self.top, self.log_level_string,
+            *tuple(self.log_levels))
+    log_level_port.config(width=6, bd=0)
+    log_level_port.grid(row=14,column=2,sticky=Tkinter.W)
+    self.log_level_port = log_level_port
+    self.log_level_string.set("info")
+    self.log_level_string.trace("w", self.filterLog)
+
+    F_log = Tkinter.Frame(top)
+    F_log.grid(row=15,column=1,columnspan=5,sticky=Tkinter.W+Tkinter.E)
+    T_log = Tkinter.Text(F_log, height=12, width=100, wrap=Tkinter.NONE,
+            state=Tkinter.DISABLED)
+    S_log = Tkinter.Scrollbar(F_log, command=T_log.yview)
+    T_log.config(yscrollcommand=S_log.set)
+    T_log.pack(side=Tkinter.LEFT, fill=Tkinter.BOTH, expand=True)
+    S_log.pack(side=Tkinter.RIGHT, fill=Tkinter.Y)
+    T_log.tag_config("debug", foreground="grey40")
+    T_log.tag_config("warning", foreground="orange red")
+    T_log.tag_config("error", foreground="red")
+    self.T_log = T_log
+
     #T_CS["bg"] = "grey"
     Send = Tkinter.Label(top, text=' ', width=W3)
     Send.grid(row=100,column=100)
@@ -370,6 +476,8 @@ class gui_interface():
     # update
     if self.sc:
         self.sc.refresh = self.top.update
+        self.sc.addListener(self.onControllerEvent)
+    self.pollLog()
     
     top.mainloop()
 
@@ -0,0 +1,134 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Asyncio facade for the SeederController.
+
+Lets a process sequence interleave relay timing and motion on one event
+loop instead of blocking a thread on every call:
+
+    asc = AsyncSeederController(sc)
+    await asc.set_relay(8, "Close")
+    await asc.run_stepper(1, steps=740, speed=60)
+    await asc.set_relay(6, "Close")
+    await asc.run_moves((1, {"steps": 2375, "speed": 10}),
+                        (2, {"steps": 17500, "speed": 70}))
+    await asc.settle(0.5)
+
+Relay writes (GPIO and log file I/O) run on the loop's default executor.
+Settle waits are asyncio sleeps, so no thread sleeps through them. Step
+pulses need sub-millisecond timing that the event loop cannot give, so
+each motor has one long-lived worker thread that runs its step loop. Moves
+on the same motor queue behind each other there. No thread is created per
+call.
+
+Process phases and whole process loops are the controller's own methods,
+run on one process worker thread, so they use the option parameters, the
+run journal and its checkpoints like any other run:
+
+    await asc.run_option(2, {"num_rows": 3})
+    await asc.resume()
+
+Requires Python 3 (asyncio). Four spaces per indentation.
+"""
+
+import asyncio
+import concurrent.futures
+
+
+class AsyncSeederController():
+    """Awaitable versions of the SeederController primitives."""
+
+    def __init__(self, sc):
+        self.sc = sc
+        self.motor_workers = {}     # motor_id -> single thread executor
+        self.process_worker = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="process")
+
+    def close(self):
+        for worker in self.motor_workers.values():
+            worker.shutdown(wait=True)
+        self.motor_workers = {}
+        self.process_worker.shutdown(wait=True)
+
+    def getWorker(self, motor_id):
+        worker = self.motor_workers.get(motor_id)
+        if worker is None:
+            self.sc.getIndex(motor_id)      # ValueError if unknown
+            worker = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                    thread_name_prefix="motor{}".format(motor_id))
+            self.motor_workers[motor_id] = worker
+        return worker
+
+    """
+    ----------------------------------
+     Primitives
+    ----------------------------------
+    """
+    async def run_stepper(self, motor_id, steps=0, direction="Forward",
+                                                    style="Double",
+                                                    speed=0):
+        self.sc.checkStop()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.getWorker(motor_id),
+                lambda: self.sc.runStepper(motor_id, steps=steps,
+                        direction=direction, style=style, speed=speed))
+
+    async def run_stepper_until(self, motor_id, input_pin, edge="rising",
+                                                    max_steps=0,
+                                                    direction="Forward",
+                                                    style="Double",
+                                                    speed=0):
+        self.sc.checkStop()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.getWorker(motor_id),
+                lambda: self.sc.runStepperUntil(motor_id, input_pin, edge,
+                        max_steps=max_steps, direction=direction,
+                        style=style, speed=speed))
+
+    async def set_relay(self, relay, mode="on"):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None,
+                lambda: self.sc.setRelay(relay, mode=mode))
+
+    # Waits without holding a thread. Raises RuntimeError on stop.
+    async def settle(self, seconds):
+        self.sc.checkStop()
+        await asyncio.sleep(seconds)
+        self.sc.checkStop()
+
+    """ Runs several moves at once and waits for all of them.
+    Each move is (motor_id, kwargs for run_stepper). Returns their results.
+
+    >>> await asc.run_moves((1, {"steps": 3300, "speed": 40}),
+    ...                     (3, {"steps": 1700, "speed": 50}))
+    """
+    async def run_moves(self, *moves):
+        return await asyncio.gather(*[self.run_stepper(motor_id, **kwargs)
+                                      for motor_id, kwargs in moves])
+
+    """
+    ----------------------------------
+     Phases and process loops
+    ----------------------------------
+    """
+    # Runs a controller method on the process worker
+    async def run_process(self, fn, *args, **kwargs):
+        self.sc.checkStop()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.process_worker,
+                lambda: fn(*args, **kwargs))
+
+    # Keyword arguments as SeederController.fillTray()
+    async def fill_tray(self, **kwargs):
+        return await self.run_process(self.sc.fillTray, **kwargs)
+
+    # Keyword arguments as SeederController.cleanTray()
+    async def clean_tray(self, **kwargs):
+        return await self.run_process(self.sc.cleanTray, **kwargs)
+
+    async def run_option(self, option, params=None):
+        fn = getattr(self.sc, "runOption{}".format(option))
+        return await self.run_process(fn, params)
+
+    # Returns False if there is nothing to resume
+    async def resume(self):
+        return await self.run_process(self.sc.resume)
@@ -0,0 +1,193 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Command line runner for the seeding machine.
+
+Runs process loops without the GUI, on the hardware or on the simulated
+backend, for scripted overnight runs and benchmarks.
+
+Written for Python 2.7 and 3. Four spaces per indentation.
+
+    python seeder_cli.py --option 2 --trays 20
+    python seeder_cli.py --recipe best.json --rows 3 --simulate \\
+            --trace run.rec --profile run.prof --metrics-file run.prom
+    python seeder_cli.py --resume
+
+A recipe file is either the JSON saved by seeder_sweep.py --save (option
+parameter overrides), or {"option": 2, "params": {...}}.
+
+Exit status:
+    0   All trays done
+    1   Fault (any other exception in the controller)
+    2   Stopped (SIGTERM, SIGINT or a stop from another thread)
+    3   Bad arguments or recipe
+"""
+
+import argparse
+import json
+import signal
+import sys
+import traceback
+from time import time
+
+from seeder_controller import SeederController, StopRequested, OPTION_PARAMS
+
+EXIT_OK         = 0
+EXIT_FAULT      = 1
+EXIT_STOPPED    = 2
+EXIT_USAGE      = 3
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description="Seeder process runner")
+    parser.add_argument("--option", type=int, choices=sorted(OPTION_PARAMS),
+                        help="Process loop to run (default 1, or the "
+                             "recipe's)")
+    parser.add_argument("--recipe", help="JSON file of option parameters")
+    parser.add_argument("--rows", type=int, help="Rows per tray")
+    parser.add_argument("--trays", type=int, default=1,
+                        help="Trays to run, one after another")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Run the trays with two on the conveyor")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the process loop in the journal")
+    parser.add_argument("--simulate", action="store_true",
+                        help="Use the simulated GPIO and MotorHAT backend")
+    parser.add_argument("--config", default="seeder_config.txt")
+    parser.add_argument("--plan-cache",
+                        help="Keep compiled motion plans in this directory")
+    parser.add_argument("--motion-worker", action="store_true",
+                        help="Generate step pulses in a separate process")
+    parser.add_argument("--trace", help="Record GPIO commands to this file")
+    parser.add_argument("--profile", help="Write cProfile stats to this file")
+    parser.add_argument("--metrics-file",
+                        help="Write Prometheus metrics here at the end")
+    parser.add_argument("--quiet", action="store_true",
+                        help="Only print warnings and the summary")
+    return parser.parse_args(argv)
+
+
+""" Reads a recipe file. Returns (option or None, params). """
+def readRecipe(fn):
+    fh = open(fn, 'r')
+    recipe = json.load(fh)
+    fh.close()
+    if not isinstance(recipe, dict):
+        raise ValueError("{} is not a JSON object".format(fn))
+    if "params" in recipe or "option" in recipe:
+        return recipe.get("option"), dict(recipe.get("params") or {})
+    return None, dict(recipe)
+
+
+# Raises ValueError for an unknown option or parameter
+def checkRecipe(option, params):
+    if option not in OPTION_PARAMS:
+        raise ValueError("unknown option {}".format(option))
+    unknown = set(params) - set(OPTION_PARAMS[option])
+    if unknown:
+        raise ValueError("unknown parameters for option {}: {}".format(
+                                        option, ", ".join(sorted(unknown))))
+
+
+""" Returns (option, params) from the arguments and recipe file. """
+def loadRecipe(args):
+    option = args.option
+    params = {}
+    if args.recipe:
+        recipe_option, params = readRecipe(args.recipe)
+        option = option or recipe_option
+    option = option or 1
+    if args.rows is not None:
+        params["num_rows"] = args.rows
+    checkRecipe(option, params)
+    return option, params
+
+
+def runTrays(sc, args, option, params):
+    if args.resume:
+        sc.resume()
+        return
+    if args.pipeline and args.trays > 1:
+        sc.runPipeline(option, trays=args.trays, params=params or None)
+        return
+    for tray in range(args.trays):
+        if args.trays > 1:
+            sc.log("\n== Tray {} of {} ==".format(tray + 1, args.trays))
+        sc.runPlanned(option, params or None)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    try:
+        option, params = loadRecipe(args)
+    except (IOError, ValueError) as e:
+        sys.stderr.write("seeder_cli: {}\n".format(e))
+        return EXIT_USAGE
+
+    sc = SeederController(config_fn=args.config, simulate=args.simulate)
+    if args.quiet:
+        sc.verbose = False
+
+    # SIGTERM (and SIGINT) stop the machine at the next step, like STOP
+    def requestStop(signum, frame):
+        sc.log("\n  Signal {} received, stopping".format(signum))
+        sc.stop = True
+    signal.signal(signal.SIGTERM, requestStop)
+    signal.signal(signal.SIGINT, requestStop)
+
+    if args.plan_cache:
+        sc.openPlanCache(args.plan_cache)
+    if args.motion_worker:
+        sc.startMotionWorker()
+    if args.trace:
+        sc.startRecording(args.trace)
+    profiler = None
+    if args.profile:
+        import cProfile
+        profiler = cProfile.Profile()
+
+    status = EXIT_OK
+    t0 = time()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        try:
+            runTrays(sc, args, option, params)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+    except StopRequested:
+        status = EXIT_STOPPED
+    except Exception:
+        status = EXIT_FAULT
+        sc.log("\n  -- Error\n")
+        sc.log(traceback.format_exc())
+    elapsed = time() - t0
+    trays = sc.metrics.trays.total()     # Finished, also before a stop
+
+    if status != EXIT_OK:
+        # Leave the machine safe
+        try:
+            sc.stop = False
+            sc.releaseAll()
+        except Exception:
+            sc.log(traceback.format_exc())
+            status = EXIT_FAULT
+    sc.stopRecording()
+    sc.stopMotionWorker()
+    if profiler is not None:
+        profiler.dump_stats(args.profile)
+    if args.metrics_file:
+        sc.metrics.dump(args.metrics_file)
+
+    summary = "\n{}: {} tray(s), {:.1f} s".format(
+            ["done", "FAULT", "stopped"][status], trays, elapsed)
+    if trays and status == EXIT_OK:
+        summary += ", {:.1f} trays/hour".format(3600.0 * trays / elapsed)
+    sc.log(summary)
+    if args.quiet:
+        print(summary.strip())
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -11,22 +11,41 @@ Written by Russell Carroll.
 Email: russell_carroll@carrelec.com
 """
 
-from Adafruit_MotorHAT import (Adafruit_MotorHAT, Adafruit_DCMotor,
-                                Adafruit_StepperMotor)
 from time import sleep, time
+from functools import wraps
+from fractions import Fraction
 import atexit
 import threading
 import random
-import RPi.GPIO as GPIO
+from seeder_metrics import SeederMetrics
+from seeder_journal import RunJournal
+try:
+    from Adafruit_MotorHAT import (Adafruit_MotorHAT, Adafruit_DCMotor,
+                                    Adafruit_StepperMotor)
+except ImportError:
+    Adafruit_MotorHAT = None
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
 
 """
 Empty classes for Adafruit_MotorHAT module.
 -> Used only if the MotorHAT module is not installed.
 """
 class Adafruit_MotorHAT_empty():
+    # Same codes as the Adafruit_MotorHAT module
+    FORWARD     = 1
+    BACKWARD    = 2
+    BRAKE       = 3
+    RELEASE     = 4
+    SINGLE      = 1
+    DOUBLE      = 2
+    INTERLEAVE  = 3
+    MICROSTEP   = 4
+
     def __init__(self,addr):
         self.addr = addr
-        self.RELEASE = 0
         
     def getMotor(self,mtr):
         return self
@@ -40,6 +59,9 @@ class Adafruit_MotorHAT_empty():
     def run(self,mode):
         pass
 
+if Adafruit_MotorHAT is None:
+    Adafruit_MotorHAT = Adafruit_MotorHAT_empty
+
 class Adafruit_DCMotor_empty(Adafruit_MotorHAT):
     def __init__(self):
         pass
@@ -51,6 +73,164 @@ class Adafruit_StepperMotor_empty(Adafruit_MotorHAT):
     def step(self, numsteps, direction, style):
         pass
 
+"""
+Empty class for the RPi.GPIO module.
+-> Used when simulating, or if the RPi.GPIO module is not installed.
+   Output levels are remembered so they can be read back with input().
+"""
+class GPIO_empty():
+    BCM     = 11
+    BOARD   = 10
+    OUT     = 0
+    IN      = 1
+    LOW     = 0
+    HIGH    = 1
+    PUD_OFF     = 20
+    PUD_DOWN    = 21
+    PUD_UP      = 22
+    RISING      = 31
+    FALLING     = 32
+    BOTH        = 33
+
+    def __init__(self):
+        self.levels = {}
+        self.events = {}    # pin -> (edge, callback)
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode, initial=None, pull_up_down=None):
+        if initial is not None:
+            self.levels[pin] = initial
+        elif pull_up_down == self.PUD_UP:
+            self.levels[pin] = self.HIGH
+
+    def output(self, pin, level):
+        self.levels[pin] = level
+
+    def input(self, pin):
+        return self.levels.get(pin, self.LOW)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        if pin in self.events:
+            raise RuntimeError("Conflicting edge detection already enabled")
+        self.events[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        self.events.pop(pin, None)
+
+    # Simulates an input changing level, firing any matching edge callback
+    def setInput(self, pin, level):
+        old = self.levels.get(pin, self.LOW)
+        self.levels[pin] = level
+        if pin not in self.events or old == level:
+            return
+        edge, callback = self.events[pin]
+        rising = level == self.HIGH
+        if (edge == self.BOTH or (edge == self.RISING and rising)
+                or (edge == self.FALLING and not rising)):
+            if callback:
+                callback(pin)
+
+    def cleanup(self):
+        self.levels = {}
+        self.events = {}
+
+"""
+Process loop parameters.
+-> Step counts and speeds (RPM) of each option, and the settle times (s)
+   between steps. runOption1() to runOption5() accept overrides of any of
+   these, e.g. runOption2({"speed_seedhead": 200}).
+"""
+DEFAULT_PARAMS = {
+    "num_rows":         12,
+    "speed_fill_first": 60,     # Conveyor while the hopper starts
+    "speed_fill_m1":    10,     # Conveyor while filling
+    "speed_fill_m2":    70,     # Hopper
+    "speed_clean_m1":   40,     # Conveyor while cleaning
+    "speed_clean_m3":   50,     # Clean tray brush
+    "speed_conveyor":   160,    # Conveyor for tray and dibble moves
+    "speed_advance_m4": 0,      # Seedhead to the pickup (0 = keep speed)
+    "speed_row":        0,      # Conveyor for row moves (0 = keep speed)
+    "speed_seedhead":   180,    # Seedhead between pickup and tray
+    "settle_start":     10.0,   # After releasing everything at the start
+    "settle_tray":      0.1,    # Dibbler relay before and after setting tray
+    "settle_dibble":    0.05,   # Dibbler down and up
+    "settle_vacuum":    1.0,    # Needle vacuum before the first seed
+    "settle_rotate":    0.5,    # Seed vibrator off before rotating
+    "settle_release":   0.5,    # Needle vacuum off / on around a release
+    "settle_puff":      0.05,   # Needle air puff
+    "set_rvs":          75,
+    "advance_dir_m4":   "Reverse",
+    "rotate_dir_m4":    "Forward",
+}
+
+def optionParams(**params):
+    p = dict(DEFAULT_PARAMS)
+    p.update(params)
+    return p
+
+OPTION_PARAMS = {
+    # 1. Dibble and Seed 29 Rows
+    1: optionParams(num_rows=29, settle_start=1.0,
+            fill_m1_first=5, fill_m1=5, fill_m2=5, clean_m1=3, clean_m3=1,
+            set_fwd=3, set_rvs=5, dibbler_m1=9, dibble_odd=1, dibble_even=1,
+            advance_m1=2000, advance_m4=170, advance_dir_m4="Forward",
+            row_odd=182, row_even=182, rotate_m4=330, rotate_dir_m4="Reverse",
+            seed_nom=330, seed_last=160, return_m1=2500),
+    # 2. Dibble and Seed 12 Rows
+    2: optionParams(
+            fill_m1_first=740, fill_m1=2375, fill_m2=17500, clean_m1=3300,
+            clean_m3=1700, set_fwd=2000, dibbler_m1=234, dibble_odd=202,
+            dibble_even=204, advance_m1=387, advance_m4=220, row_odd=201,
+            row_even=203, rotate_m4=486, seed_nom=486, seed_last=275,
+            return_m1=2000),
+    # 3. Seed 12 Rows, No Dibble
+    3: optionParams(
+            fill_m1_first=700, fill_m1=2475, fill_m2=8800, clean_m1=3200,
+            clean_m3=1750, set_fwd=2000, dibbler_m1=2780, advance_m1=390,
+            advance_m4=220, row_odd=212, row_even=212, rotate_m4=486,
+            seed_nom=486, seed_last=352, return_m1=2000),
+    # 4. No Dibble, Place 3 Seeds Over 12 Rows
+    4: optionParams(
+            fill_m1_first=740, fill_m1=2700, fill_m2=20000, clean_m1=3400,
+            clean_m3=1400, set_fwd=2000, dibbler_m1=2720, advance_m1=400,
+            advance_m4=220, row_odd=197, row_even=197, rotate_m4=488,
+            seed_nom=488, seed_last_1=352, seed_last_2=372, seed_last_3=285,
+            shift_m1=5, return_m1=500),
+    # 5. Dibble 12 Rows, Places 2 Seeds Per Row
+    5: optionParams(
+            fill_m1_first=740, fill_m1=2575, fill_m2=15800, clean_m1=3400,
+            clean_m3=1400, set_fwd=2000, dibbler_m1=235, dibble_odd=205,
+            dibble_even=205, advance_m1=387, advance_m4=220, row_odd=205,
+            row_even=205, rotate_m4=486, seed_nom=486, seed_last_1=275,
+            seed_last_2=275, shift_m1=6, return_m1=200),
+}
+
+"""
+Decorator for process phases that are recorded in the run journal.
+-> When resuming, a phase the journal shows as complete is skipped.
+"""
+def checkpointed(method):
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        name = method.__name__
+        if not self.isPending(name):
+            return None
+        result = method(self, *args, **kwargs)
+        self.checkpoint(name)
+        return result
+    return wrapper
+
+class StopRequested(RuntimeError):
+    """Raised by checkStop() when the stop signal is set. A RuntimeError,
+    so callers that catch those to release the machine still do.
+    """
+    pass
+
 class SeederController():
     """Seeder controller object.
 
@@ -63,10 +243,14 @@ class SeederController():
      Miscellaneous functions
     ----------------------------------
     """
-    def __init__(self, config_fn="seeder_config.txt"):
+    def __init__(self, config_fn="seeder_config.txt", simulate=False,
+                       log_fn="seeder_log.txt",
+                       journal_fn="seeder_journal.txt",
+                       status_fn=None):
         # Default values
+        self.simulate       = simulate or (GPIO is None)
         self.log_text       = ""
-        self.log_fn         = "seeder_log.txt"
+        self.log_fn         = log_fn
         self.verbose        = True
         self.num_rows       = 29        # Number of seeder rows
         self.stop           = False
@@ -86,6 +270,7 @@ class SeederController():
         self.Relay_Ch[6]    = 17
         self.Relay_Ch[7]    = 27
         self.Relay_Ch[8]    = 22
+        self.relay_state    = dict((r, "off") for r in self.relay_list)
 
         # Stepper Motor
         self.motor_id       = [ 1,    2,    3,    4   ]
@@ -97,28 +282,136 @@ class SeederController():
         self.step_pin       = [ 26,   21,   6,    25  ] # Used by GPIO only
         self.gpio_cw        = [ 1,    1,    1,    1   ] # Used by GPIO only
         self.gpio_ccw       = [ 0,    0,    0,    0   ]
+
+        # Step resolution of GPIO motors. Recipe step counts are in
+        # 1/recipe_microsteps of a full step, the setting the drivers had
+        # before their microstep-select pins (MS1, MS2, MS3) were wired. A
+        # motor with ms_pins runs each move at the resolution of its phase
+        # (if auto_resolution) or of its style, with the step count and
+        # delay rescaled so the distance and speed are unchanged.
+        self.ms_pins        = [ None, None, None, None] # Used by GPIO only
+        self.recipe_microsteps = [ 1, 1,    1,    1   ]
+        self.ms_table       = {     # Microsteps -> MS pin levels (A4988)
+            1:  (0, 0, 0),
+            2:  (1, 0, 0),
+            4:  (0, 1, 0),
+            8:  (1, 1, 0),
+            16: (1, 1, 1) }
+        self.style_microsteps = {"double": 1, "single": 1, "interleave": 2,
+                                 "microstep": 16}
+        self.auto_resolution = True
+        self.phase_microsteps = {
+            "fillTray":     1,      # Long transfer moves: full steps
+            "cleanTray":    1,
+            "setTray":      1,
+            "returnToZero": 1,
+            "rotateToTray": 16,     # Seedhead placement: fine steps
+            "releaseSeed":  16 }
+
+        # Position tracking. Signed step count per motor id, positive is
+        # Forward. Named positions are (motor_id, position) pairs. Moves
+        # at a finer resolution that are cut short leave part of a step,
+        # kept in position_frac so the count does not drift.
+        self.position       = dict((m, 0) for m in self.motor_id)
+        self.position_frac  = dict((m, 0) for m in self.motor_id)
+        self.named_positions = {}
+        # Conveyor travel from the start of fillTray until the tray is clear
+        # of the machine. returnToZero only runs the remaining distance
+        # instead of its fixed step count. None takes it from the option's
+        # own moves (see getExitSteps()).
+        self.conveyor_exit_steps = None
+        self.exit_steps     = {}        # Travel of options, see above
+
+        # Tray sensors on GPIO inputs. None = not fitted, so the fixed
+        # step counts of the recipe are used instead.
+        self.tray_sensor_pin    = None      # Tray at the dibbler stop
+        self.tray_sensor_edge   = "falling"
+        self.exit_sensor_pin    = None      # Tray clear of the machine
+        self.exit_sensor_edge   = "falling"
+        self.sensor_pull        = "up"      # "up", "down" or "off"
         
+        # Step deadlines of GPIO moves. An edge more than late_tolerance
+        # half periods after its deadline is a miss. With miss_backoff set
+        # to "move", every miss_threshold misses slow the rest of the move
+        # by backoff_factor. With "run", the slower speed also stays for
+        # the rest of the process loop (speed_scale). The motion worker
+        # cannot change speed inside a move, so it only backs off for "run".
+        self.late_tolerance = 0.5
+        self.miss_threshold = 20
+        self.miss_backoff   = None      # None, "move" or "run"
+        self.backoff_factor = 0.8
+        self.speed_scale    = [ 1.0,  1.0,  1.0,  1.0 ]
+        self.move_stats     = {}        # motor_id -> stats of the last move
+        self.deadline_stats = dict((m, {"moves": 0, "edges": 0, "misses": 0,
+                        "late_max": 0.0}) for m in self.motor_id)
+
+        # Shadow copy of the last level written to each output pin. Writes
+        # of the level a pin already has are skipped. With gpio_verify, the
+        # pin is read back first, so a level changed behind our back is
+        # corrected instead of trusted.
+        self.pin_shadow     = {}
+        self.gpio_verify    = False
+
         # Thread queue
         self.thread_queue = []
+        self.thread_errors = []     # Exceptions of non-blocking moves
+        self.motion_worker  = None      # See startMotionWorker()
+        self.status_block   = None      # See openStatusBlock()
+        self.status_fn      = status_fn # None for seeder_status.DEFAULT_FN
+        self.recorder       = None      # See startRecording()
+        self.plan_cache     = None      # See openPlanCache()
+        self.plan_speed     = None      # Motor speeds plans start from
+
+        # Progress reporting
+        self.listeners      = []        # Callbacks given each event dict
+        self.phase          = ""        # Current process phase
+        self.row            = 0         # Current row of the phase
+        self.option         = 0         # Option of the running process loop
+        self.option_params  = None      # and its parameter overrides
+        self.tray_stations  = {}        # Tray number -> station (pipeline)
+        self.metrics        = SeederMetrics()
+
+        # Run journal, used to resume a stopped process loop
+        self.journal_fn     = journal_fn
+        self.journal        = RunJournal(self.journal_fn)
+        self.journaling     = False     # True inside a process loop
+        # True once the journal's positions are counted from the same zero
+        # as self.position (it was written, or adopted, by this process)
+        self.journal_live   = False
+        self.resume_run     = None      # Journal contents being resumed
+        self.resume_settle  = 1.0       # Wait after restoring relays (s)
 
         # Startup procedure
         self.log("-- Keith Haynes Seeder Controller --", mode='w')
         self.log("\nSeeder Controller Startup...\n")
-        GPIO.setmode(GPIO.BCM)  # Setup GPIO
-        GPIO.setwarnings(False)
+        if self.simulate:
+            self.log("  Simulated hardware backend",log_only=True)
+            self.gpio = GPIO_empty()
+        else:
+            self.gpio = GPIO
+        self.gpio.setmode(self.gpio.BCM)  # Setup GPIO
+        self.gpio.setwarnings(False)
         self.setupMotorHAT()
         self.setupMotors()
         self.setupRelays()
 
     def __del__(self):
         # Final shutdown procedure
+        try:
+            self.stopMotionWorker()
+            self.closeStatusBlock()
+            self.stopRecording()
+            self.closePlanCache()
+        except:
+            pass
+
         try:
             self.turnOffMotors()
         except:
             pass
             
         try:
-            GPIO.cleanup()
+            self.gpio.cleanup()
         except:
             pass
             
@@ -135,6 +428,9 @@ class SeederController():
         if self.verbose and not log_only:
             print(text_str)
         self.log_text += text_str + '\n'
+        if self.listeners:
+            level = self.getLogLevel(text_str, log_only)
+            self.emit("log", text=text_str, log_only=log_only, level=level)
         try:
             fh = open(self.log_fn, mode)
             fh.write(text_str + '\n')
@@ -143,10 +439,112 @@ class SeederController():
             if not log_only:
                 print("  Warning: Failed to save {}".format(self.log_fn))
 
+    # Level of a log line for filtering: debug, info, warning or error
+    def getLogLevel(self, text_str, log_only=False):
+        if "Error" in text_str:
+            return "error"
+        if "Warning" in text_str:
+            return "warning"
+        if log_only:
+            return "debug"
+        return "info"
+
     # refresh command for multi threading
     def refresh(self):
         pass
 
+    # Waits for air, vacuum or mechanics to settle
+    def settle(self, seconds):
+        if seconds > 0:
+            sleep(seconds)
+
+    """ Registers a callback for progress events.
+
+    The callback is given a dict with an "event" key ("log", "phase",
+    "process") and the event data. It is called from whichever thread
+    produced the event, so it must return quickly and must not block.
+    """
+    def addListener(self, callback):
+        self.listeners.append(callback)
+
+    def removeListener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def emit(self, event, **data):
+        data["event"] = event
+        data["time"] = time()
+        for callback in list(self.listeners):
+            try:
+                callback(data)
+            except Exception:
+                pass    # A broken observer must not stop the machine
+
+    # Records the current process phase (and row, if given)
+    def setPhase(self, phase, row=None):
+        self.phase = phase
+        self.metrics.phaseChanged(phase)
+        if row is not None:
+            self.row = row
+        self.publishStatus()
+        self.emit("phase", phase=phase, row=self.row, option=self.option)
+
+    # Called at the end of every move with the number of steps taken
+    def moveFinished(self, motor_id, steps):
+        self.metrics.stepsIssued(motor_id, steps)
+        self.publishStatus()
+
+    """ Publishes the machine status in a shared-memory block that other
+    threads and processes can read without locks. See seeder_status.py.
+
+    >>> self.openStatusBlock()      # status_fn, or /dev/shm/seeder_status
+    """
+    def openStatusBlock(self, fn=None):
+        from seeder_status import StatusWriter, DEFAULT_FN
+        self.closeStatusBlock()
+        self.status_block = StatusWriter(fn or self.status_fn or DEFAULT_FN)
+        self.publishStatus()
+
+    def closeStatusBlock(self):
+        if self.status_block is not None:
+            self.status_block.close()
+            self.status_block = None
+
+    def publishStatus(self):
+        if self.status_block is not None:
+            self.status_block.publish(self)
+
+    def beginProcess(self, option, num_rows=None, params=None,
+                                                        resumable=True):
+        self.stop = False
+        self.option = option
+        self.option_params = params
+        self.row = 0
+        if num_rows is not None:
+            self.num_rows = num_rows
+        self.speed_scale = [1.0] * len(self.motor_id)
+        self.log("\n-- Begining Option {} process loop --".format(option))
+        self.metrics.processStarted()
+        self.journaling = True
+        if (resumable and self.resume_run
+                      and self.resume_run["option"] == option):
+            msg = "  Resuming, {} steps already complete"
+            self.log(msg.format(len(self.resume_run["done"])))
+            self.journal.resumed()
+        else:
+            self.resume_run = None
+            self.journal.begin(option, self.num_rows, params, resumable)
+            self.journal_live = True
+        self.emit("process", state="start", option=option)
+
+    def endProcess(self, option):
+        self.log("\n-- End of Option {} process loop --".format(option))
+        self.metrics.processFinished(option)
+        self.journaling = False
+        self.journal.end()
+        self.setPhase("")
+        self.emit("process", state="end", option=option)
+
     """
     ----------------------------------
      Low Level Functions
@@ -156,6 +554,9 @@ class SeederController():
     def setupMotorHAT(self):
         msg_text = "  Bottom HAT addr set to " + hex(self.bothat_addr)
         self.log(msg_text,log_only=True)
+        if self.simulate:
+            self.bothat = Adafruit_MotorHAT_empty(addr=self.bothat_addr)
+            return
         try:
             self.bothat = Adafruit_MotorHAT(addr=self.bothat_addr)
         except:
@@ -177,9 +578,13 @@ class SeederController():
                             step_pin   )
         self.log(msg,log_only=True)
         # set pins
-        GPIO.setup(dir_pin,  GPIO.OUT)
-        GPIO.setup(step_pin, GPIO.OUT)
-        GPIO.output(dir_pin, self.gpio_cw[mtr])
+        self.setupOutput(dir_pin)
+        self.setupOutput(step_pin)
+        self.writePin(dir_pin, self.gpio_cw[mtr])
+        if self.ms_pins[mtr] is not None:
+            for pin in self.ms_pins[mtr]:
+                self.setupOutput(pin)
+            self.setResolution(mtr, self.recipe_microsteps[mtr])
 
     # Define motors
     def setupMotors(self):
@@ -203,6 +608,13 @@ class SeederController():
     def getIndex(self, motor_id):
         return self.motor_id.index(motor_id)   # Get motor index from id
 
+    # Position change per step: +1 for Forward, -1 for Reverse
+    def getDirectionSign(self, direction):
+        dir_low = direction.lower()
+        if ('rev' in dir_low) or ('ccw' in dir_low):
+            return -1
+        return 1
+
     def setSpeed(self, motor_id, speed=0):
         if speed > 0:
             msg = "  Setting speed of motor {} to {}".format(motor_id, speed)
@@ -217,9 +629,50 @@ class SeederController():
         for relay in self.relay_list:
             msg_text = "  Relay Channel {} pin set to {}".format(relay,self.Relay_Ch[relay])
             self.log(msg_text,log_only=True)
-            GPIO.setup(self.Relay_Ch[relay],GPIO.OUT)
-            GPIO.output(self.Relay_Ch[relay],GPIO.HIGH)
+            self.setupOutput(self.Relay_Ch[relay])
+            self.writePin(self.Relay_Ch[relay],self.gpio.HIGH)
     
+    def setupOutput(self, pin):
+        self.gpio.setup(pin, self.gpio.OUT)
+        self.pin_shadow.pop(pin, None)  # Level unknown until written
+
+    """ Writes an output pin, unless the shadow copy shows it already has
+    that level. Returns True if the pin was written.
+
+    >>> self.writePin(19, 1)
+    True
+    >>> self.writePin(19, 1)    # Saved write
+    False
+    """
+    def writePin(self, pin, level):
+        last = self.pin_shadow.get(pin)
+        if last is not None and self.gpio_verify:
+            actual = self.gpio.input(pin)
+            if actual != last:
+                msg = "  Warning: Pin {} reads {}, expected {}"
+                self.log(msg.format(pin, actual, last), log_only=True)
+                self.metrics.gpioMismatch(pin)
+                last = actual
+        if last == level:
+            self.metrics.gpioWriteSaved()
+            return False
+        self.gpio.output(pin, level)
+        self.pin_shadow[pin] = level
+        return True
+
+    """ Re-reads every shadowed output pin from the hardware. Returns the
+    number of pins whose level differed from the shadow copy.
+    """
+    def syncPins(self):
+        changed = 0
+        for pin, level in list(self.pin_shadow.items()):
+            actual = self.gpio.input(pin)
+            if actual != level:
+                self.metrics.gpioMismatch(pin)
+                self.pin_shadow[pin] = actual
+                changed += 1
+        return changed
+
     # Turn off all motors
     def turnOffMotors(self):
         for mtr in range(4):
@@ -228,7 +681,9 @@ class SeederController():
     def checkStop(self):
         if self.stop:
             self.log("  Stop signal detected")
-            raise RuntimeError
+            self.metrics.processStopped()
+            self.journal.sync()
+            raise StopRequested
 
     """ Sets relay to a given state.
     
@@ -248,9 +703,15 @@ class SeederController():
         
         cmd = mode.lower()
         if ("on" in cmd) or ("close" in cmd):
-            GPIO.output(self.Relay_Ch[relay],GPIO.LOW)     # LOW = ON/Closed
+            self.writePin(self.Relay_Ch[relay],self.gpio.LOW)     # LOW = ON/Closed
+            self.relay_state[relay] = "on"
+            self.metrics.relaySet(relay, "on")
+            self.publishStatus()
         elif ("off" in cmd) or ("open" in cmd):
-            GPIO.output(self.Relay_Ch[relay],GPIO.HIGH)    # HIGH = OFF/Open
+            self.writePin(self.Relay_Ch[relay],self.gpio.HIGH)    # HIGH = OFF/Open
+            self.relay_state[relay] = "off"
+            self.metrics.relaySet(relay, "off")
+            self.publishStatus()
         else:
             self.log("  Unknown mode: {}".format(mode))
             raise ValueError
@@ -306,51 +767,267 @@ class SeederController():
         
         # Run the stepper
         self.stepper[motor_id].step(numsteps, direction, style)
+        self.position[motor_id] += self.getDirectionSign(this_dir) * numsteps
+        self.moveFinished(motor_id, numsteps)
         
         msg =  "  Finished MotorHAT stepper worker: "
         msg += "motor_id={}".format(motor_id)
         self.log(msg, log_only=True)
 
-    def runGPIO_Stepper(self, motor_id, steps, direction="Forward"):
+    """ Steps a GPIO motor. Returns the number of steps taken.
+
+    If until (a threading.Event) is given, the move ends before the next
+    step once it is set. Steps are in the motor's recipe resolution; if
+    the driver has microstep-select pins, the move may run at another
+    resolution (see getResolution()) with the pulse count and delay
+    rescaled to cover the same distance at the same speed.
+    """
+    def runGPIO_Stepper(self, motor_id, steps, direction="Forward", until=None,
+                                                            style="Double"):
         mtr_index = self.getIndex(motor_id)
-        dir_low = direction.lower()
+        sign = self.getDirectionSign(direction)
         cw = self.gpio_cw[mtr_index]
-        if ('rev' in dir_low) or ('ccw' in dir_low):
+        if sign < 0:
             dir_code = self.getCCW(cw)
         else:
             dir_code = cw
         
         # Calculate the delay from speed
         spr = self.steps_per_rev[mtr_index]
-        rpm = self.motor_speed[mtr_index]
-        delay = 30.0/(spr*rpm)   # Warning: Some limits should be made on this
+        rpm = self.motor_speed[mtr_index] * self.speed_scale[mtr_index]
+        base = self.recipe_microsteps[mtr_index]
 
         msg = "  Starting GPIO stepper worker: "
         msg += "motor_id={}, numsteps={}, direction={}"
         msg = msg.format(motor_id, steps, direction)
         self.log(msg, log_only=True)
         
-        # Set direction
-        GPIO.output(self.dir_pin[mtr_index], dir_code)
+        if self.motion_worker is not None:
+            # The motion worker process sets the direction pin
+            self.pin_shadow.pop(self.dir_pin[mtr_index], None)
+        else:
+            self.writePin(self.dir_pin[mtr_index], dir_code)
+
+        moved = 0       # Recipe steps, with the fractions of a step
+        stats = {"edges": 0, "misses": 0, "late_max": 0.0, "late_sum": 0.0,
+                 "scale": 1.0, "pulses": 0}
+        try:
+            for pulses, res in self.getStepSegments(motor_id, steps, style):
+                self.setResolution(mtr_index, res)
+                # Warning: Some limits should be made on this
+                delay = 30.0*base/(spr*res*rpm*stats["scale"])
+                stats["pulses"] = 0
+                try:
+                    self.pulseGPIO(mtr_index, pulses, dir_code, sign, delay,
+                                                            until, stats)
+                finally:
+                    moved += Fraction(stats["pulses"]*base, res)
+                if stats["pulses"] < pulses:
+                    break
+        finally:
+            done = int(moved)
+            position = self.position_frac[motor_id] + sign * moved
+            self.position_frac[motor_id] = position - int(position)
+            self.position[motor_id] += int(position)
+            self.moveFinished(motor_id, done)
+            self.deadlinesFinished(motor_id, stats)
         
+        msg =  "  Finished GPIO stepper worker: "
+        msg += "motor_id={}".format(motor_id)
+        self.log(msg, log_only=True)
+        return done
+
+    """ Sends pulses to a GPIO motor. Pulses sent and step deadline stats
+    are added to the stats dict.
+    """
+    def pulseGPIO(self, mtr_index, pulses, dir_code, sign, delay, until, 
+                                                                    stats):
+        tolerance = self.late_tolerance * delay
+        if self.motion_worker is not None:
+            # Pulses are generated by the motion worker process
+            should_abort = lambda: self.stop or (until is not None 
+                                                    and until.is_set())
+            stats["pulses"] = self.motion_worker.run(mtr_index, pulses,
+                            dir_code, sign, delay, should_abort, tolerance)
+            result = self.motion_worker.last_result[mtr_index]
+            edges = 2 * stats["pulses"]
+            stats["edges"] += edges
+            stats["misses"] += result["misses"]
+            stats["late_max"] = max(stats["late_max"], result["late_max"])
+            stats["late_sum"] += result["late_mean"] * edges
+            self.checkStop()
+            return
+
         # Run stepper motor. Use absolute timing for better accuracy
         next_time = time() 
-        for x in range(steps):
-            self.checkStop()
-            GPIO.output(self.step_pin[mtr_index], GPIO.HIGH)
+        step_pin = self.step_pin[mtr_index]
+        levels = (self.gpio.HIGH, self.gpio.LOW)
+        window = 0      # Misses since the last back off
+        for edge in range(2 * pulses):
+            if edge % 2 == 0:
+                self.checkStop()
+                if until is not None and until.is_set():
+                    break
+            self.gpio.output(step_pin, levels[edge % 2])
+            late = time() - next_time
+            stats["edges"] += 1
+            stats["late_sum"] += late
+            if late > stats["late_max"]:
+                stats["late_max"] = late
+            if late > tolerance:
+                stats["misses"] += 1
+                window += 1
+                if self.miss_backoff and window >= self.miss_threshold:
+                    # Slow down, and stop catching up on the lost time
+                    window = 0
+                    delay /= self.backoff_factor
+                    tolerance = self.late_tolerance * delay
+                    stats["scale"] *= self.backoff_factor
+                    next_time = time()
+                    msg = "  Warning: Motor {} missing step deadlines, "
+                    msg += "slowing to {:.0f}% speed"
+                    self.log(msg.format(self.motor_id[mtr_index],
+                                        100 * stats["scale"]), log_only=True)
+            if edge % 2:
+                stats["pulses"] += 1
             next_time += delay
             while time() < next_time:
                 sleep(delay/10)
-            
-            GPIO.output(self.step_pin[mtr_index], GPIO.LOW)
-            next_time += delay
-            while time() < next_time:
-                sleep(delay/10)
-        
-        msg =  "  Finished GPIO stepper worker: "
-        msg += "motor_id={}".format(motor_id)
-        self.log(msg, log_only=True)
+
+    # Records the step deadline stats of a finished GPIO move
+    def deadlinesFinished(self, motor_id, stats):
+        mtr_index = self.getIndex(motor_id)
+        edges = stats["edges"]
+        move = {"edges": edges, "misses": stats["misses"],
+                "late_max": stats["late_max"],
+                "late_mean": stats["late_sum"] / edges if edges else 0.0,
+                "speed_scale": self.speed_scale[mtr_index] * stats["scale"]}
+        self.move_stats[motor_id] = move
+        total = self.deadline_stats[motor_id]
+        total["moves"] += 1
+        total["edges"] += edges
+        total["misses"] += move["misses"]
+        total["late_max"] = max(total["late_max"], move["late_max"])
+        self.metrics.deadlinesMissed(motor_id, move["misses"])
+        if not move["misses"]:
+            return
+        msg = "  Warning: Motor {} missed {} of {} step deadlines "
+        msg += "(up to {:.2f} ms late)"
+        self.log(msg.format(motor_id, move["misses"], edges,
+                            move["late_max"] * 1000), log_only=True)
+        if self.miss_backoff == "run":
+            scale = stats["scale"]
+            if scale == 1.0 and move["misses"] >= self.miss_threshold:
+                scale = self.backoff_factor     # Motion worker moves
+            if scale < 1.0:
+                self.speed_scale[mtr_index] *= scale
+                self.metrics.speedBackedOff(motor_id)
+                msg = "  Warning: Motor {} held at {:.0f}% speed for the run"
+                self.log(msg.format(motor_id,
+                                    100 * self.speed_scale[mtr_index]))
+        elif stats["scale"] < 1.0:
+            self.metrics.speedBackedOff(motor_id)
+
+    """ Microsteps per full step for a GPIO move: the resolution set for
+    the current phase if auto_resolution is on, otherwise the one given by
+    the style. Motors without microstep-select pins always run at their
+    recipe resolution.
+    """
+    def getResolution(self, motor_id, style="Double"):
+        mtr_index = self.getIndex(motor_id)
+        if self.ms_pins[mtr_index] is None:
+            return self.recipe_microsteps[mtr_index]
+        res = None
+        if self.auto_resolution:
+            res = self.phase_microsteps.get(self.phase)
+        if res is None:
+            res = self.style_microsteps.get(style.lower(), 1)
+        if res not in self.ms_table:
+            self.log("  Unsupported resolution: 1/{} step".format(res))
+            raise ValueError
+        return res
+
+    """ Splits a move of recipe steps into (pulses, resolution) segments.
+    A coarse move ends with the steps that do not fill a whole coarse step,
+    at the recipe resolution.
+
+    # Recipe in 1/16 steps, run in full steps
+    >>> self.getStepSegments(1, 2375, "Double")
+    [(148, 1), (7, 16)]
+    """
+    def getStepSegments(self, motor_id, steps, style="Double"):
+        base = self.recipe_microsteps[self.getIndex(motor_id)]
+        res = self.getResolution(motor_id, style)
+        if res >= base:
+            return [(steps*res//base, res)]
+        ratio = base//res
+        segments = [(steps//ratio, res), (steps%ratio, base)]
+        return [seg for seg in segments if seg[0] > 0]
+
+    # Sets the driver's microstep-select pins
+    def setResolution(self, mtr_index, res):
+        pins = self.ms_pins[mtr_index]
+        if pins is None:
+            return
+        for pin, level in zip(pins, self.ms_table[res]):
+            self.writePin(pin, level)
     
+    """ Moves GPIO step pulse generation into a separate process, pinned to
+    a CPU and at real-time priority where the OS allows it. See 
+    seeder_motion.py.
+
+    >>> self.startMotionWorker(cpu=3, rt_priority=50)
+    """
+    def startMotionWorker(self, cpu=None, rt_priority=None):
+        from seeder_motion import MotionWorker
+        self.stopMotionWorker()
+        self.log("  Starting motion worker process",log_only=True)
+        self.motion_worker = MotionWorker(self.dir_pin, self.step_pin,
+                    simulate=self.simulate, cpu=cpu, rt_priority=rt_priority)
+
+    def stopMotionWorker(self):
+        if self.motion_worker is not None:
+            self.log("  Stopping motion worker process",log_only=True)
+            self.motion_worker.close()
+            self.motion_worker = None
+
+    """ Records every GPIO setup/output call and MotorHAT step call to a
+    binary file, for replay or comparison. See seeder_record.py.
+
+    >>> self.startRecording("option2.rec")
+    """
+    def startRecording(self, fn):
+        from seeder_record import (Recorder, RecordingGPIO, RecordingStepper,
+                                   OP_INITIAL)
+        self.stopRecording()
+        if self.motion_worker is not None:
+            self.log("  Warning: GPIO pulses from the motion worker are not "
+                     "recorded")
+        meta = {"step_pin": dict(zip(self.motor_id, self.step_pin)),
+                "dir_pin": dict(zip(self.motor_id, self.dir_pin)),
+                "relay_pin": self.Relay_Ch}
+        self.log("  Recording GPIO commands to {}".format(fn),log_only=True)
+        self.recorder = Recorder(fn, meta)
+        for relay in self.relay_list:
+            level = 0 if self.relay_state[relay] == "on" else 1
+            self.recorder.add(OP_INITIAL, self.Relay_Ch[relay], level)
+        self.gpio = RecordingGPIO(self.gpio, self.recorder)
+        for motor_id in self.stepper:
+            self.stepper[motor_id] = RecordingStepper(self.stepper[motor_id],
+                                                    motor_id, self.recorder)
+
+    def stopRecording(self):
+        if self.recorder is None:
+            return
+        self.gpio = self.gpio.inner
+        for motor_id in self.stepper:
+            self.stepper[motor_id] = self.stepper[motor_id].inner
+        self.recorder.close()
+        msg = "  Recorded {} GPIO commands to {}"
+        self.log(msg.format(self.recorder.count, self.recorder.fn),
+                                                            log_only=True)
+        self.recorder = None
+
     def releaseStepper(self,motor_id):
         mtr_index = self.getIndex(motor_id)
         if self.motor_control[mtr_index] == "GP":
@@ -365,15 +1042,92 @@ class SeederController():
         self.checkStop()
         if steps == 0:
             self.log("  Warning: Call to runStepper() but steps = 0")
-            return  # Do nothing
+            return 0  # Do nothing
         self.setSpeed(motor_id,speed)   # update speed if provided
         mtr_index = self.getIndex(motor_id)
         if self.motor_control[mtr_index] == "GP":
-            self.runGPIO_Stepper(motor_id,steps,direction)
+            return self.runGPIO_Stepper(motor_id,steps,direction,style=style)
         elif self.motor_control[mtr_index] == "MH":
             dir_code = self.getDirectionCode(direction)
             style_code = self.getStyleCode(style)
             self.stepper_worker(motor_id, steps, dir_code, style_code)
+            return steps
+
+    def getEdgeCode(self, edge):
+        code = None
+        cmd = edge.lower()
+        if "ris" in cmd:
+            code = self.gpio.RISING
+        elif "fall" in cmd:
+            code = self.gpio.FALLING
+        elif "both" in cmd:
+            code = self.gpio.BOTH
+        return code
+
+    def getPullCode(self, pull):
+        cmd = pull.lower()
+        if "up" in cmd:
+            return self.gpio.PUD_UP
+        elif "down" in cmd:
+            return self.gpio.PUD_DOWN
+        return self.gpio.PUD_OFF
+
+    """ Runs a motor until an edge is seen on a GPIO input, or max_steps.
+    The edge is caught by interrupt, and the move stops before the next
+    step. Returns the number of steps taken.
+
+    # Drive the conveyor until the tray sensor pulls pin 16 low
+    >>> self.runStepperUntil(1, 16, "falling", 2000, speed=160)
+    1712
+    """
+    def runStepperUntil(self, motor_id, input_pin, edge="rising", 
+                                            max_steps=0,
+                                            direction="Forward",
+                                            style="Double",
+                                            speed=0):
+        self.checkStop()
+        edge_code = self.getEdgeCode(edge)
+        if edge_code is None:
+            self.log("  Unknown edge: {}".format(edge))
+            raise ValueError
+        self.setSpeed(motor_id,speed)   # update speed if provided
+        mtr_index = self.getIndex(motor_id)
+
+        msg = "  Running motor {} until {} edge on pin {} (max {} steps)"
+        self.log(msg.format(motor_id, edge, input_pin, max_steps), 
+                                                            log_only=True)
+        fired = threading.Event()
+        self.gpio.setup(input_pin, self.gpio.IN,
+                        pull_up_down=self.getPullCode(self.sensor_pull))
+        self.pin_shadow.pop(input_pin, None)
+        self.gpio.add_event_detect(input_pin, edge_code,
+                                   callback=lambda pin: fired.set())
+        try:
+            if self.motor_control[mtr_index] == "GP":
+                done = self.runGPIO_Stepper(motor_id, max_steps, direction,
+                                                    until=fired, style=style)
+            else:
+                # MotorHAT steps are blocking, so go one step at a time
+                dir_code = self.getDirectionCode(direction)
+                style_code = self.getStyleCode(style)
+                sign = self.getDirectionSign(direction)
+                done = 0
+                while done < max_steps and not fired.is_set():
+                    self.checkStop()
+                    self.stepper[motor_id].step(1, dir_code, style_code)
+                    self.position[motor_id] += sign
+                    done += 1
+                self.moveFinished(motor_id, done)
+        finally:
+            self.gpio.remove_event_detect(input_pin)
+
+        if fired.is_set():
+            msg = "  Pin {} edge after {} steps".format(input_pin, done)
+        else:
+            msg = "  Warning: No edge on pin {} within {} steps"
+            msg = msg.format(input_pin, max_steps)
+        self.log(msg, log_only=True)
+        return done
 
     """ (Not Ready - Do not use) 
     Enables stepper without blocking. (Multiple motors can run at once)
@@ -390,23 +1144,171 @@ class SeederController():
         self.checkStop()
         msg = "  Starting motor {} as non-blocking."
         args = (motor_id, steps, direction, style, speed)
-        this_thread = threading.Thread(target=self.runStepper, args=args) 
+        this_thread = threading.Thread(target=self.runStepperThread,
+                                                            args=args) 
         self.thread_queue.append(this_thread)
         this_thread.start()
 
-    # Waits for all motors to finish
+    # Runs a non-blocking move. Its exception is raised by waitForMotors().
+    def runStepperThread(self, *args):
+        try:
+            self.runStepper(*args)
+        except Exception as e:
+            self.thread_errors.append(e)
+
+    """ Waits for all motors to finish. Raises the exception of a move
+    that failed, a fault in preference to a stop.
+    """
     def waitForMotors(self):
         msg = "  Waiting for {} motor threads to finish."
         self.log(msg.format(len(self.thread_queue)) ,log_only=True)
         while len(self.thread_queue) > 0:
             self.refresh()
             if self.thread_queue[-1]:
-                if not self.thread_queue[-1].isAlive():
+                if not self.thread_queue[-1].is_alive():
                     del self.thread_queue[-1]
             else:
                 del self.thread_queue[-1]   # remove from list
         self.log("  Threads finished.",log_only=True)
+        errors, self.thread_errors = self.thread_errors, []
+        faults = [e for e in errors if not isinstance(e, StopRequested)]
+        if faults or errors:
+            raise (faults or errors)[0]
     
+    """
+    ----------------------------------
+     Run Journal
+    ----------------------------------
+    """
+    # Relay states as a string of 0/1, in relay_list order
+    def getRelayBits(self):
+        bits = ["1" if self.relay_state[r] == "on" else "0"
+                                                for r in self.relay_list]
+        return "".join(bits)
+
+    # Returns False if the step is already complete in the resumed run
+    def isPending(self, phase, row=0):
+        if not self.journaling or self.resume_run is None:
+            return True
+        if (phase, row) in self.resume_run["done"]:
+            msg = "  Skipping {} (complete)".format(phase)
+            if row:
+                msg = "  Skipping {} {} (complete)".format(phase, row)
+            self.log(msg, log_only=True)
+            return False
+        # First unfinished step: put the machine back as it was
+        self.restoreState(self.resume_run)
+        self.resume_run = None
+        return True
+
+    def checkpoint(self, phase, row=0):
+        if self.journaling:
+            positions = [self.position[m] for m in self.motor_id]
+            self.journal.checkpoint(phase, row, self.getRelayBits(), positions)
+
+    """ Yields the rows of a row loop that are still to be done, and
+    records each row in the journal once the loop body has finished it.
+    Rows are counted from 0 like range(self.num_rows).
+
+    >>> for row in self.pendingRows("dippleRow"):
+    ...     self.dippleRow(row+1)
+    """
+    def pendingRows(self, phase):
+        for row in range(self.num_rows):
+            if self.isPending(phase, row+1):
+                yield row
+                self.checkpoint(phase, row+1)
+
+    def restoreState(self, run):
+        self.log("\nRestore Machine State")
+        if run["positions"] and self.journal_live:
+            # The motors kept moving after the checkpoint; drive them back
+            for mtr_id, position in zip(self.motor_id, run["positions"]):
+                if self.position[mtr_id] != position:
+                    msg = "  Moving motor {} back from {} to {}"
+                    self.log(msg.format(mtr_id, self.position[mtr_id],
+                                                                position))
+                    self.moveToPosition(mtr_id, position)
+        elif run["positions"]:
+            # Counts of another process: assume the machine has not moved
+            for mtr_id, position in zip(self.motor_id, run["positions"]):
+                self.position[mtr_id] = position
+                self.position_frac[mtr_id] = 0
+            self.journal_live = True
+        if run["relays"]:
+            for relay, bit in zip(self.relay_list, run["relays"]):
+                if bit == "1":
+                    self.setRelay(relay, mode="Close")
+                else:
+                    self.setRelay(relay, mode="Open")
+            if "1" in run["relays"]:
+                self.settle(self.resume_settle)   # Let vacuum and air settle
+
+    """ Continues the process loop recorded in the journal from its first
+    unfinished phase or row. Returns False if there is nothing to resume.
+    """
+    def resume(self):
+        run = self.journal.load()
+        if run is None:
+            self.log("\nNothing to resume")
+            return False
+        self.resume_run = run
+        self.log("\nResuming Option {}".format(run["option"]))
+        params = dict(run["params"] or {})
+        params["num_rows"] = run["num_rows"]
+        getattr(self, "runOption{}".format(run["option"]))(params)
+        return True
+
+    """
+    ----------------------------------
+     Position Tracking
+    ----------------------------------
+    """
+    def getPosition(self, motor_id):
+        return self.position[motor_id]
+
+    # Redefines the current position of a motor (e.g. after homing)
+    def setPosition(self, motor_id, position=0):
+        self.log("  Motor {} position set to {}".format(motor_id, position),
+                                                            log_only=True)
+        self.position[motor_id] = position
+        self.position_frac[motor_id] = 0
+
+    """ Names a position of a motor. Defaults to where the motor is now.
+
+    >>> self.markPosition("tray_start", 1)
+    >>> self.markPosition("seed_pickup", 4, position=-220)
+    """
+    def markPosition(self, name, motor_id, position=None):
+        if position is None:
+            position = self.position[motor_id]
+        self.named_positions[name] = (motor_id, position)
+
+    # Steps from the current position to a named or absolute target
+    def getDelta(self, motor_id, target):
+        if target in self.named_positions:
+            target_motor, target = self.named_positions[target]
+            if target_motor != motor_id:
+                self.log("  Position {} belongs to motor {}".format(
+                                                    target, target_motor))
+                raise ValueError
+        return target - self.position[motor_id]
+
+    """ Moves a motor the minimal distance to a named or absolute position.
+    Returns the signed number of steps requested.
+
+    >>> self.moveToPosition(1, "tray_exit", speed=160)
+    """
+    def moveToPosition(self, motor_id, target, style="Double", speed=0):
+        delta = self.getDelta(motor_id, target)
+        if delta > 0:
+            self.runStepper(motor_id, steps=delta, direction="Forward",
+                                                    style=style, speed=speed)
+        elif delta < 0:
+            self.runStepper(motor_id, steps=-delta, direction="Reverse",
+                                                    style=style, speed=speed)
+        return delta
+
     """
     ----------------------------------
      User Level Functions
@@ -418,16 +1320,21 @@ class SeederController():
         self.releaseAirValves()
         self.setRelay(1,mode="Close")
         self.log("\nPlease wait...")
-        sleep(0.1)
+        self.settle(0.1)
         
-    def fillTray(self, steps_m1_first=575, steps_m1=2850, steps_m2=8050):
+    @checkpointed
+    def fillTray(self, steps_m1_first=575, steps_m1=2850, steps_m2=8050,
+                                speed_first=60, speed_m1=10, speed_m2=70):
         self.log("\nFill tray")
+        self.setPhase("fillTray")
+        self.markPosition("tray_start", 1)
         self.setRelay(8,mode="Close")
-        self.runStepper(1,steps=steps_m1_first,direction="Forward",speed=60)
+        self.runStepper(1,steps=steps_m1_first,direction="Forward",
+                                                            speed=speed_first)
         self.setRelay(6,mode="Close")
         # Run both at once\
-        self.startStepperNoBlock(1,steps=steps_m1,direction="Forward",speed=10)   
-        self.startStepperNoBlock(2,steps=steps_m2,direction="Forward",speed=70)   
+        self.startStepperNoBlock(1,steps=steps_m1,direction="Forward",speed=speed_m1)   
+        self.startStepperNoBlock(2,steps=steps_m2,direction="Forward",speed=speed_m2)   
         self.waitForMotors()
         self.setRelay(8,mode="Open")
         self.setRelay(6,mode="Open")
@@ -435,94 +1342,131 @@ class SeederController():
     def releaseDirtHopper(self):
         pass # No longer needed
 
-    def cleanTray(self,steps_m1=3900,steps_m3=1900):
+    @checkpointed
+    def cleanTray(self,steps_m1=3900,steps_m3=1900,speed_m1=40,speed_m3=50):
         self.log("Clean Tray")
+        self.setPhase("cleanTray")
         self.runStepper(1,steps=1,direction="Forward",speed=20)  
         # Run both at once 
-        self.startStepperNoBlock(1,steps=steps_m1,direction="Forward",speed=40)   
-        self.startStepperNoBlock(3,steps=steps_m3,direction="Forward",speed=50)  
+        self.startStepperNoBlock(1,steps=steps_m1,direction="Forward",speed=speed_m1)   
+        self.startStepperNoBlock(3,steps=steps_m3,direction="Forward",speed=speed_m3)  
         self.waitForMotors()
         self.releaseStepper(3)
 
-    def setTray(self,steps_m1_fwd=1500,steps_m1_rvs=75):
+    @checkpointed
+    def setTray(self,steps_m1_fwd=1500,steps_m1_rvs=75,speed=160,settle=0.1):
         self.log("Set Tray")
+        self.setPhase("setTray")
         self.setRelay(1,mode="Close")
-        sleep(0.1)
-        self.runStepper(1,steps=steps_m1_fwd,direction="Forward",speed=160)
-        self.runStepper(1,steps=steps_m1_rvs,direction="Reverse",speed=160)
-        sleep(0.1)
+        self.settle(settle)
+        if self.tray_sensor_pin is None:
+            self.runStepper(1,steps=steps_m1_fwd,direction="Forward",speed=speed)
+        else:
+            # Stop at the tray instead of running the full distance
+            self.runStepperUntil(1, self.tray_sensor_pin, 
+                    self.tray_sensor_edge, max_steps=steps_m1_fwd, speed=speed)
+        self.runStepper(1,steps=steps_m1_rvs,direction="Reverse",speed=speed)
+        self.settle(settle)
 
-    def forwardDibbler(self,steps_m1=190):
+    @checkpointed
+    def forwardDibbler(self,steps_m1=190,speed=160,settle=0.1):
         self.log("Forward Dibbler")
+        self.setPhase("forwardDibbler")
         self.setRelay(1,mode="Open")
-        sleep(0.1)
-        self.runStepper(1,steps=steps_m1,direction="Forward",speed=160)
+        self.settle(settle)
+        self.runStepper(1,steps=steps_m1,direction="Forward",speed=speed)
 
-    def dippleRow(self, cnt, steps_odd=182, steps_even=182):
+    def dippleRow(self, cnt, steps_odd=182, steps_even=182, speed=160,
+                                                            settle=0.05):
         self.log("\nDibble Row {}".format(cnt))
+        self.setPhase("dippleRow", cnt)
         self.setRelay(1,mode="Close")
-        sleep(0.05)
+        self.settle(settle)
         self.setRelay(1,mode="Open")
-        sleep(0.05)
+        self.settle(settle)
         if cnt%2 > 0:
             steps = steps_odd  # Odd rows
         else:
             steps = steps_even  # Even rows
-        self.runStepper(1,steps=steps,direction="Forward",speed=160)
+        self.runStepper(1,steps=steps,direction="Forward",speed=speed)
         
-    def advanceToSeeder(self,steps_m1=403,steps_m4=219,dir_m4="Reverse"):
+    @checkpointed
+    def advanceToSeeder(self,steps_m1=403,steps_m4=219,dir_m4="Reverse",
+                                                    speed=160,speed_m4=0):
         self.log("\nAdvance To Seeder")
+        self.setPhase("advanceToSeeder")
         self.log("Activate Vacuum")
         self.setRelay(7,mode="Close")        
-        self.runStepper(1, steps=steps_m1, direction="Forward", speed=160)
-        self.runStepper(4, steps=steps_m4, direction=dir_m4, style="Interleave")
+        self.runStepper(1, steps=steps_m1, direction="Forward", speed=speed)
+        self.runStepper(4, steps=steps_m4, direction=dir_m4, style="Interleave",
+                                                            speed=speed_m4)
                
-    def activateVacuum(self):        
+    @checkpointed
+    def activateVacuum(self, settle=1.0):        
+        self.setPhase("activateVacuum")
         self.setRelay(5,mode="Close")
         self.setRelay(2,mode="Close")
         self.setRelay(3,mode="Open")
-        sleep(1.0)
+        self.settle(settle)
         
-    def setRow(self, cnt, steps_odd=182, steps_even=182):
+    def setRow(self, cnt, steps_odd=182, steps_even=182, speed=0):
         self.log("\nSet Row {}".format(cnt))
+        self.setPhase("setRow", cnt)
         if cnt%2 > 0:
             steps = steps_odd  # Odd rows
         else:
             steps = steps_even  # Even rows
-        self.runStepper(1,steps=steps,direction="Forward")
+        self.runStepper(1,steps=steps,direction="Forward",speed=speed)
         
-    def rotateToTray(self,steps_m4=486, m4_dir="Forward"):
+    def rotateToTray(self,steps_m4=486, m4_dir="Forward", speed=180, 
+                                                            settle=0.5):
         self.log("Rotate To Tray")
+        self.setPhase("rotateToTray")
         self.setRelay(5,mode="Open")
-        sleep(0.5)
+        self.settle(settle)
         self.setRelay(5,mode="Close")
-        self.runStepper(4, steps=steps_m4, direction=m4_dir, speed=180,
+        self.runStepper(4, steps=steps_m4, direction=m4_dir, speed=speed,
                                                         style="Interleave")
 
-    def releaseSeed(self,row,steps_nom=486,steps_last=372):
+    def releaseSeed(self,row,steps_nom=486,steps_last=372,speed=180,
+                                                settle=0.5,settle_puff=0.05):
         self.log("Release Seed")
+        self.setPhase("releaseSeed")
         self.setRelay(2,mode="Open")
-        sleep(0.5)
+        self.settle(settle)
+        self.metrics.seedPlaced()
         self.setRelay(3,mode="Close")
-        sleep(0.05)
+        self.settle(settle_puff)
         self.setRelay(3,mode="Open")
         
         if row == self.num_rows:
             # Do not pick up another seed
-            self.runStepper(4, steps=steps_last, direction="Reverse", speed=180, 
+            self.runStepper(4, steps=steps_last, direction="Reverse", speed=speed, 
                                                     style="Interleave")
         else:
             # pick up another seed
-            self.runStepper(4, steps=steps_nom, direction="Forward", speed=180, 
+            self.runStepper(4, steps=steps_nom, direction="Forward", speed=speed, 
                                                     style="Interleave")
         self.setRelay(2,mode="Close")
-        sleep(0.5)
+        self.settle(settle)
 
-    def returnToZero(self,steps_m1=4000):
+    @checkpointed
+    def returnToZero(self,steps_m1=4000,speed=160):
         self.setRelay(5,mode="Open")        
         self.log("\nReturn To Zero")
+        self.setPhase("returnToZero")
         self.releaseStepper(4)
-        self.runStepper(1, steps=steps_m1, direction="Forward", speed=160)
+        exit_steps = self.getExitSteps()
+        if exit_steps and "tray_start" in self.named_positions:
+            # Only run the distance left to clear the tray
+            start = self.named_positions["tray_start"][1]
+            remaining = start + exit_steps - self.position[1]
+            steps_m1 = max(0, min(steps_m1, remaining))
+        if steps_m1 > 0 and self.exit_sensor_pin is not None:
+            self.runStepperUntil(1, self.exit_sensor_pin, 
+                    self.exit_sensor_edge, max_steps=steps_m1, speed=speed)
+        elif steps_m1 > 0:
+            self.runStepper(1, steps=steps_m1, direction="Forward", speed=speed)
         self.releaseStepper(3)
         self.releaseStepper(4)
         
@@ -530,167 +1474,234 @@ class SeederController():
         self.log("\nRelease Air Valves")
         for relay in self.relay_list:
             self.setRelay(relay,mode="Open")    # open all relays
-        
-    # Option 1. Dibble and Seed 29 Rows
-    def runOption1(self):
-        self.stop = False
-        self.log("\n-- Begining Option 1 process loop --")
-        self.num_rows = 29
-        
-        self.releaseAll()
-        sleep(1.0)
-        self.fillTray(steps_m1_first=5, steps_m1=5, steps_m2=5) 
+
+    """ Returns the parameters of an option: its OPTION_PARAMS entry, with
+    any overrides given in params.
+
+    >>> self.getOptionParams(2, {"speed_seedhead": 200})
+    """
+    def getOptionParams(self, option, params=None):
+        p = dict(OPTION_PARAMS[option])
+        if params:
+            unknown = set(params) - set(p)
+            if unknown:
+                msg = "  Unknown parameters for option {}: {}"
+                self.log(msg.format(option, ", ".join(sorted(unknown))))
+                raise ValueError
+            p.update(params)
+        return p
+
+    """ Returns the conveyor travel from the start of fillTray until the
+    tray is clear of the machine: conveyor_exit_steps if set, otherwise the
+    travel of the running option's own moves, captured once for each set of
+    parameters.
+    """
+    def getExitSteps(self):
+        if self.conveyor_exit_steps is not None:
+            return self.conveyor_exit_steps
+        if self.option not in OPTION_PARAMS:
+            return None
+        key = (self.option, repr(sorted(self.getOptionParams(self.option,
+                                        self.option_params).items())))
+        if key not in self.exit_steps:
+            from seeder_pipeline import trayTravel
+            self.exit_steps[key] = trayTravel(self.option,
+                                              self.option_params)
+        return self.exit_steps[key]
+
+    """ Runs several trays of an option with more than one on the
+    conveyor at a time. See seeder_pipeline.py.
+
+    >>> self.runPipeline(2, trays=10)
+    """
+    def runPipeline(self, option, trays=2, params=None, max_in_flight=2,
+                                                        tray_pitch=None):
+        from seeder_pipeline import TrayPipeline
+        pipeline = TrayPipeline(self, option, params=params, trays=trays,
+                                max_in_flight=max_in_flight,
+                                tray_pitch=tray_pitch)
+        pipeline.run()
+
+    """ Keeps the compiled motion plans of options in a directory, used by
+    runPlanned() and runPipeline(). See seeder_plans.py.
+
+    >>> self.openPlanCache("seeder_plans", max_bytes=16 << 20)
+    """
+    def openPlanCache(self, directory="seeder_plans", max_bytes=16 << 20):
+        from seeder_plans import PlanCache
+        self.closePlanCache()
+        self.log("  Motion plan cache in {}".format(directory),log_only=True)
+        self.plan_cache = PlanCache(directory, max_bytes)
+        # Plans start from the speeds at the start of the run, so every
+        # tray runs the same plan whatever speeds the last one left
+        self.plan_speed = list(self.motor_speed)
+
+    def closePlanCache(self):
+        if self.plan_cache is not None:
+            self.plan_cache.close()
+            self.plan_cache = None
+
+    """ Runs one tray of an option from its cached plan. Without a plan
+    cache, or with tray sensors fitted, the option is run directly.
+
+    >>> self.runPlanned(2, {"speed_seedhead": 200})
+    """
+    def runPlanned(self, option, params=None):
+        if self.plan_cache is None or self.tray_sensor_pin is not None \
+                                   or self.exit_sensor_pin is not None:
+            getattr(self, "runOption{}".format(option))(params)
+            return
+        from seeder_plans import runPlan
+        runPlan(self, self.plan_cache.load(self, option, params), params)
+
+    # Steps shared by all options up to the dibbler
+    def prepareTray(self, p):
+        # A resumed run keeps the machine as the stop left it (the needle
+        # vacuum on); the relays of the last checkpoint are restored
+        # before the first unfinished step
+        if self.resume_run is None:
+            self.releaseAll()
+            self.settle(p["settle_start"])
+        self.fillTray(steps_m1_first=p["fill_m1_first"], 
+                steps_m1=p["fill_m1"], steps_m2=p["fill_m2"],
+                speed_first=p["speed_fill_first"], 
+                speed_m1=p["speed_fill_m1"], speed_m2=p["speed_fill_m2"]) 
         self.releaseDirtHopper()  
-        self.cleanTray(steps_m1=3,steps_m3=1)   
-        self.setTray(steps_m1_fwd=3,steps_m1_rvs=5) 
-        self.forwardDibbler(steps_m1=9)
+        self.cleanTray(steps_m1=p["clean_m1"], steps_m3=p["clean_m3"],
+                speed_m1=p["speed_clean_m1"], speed_m3=p["speed_clean_m3"])
+        self.setTray(steps_m1_fwd=p["set_fwd"], steps_m1_rvs=p["set_rvs"],
+                speed=p["speed_conveyor"], settle=p["settle_tray"]) 
+        self.forwardDibbler(steps_m1=p["dibbler_m1"], 
+                speed=p["speed_conveyor"], settle=p["settle_tray"])
 
-        for row in range(self.num_rows):        
-            self.dippleRow(row+1,steps_odd=1, steps_even=1)
+    def dibbleRows(self, p):
+        for row in self.pendingRows("dippleRow"):
+            self.dippleRow(row+1, steps_odd=p["dibble_odd"], 
+                    steps_even=p["dibble_even"], speed=p["speed_conveyor"],
+                    settle=p["settle_dibble"])
 
-        self.advanceToSeeder(steps_m1=2000,steps_m4=170,dir_m4="Forward")
-        self.activateVacuum()
-        
-        for row in range(self.num_rows):
-            self.setRow(row+1, steps_odd=182, steps_even=182)
-            self.rotateToTray(steps_m4=330, m4_dir="Reverse")   
-            self.releaseSeed(row+1,steps_nom=330,steps_last=160)
+    def prepareSeeder(self, p):
+        self.advanceToSeeder(steps_m1=p["advance_m1"], 
+                steps_m4=p["advance_m4"], dir_m4=p["advance_dir_m4"],
+                speed=p["speed_conveyor"], speed_m4=p["speed_advance_m4"])
+        self.activateVacuum(settle=p["settle_vacuum"])
+
+    # Rotates the seedhead to the tray and releases one seed
+    def placeSeed(self, p, row, steps_last):
+        self.rotateToTray(steps_m4=p["rotate_m4"], m4_dir=p["rotate_dir_m4"],
+                speed=p["speed_seedhead"], settle=p["settle_rotate"])   
+        self.releaseSeed(row, steps_nom=p["seed_nom"], steps_last=steps_last,
+                speed=p["speed_seedhead"], settle=p["settle_release"],
+                settle_puff=p["settle_puff"])
 
-        self.returnToZero(steps_m1=2500)    
+    def finishTray(self, p):
+        self.returnToZero(steps_m1=p["return_m1"], speed=p["speed_conveyor"])    
         self.releaseAll()  
-        
-        self.log("\n-- End of Option 1 process loop --")
 
-    # Option 2. Dibble and Seed 12 Rows
-    def runOption2(self):
-        self.stop = False
-        self.log("\n-- Begining Option 2 process loop --")
-        self.num_rows = 12
+    # Option 1. Dibble and Seed 29 Rows
+    def runOption1(self, params=None):
+        p = self.getOptionParams(1, params)
+        self.beginProcess(1, num_rows=p["num_rows"], params=params)
         
-        self.releaseAll()
-        sleep(10.0)
-        self.fillTray(steps_m1_first=740, steps_m1=2375, steps_m2=17500) 
-        self.releaseDirtHopper()  
-        self.cleanTray(steps_m1=3300,steps_m3=1700)   
-        self.setTray(steps_m1_fwd=2000,steps_m1_rvs=75) 
-        self.forwardDibbler(steps_m1=234)
+        self.prepareTray(p)
+        self.dibbleRows(p)
+        self.prepareSeeder(p)
+        
+        for row in self.pendingRows("seedRow"):
+            self.setRow(row+1, steps_odd=p["row_odd"], 
+                    steps_even=p["row_even"], speed=p["speed_row"])
+            self.placeSeed(p, row+1, p["seed_last"])
 
-        for row in range(self.num_rows):        
-            self.dippleRow(row+1,steps_odd=202, steps_even=204)
+        self.finishTray(p)
+        
+        self.endProcess(1)
 
-        self.advanceToSeeder(steps_m1=387,steps_m4=220)
-        self.activateVacuum()               
+    # Option 2. Dibble and Seed 12 Rows
+    def runOption2(self, params=None):
+        p = self.getOptionParams(2, params)
+        self.beginProcess(2, num_rows=p["num_rows"], params=params)
         
-        for row in range(self.num_rows):
-            self.setRow(row+1, steps_odd=201, steps_even=203)
-            self.rotateToTray(steps_m4=486)   
-            self.releaseSeed(row+1,steps_nom=486,steps_last=275)
+        self.prepareTray(p)
+        self.dibbleRows(p)
+        self.prepareSeeder(p)
+        
+        for row in self.pendingRows("seedRow"):
+            self.setRow(row+1, steps_odd=p["row_odd"], 
+                    steps_even=p["row_even"], speed=p["speed_row"])
+            self.placeSeed(p, row+1, p["seed_last"])
 
-        self.returnToZero(steps_m1=2000)    
-        self.releaseAll()    
+        self.finishTray(p)
         
-        self.log("\n-- End of Option 2 process loop --")
+        self.endProcess(2)
 
     # Option 3. Seed 12 Rows, No Dibble
-    def runOption3(self):
-        self.stop = False
-        self.log("\n-- Begining Option 3 process loop --")
-        self.num_rows = 12
+    def runOption3(self, params=None):
+        p = self.getOptionParams(3, params)
+        self.beginProcess(3, num_rows=p["num_rows"], params=params)
         
-        self.releaseAll()
-        sleep(10.0)
-        self.fillTray(steps_m1_first=700, steps_m1=2475, steps_m2=8800) 
-        self.releaseDirtHopper()  
-        self.cleanTray(steps_m1=3200,steps_m3=1750)   
-        self.setTray(steps_m1_fwd=2000,steps_m1_rvs=75) 
-        self.forwardDibbler(steps_m1=2780)
-
-        self.advanceToSeeder(steps_m1=390,steps_m4=220)
-        self.activateVacuum()               
+        self.prepareTray(p)
+        self.prepareSeeder(p)
         
-        for row in range(self.num_rows):
-            self.setRow(row+1, steps_odd=212, steps_even=212)
-            self.rotateToTray(steps_m4=486)   
-            self.releaseSeed(row+1,steps_nom=486,steps_last=352)
+        for row in self.pendingRows("seedRow"):
+            self.setRow(row+1, steps_odd=p["row_odd"], 
+                    steps_even=p["row_even"], speed=p["speed_row"])
+            self.placeSeed(p, row+1, p["seed_last"])
 
-        self.returnToZero(steps_m1=2000)    
-        self.releaseAll()    
+        self.finishTray(p)
         
-        self.log("\n-- End of Option 3 process loop --")
+        self.endProcess(3)
 
     # Option 4. No Dibble, Place 3 Seeds Over 12 Rows
-    def runOption4(self):
-        self.stop = False
-        self.log("\n-- Begining Option 4 process loop --")
-        self.num_rows = 12
+    def runOption4(self, params=None):
+        p = self.getOptionParams(4, params)
+        self.beginProcess(4, num_rows=p["num_rows"], params=params)
         
-        self.releaseAll()
-        sleep(10.0)
-        self.fillTray(steps_m1_first=740, steps_m1=2700, steps_m2=20000) 
-        self.releaseDirtHopper()  
-        self.cleanTray(steps_m1=3400,steps_m3=1400)   
-        self.setTray(steps_m1_fwd=2000,steps_m1_rvs=75) 
-        self.forwardDibbler(steps_m1=2720)
-
-        self.advanceToSeeder(steps_m1=400,steps_m4=220)
-        self.activateVacuum()                           
+        self.prepareTray(p)
+        self.prepareSeeder(p)
         
-        for row in range(self.num_rows):
+        for row in self.pendingRows("seedRow"):
             # First Seed
-            self.setRow(row+1, steps_odd=197, steps_even=197)
-            self.rotateToTray(steps_m4=488)   
-            self.releaseSeed(row,steps_nom=488,steps_last=352)
+            self.setRow(row+1, steps_odd=p["row_odd"], 
+                    steps_even=p["row_even"], speed=p["speed_row"])
+            self.placeSeed(p, row, p["seed_last_1"])
             # Second Seed
-            self.runStepper(1,steps=5,direction="Forward")
-            self.rotateToTray(steps_m4=488)   
-            self.releaseSeed(row,steps_nom=488,steps_last=372)
+            self.runStepper(1,steps=p["shift_m1"],direction="Forward",
+                                                    speed=p["speed_row"])
+            self.placeSeed(p, row, p["seed_last_2"])
             # Third Seed
-            self.runStepper(1,steps=5,direction="Forward")
-            self.rotateToTray(steps_m4=488)   
-            self.releaseSeed(row+1,steps_nom=488,steps_last=285)
+            self.runStepper(1,steps=p["shift_m1"],direction="Forward",
+                                                    speed=p["speed_row"])
+            self.placeSeed(p, row+1, p["seed_last_3"])
 
-        self.returnToZero(steps_m1=500)    
-        self.releaseAll()    
-        self.log("\n-- End of Option 4 process loop --")
+        self.finishTray(p)
+        self.endProcess(4)
 
     # Option 5. Dibble 12 Rows, Places 2 Seeds Per Row
-    def runOption5(self):
-        self.stop = False
-        self.log("\n-- Begining Option 5 process loop --")
-        self.num_rows = 12
+    def runOption5(self, params=None):
+        p = self.getOptionParams(5, params)
+        self.beginProcess(5, num_rows=p["num_rows"], params=params)
         
-        self.releaseAll()
-        sleep(10.0)
-        self.fillTray(steps_m1_first=740, steps_m1=2575, steps_m2=15800) 
-        self.releaseDirtHopper()  
-        self.cleanTray(steps_m1=3400,steps_m3=1400)
-        self.setTray(steps_m1_fwd=2000,steps_m1_rvs=75) 
-        self.forwardDibbler(steps_m1=235)
-
-        for row in range(self.num_rows):        
-            self.dippleRow(row+1,steps_odd=205, steps_even=205)
-
-        self.advanceToSeeder(steps_m1=387,steps_m4=220)
-        self.activateVacuum()                       
+        self.prepareTray(p)
+        self.dibbleRows(p)
+        self.prepareSeeder(p)
         
-        for row in range(self.num_rows):
+        for row in self.pendingRows("seedRow"):
             # First seed
-            self.setRow(row+1, steps_odd=205, steps_even=205)
-            self.rotateToTray(steps_m4=486)   
-            self.releaseSeed(row,steps_nom=486,steps_last=275)
+            self.setRow(row+1, steps_odd=p["row_odd"], 
+                    steps_even=p["row_even"], speed=p["speed_row"])
+            self.placeSeed(p, row, p["seed_last_1"])
             # Second seed
-            self.runStepper(1,steps=6,direction="Forward")
-            self.rotateToTray(steps_m4=486)   
-            self.releaseSeed(row+1,steps_nom=486,steps_last=275)
+            self.runStepper(1,steps=p["shift_m1"],direction="Forward",
+                                                    speed=p["speed_row"])
+            self.placeSeed(p, row+1, p["seed_last_2"])
 
-        self.returnToZero(steps_m1=200)    
-        self.releaseAll()      
+        self.finishTray(p)
         
-        self.log("\n-- End of Option 5 process loop --")
+        self.endProcess(5)
 
 
 if __name__ == "__main__":
-    # Create seeder controller object and run the main loop
-    sc = SeederController()
-    sc.num_rows = 3
-    sc.runOption1()
+    # Run from the command line, see seeder_cli.py for the options
+    import sys
+    import seeder_cli
+    sys.exit(seeder_cli.main())
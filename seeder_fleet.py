@@ -0,0 +1,703 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Runs several seeding machines from one host process.
+
+A Fleet holds machines and a queue of jobs. A LocalMachine owns a
+SeederController in this process; a RemoteMachine drives the controller of
+a seeder_server.py on another Pi over its JSON-lines socket protocol. Each
+machine has a worker thread that takes the next queued job it may run, so
+trays go to whichever machine is free. A job of several trays is pipelined
+on its machine (see seeder_pipeline.py); with a batch size, the trays of a
+request are split into jobs that several machines share.
+
+Recipes are loaded once and shared by every machine. The fleet also keeps
+a plan per recipe with its predicted cycle time (see seeder_sweep.py),
+used to estimate when the queue will be done. With a plan cache directory,
+the local machines share their compiled motion plans (seeder_plans.py).
+
+Status and metrics of all machines are gathered on request; the metrics
+of each machine are labelled with its name.
+
+This host can only drive the hardware of one machine (the GPIO pins are
+fixed). Other local machines must be simulated.
+
+Written for Python 2.7 and 3. Four spaces per indentation.
+
+    python seeder_fleet.py --local line1 --remote line2=unix:/tmp/seeder.sock \\
+            --remote line3=192.168.1.23:8765 --recipe tomato=best.json \\
+            --run tomato:20 --batch 5 --metrics-port 9200
+
+>>> fleet = Fleet()
+>>> fleet.addLocal("sim1", simulate=True)
+>>> fleet.addRemote("line2", "unix:/tmp/seeder.sock")
+>>> fleet.submit("option2", trays=10, batch=2)
+>>> fleet.start()
+>>> fleet.wait()
+"""
+
+import json
+import socket
+import threading
+import traceback
+from time import time
+
+from seeder_controller import SeederController, StopRequested, OPTION_PARAMS
+from seeder_metrics import SeederMetrics, Gauge
+
+
+""" Adds a label to every sample line of a Prometheus text. Returns a list
+of (metric family, line) pairs.
+
+>>> labelSamples('# TYPE h histogram\\nh_sum 1\\nh_count{x="2"} 3\\n',
+...              "machine", "m1")
+[('h', '# TYPE h histogram'), ('h', 'h_sum{machine="m1"} 1'),
+ ('h', 'h_count{machine="m1",x="2"} 3')]
+"""
+def labelSamples(text, name, value):
+    out = []
+    family = None
+    label = '{}="{}"'.format(name, value)
+    for line in text.splitlines():
+        if not line:
+            continue
+        if line.startswith("#"):
+            parts = line.split(None, 3)
+            if len(parts) >= 3:
+                family = parts[2]
+            out.append((family, line))
+            continue
+        if "{" in line:
+            line = line.replace("{", "{" + label + ",", 1)
+        else:
+            sample, rest = line.split(" ", 1)
+            line = "{}{{{}}} {}".format(sample, label, rest)
+        out.append((family, line))
+    return out
+
+
+""" Parses "unix:/path" or "host:port". Returns an argument for connect(). """
+def parseAddress(address):
+    if address.startswith("unix:"):
+        return address[len("unix:"):]
+    host, port = address.rsplit(":", 1)
+    return (host, int(port))
+
+
+class LocalMachine():
+    """A SeederController in this process."""
+
+    def __init__(self, name, sc=None, simulate=False):
+        if sc is None:
+            # Machines of one host must not share a log, journal or status
+            # block. The constructor already writes the log.
+            from seeder_status import DEFAULT_FN
+            sc = SeederController(simulate=simulate,
+                    log_fn="seeder_log_{}.txt".format(name),
+                    journal_fn="seeder_journal_{}.txt".format(name),
+                    status_fn="{}_{}".format(DEFAULT_FN, name))
+            sc.verbose = False
+        self.name = name
+        self.sc = sc
+
+    """ Runs trays of an option, pipelined if more than one. Returns a dict
+    with "state" ("done", "stopped" or "error") and, on error, "error".
+    """
+    def run(self, option, trays=1, params=None):
+        self.sc.stop = False
+        try:
+            if trays > 1:
+                self.sc.runPipeline(option, trays=trays, params=params)
+            else:
+                self.sc.runPlanned(option, params)
+            return {"state": "done"}
+        except StopRequested:
+            # Leave the machine safe
+            self.safeRelease()
+            return {"state": "stopped"}
+        except Exception:
+            self.sc.log("\n  -- Error\n")
+            self.sc.log(traceback.format_exc())
+            self.safeRelease()
+            return {"state": "error",
+                    "error": traceback.format_exc().strip().splitlines()[-1]}
+
+    def safeRelease(self):
+        self.sc.stop = False
+        try:
+            self.sc.releaseAll()
+        except Exception:
+            self.sc.log(traceback.format_exc())
+
+    def stop(self):
+        self.sc.stop = True
+
+    def status(self):
+        metrics = self.sc.metrics
+        return {"option": self.sc.option,
+                "phase": self.sc.phase,
+                "row": self.sc.row,
+                "num_rows": self.sc.num_rows,
+                "trays": self.sc.tray_stations,
+                # Keys as in the JSON of a remote machine
+                "position": dict((str(m), p)
+                                 for m, p in self.sc.position.items()),
+                "stop": self.sc.stop,
+                "simulate": self.sc.simulate,
+                "trays_done": metrics.trays.total(),
+                "seeds": metrics.seeds.get(),
+                "trays_per_hour": metrics.trays_per_hour.get()}
+
+    def metricsText(self):
+        return self.sc.metrics.render()
+
+    def close(self):
+        self.sc.stopMotionWorker()
+
+
+class RemoteMachine():
+    """The controller of a seeder_server.py, over its socket protocol."""
+
+    def __init__(self, name, address, timeout=10.0):
+        self.name = name
+        self.address = parseAddress(address)
+        self.timeout = timeout      # Seconds to wait for a reply
+        self.conn = None            # Control connection: requests only
+        self.lock = threading.Lock()
+
+    def connect(self, timeout=None):
+        family = socket.AF_UNIX if isinstance(self.address, str) \
+                                else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.address)
+        sock.settimeout(timeout)
+        return sock, sock.makefile('rb')
+
+    @staticmethod
+    def send(sock, msg):
+        sock.sendall((json.dumps(msg) + "\n").encode("utf-8"))
+
+    @staticmethod
+    def receive(reader):
+        line = reader.readline()
+        if not line:
+            raise IOError("connection closed")
+        return json.loads(line.decode("utf-8"))
+
+    # Sends a command and returns its reply. Raises IOError if the server
+    # does not answer, or RuntimeError if it refuses the command.
+    def request(self, msg):
+        with self.lock:
+            try:
+                if self.conn is None:
+                    self.conn = self.connect(self.timeout)
+                sock, reader = self.conn
+                self.send(sock, msg)
+                reply = self.receive(reader)
+            except (IOError, OSError, ValueError):
+                self.closeConnection()
+                raise IOError("{}: no reply from {}".format(self.name,
+                                                            self.address))
+        if not reply.get("ok"):
+            raise RuntimeError(reply.get("error", "refused"))
+        return reply
+
+    def closeConnection(self):
+        if self.conn is not None:
+            sock, reader = self.conn
+            reader.close()
+            sock.close()
+            self.conn = None
+
+    """ Starts trays of an option on the server and waits for the job to
+    end. Returns a dict like LocalMachine.run().
+    """
+    def run(self, option, trays=1, params=None):
+        msg = {"cmd": "start", "option": option, "trays": trays}
+        if params:
+            msg["params"] = params
+        try:
+            # A connection of its own, subscribed to the job events
+            sock, reader = self.connect()
+        except (IOError, OSError) as e:
+            return {"state": "error", "error": "connect failed: {}".format(e)}
+        try:
+            self.send(sock, {"cmd": "subscribe"})
+            self.send(sock, msg)
+            job = None
+            while True:
+                reply = self.receive(reader)
+                if "ok" in reply:
+                    if not reply["ok"]:
+                        return {"state": "error", "error": reply["error"]}
+                    job = reply.get("job", job)
+                elif reply.get("event") == "job" and job is not None and \
+                        reply.get("job") == job and reply["state"] != "start":
+                    result = {"state": reply["state"]}
+                    if reply.get("error"):
+                        result["error"] = reply["error"]
+                    return result
+        except (IOError, OSError, ValueError) as e:
+            return {"state": "error", "error": "connection lost: {}".format(e)}
+        finally:
+            reader.close()
+            sock.close()
+
+    def stop(self):
+        try:
+            self.request({"cmd": "stop"})
+        except (IOError, RuntimeError):
+            pass
+
+    def status(self):
+        reply = self.request({"cmd": "status"})
+        for key in ("ok", "id"):
+            reply.pop(key, None)
+        # JSON object keys are strings
+        reply["trays"] = dict((int(k), v) for k, v in
+                              (reply.get("trays") or {}).items())
+        return reply
+
+    def metricsText(self):
+        return self.request({"cmd": "metrics"})["text"]
+
+    def close(self):
+        with self.lock:
+            self.closeConnection()
+
+
+class Job():
+    """Trays of one recipe, queued for a machine."""
+
+    def __init__(self, number, recipe, option, params, trays, machine=None):
+        self.number     = number
+        self.recipe     = recipe
+        self.option     = option
+        self.params     = params
+        self.trays      = trays
+        self.target     = machine   # Machine name, or None for any
+        self.machine    = None      # Machine that ran it
+        self.state      = "queued"  # running, done, stopped, error, cancelled
+        self.error      = ""
+        self.t_start    = None
+        self.t_end      = None
+
+    def summary(self):
+        return {"job": self.number, "recipe": self.recipe,
+                "trays": self.trays, "machine": self.machine or self.target,
+                "state": self.state, "error": self.error,
+                "t_start": self.t_start, "t_end": self.t_end}
+
+
+class FleetMetrics(SeederMetrics):
+    """Metrics of the fleet, and of all machines labelled by machine. Works
+    with SeederMetrics.serveHTTP() and dump().
+    """
+
+    def __init__(self, fleet):
+        SeederMetrics.__init__(self)
+        self.fleet = fleet
+        self.machine_up = Gauge("seeder_fleet_machine_up",
+                "Machine answered the last metrics request.", ("machine",))
+        self.jobs = Gauge("seeder_fleet_jobs", "Jobs per state.", ("state",))
+        # Process metrics come from the machines, not from the fleet
+        self.all_metrics = [self.machine_up, self.jobs]
+
+    def render(self):
+        fleet = self.fleet
+        families = []       # In order of the first appearance
+        lines_of = {}       # family -> header lines, then sample lines
+        for name in fleet.order:
+            try:
+                text = fleet.machines[name].metricsText()
+                self.machine_up.set(1, name)
+            except (IOError, RuntimeError):
+                self.machine_up.set(0, name)
+                continue
+            for family, line in labelSamples(text, "machine", name):
+                if family not in lines_of:
+                    families.append(family)
+                    lines_of[family] = []
+                # Every machine sends the same headers; keep the first
+                if not line.startswith("#") or line not in lines_of[family]:
+                    lines_of[family].append(line)
+        with fleet.cond:
+            self.jobs.clear()
+            for job in fleet.jobs:
+                self.jobs.set(self.jobs.get(job.state) + 1, job.state)
+        lines = [SeederMetrics.render(self).rstrip("\n")]
+        for family in families:
+            lines.extend(lines_of[family])
+        return "\n".join(lines) + "\n"
+
+
+class Fleet():
+    """Machines, shared recipes and plans, and the job queue."""
+
+    def __init__(self, plan_dir=None):
+        self.plan_dir   = plan_dir  # Plan cache shared by local machines
+        self.machines   = {}        # name -> LocalMachine or RemoteMachine
+        self.order      = []        # Machine names, in the order added
+        self.recipes    = dict(("option{}".format(o), (o, {}))
+                               for o in OPTION_PARAMS)
+        self.plans      = {}        # recipe name -> plan, see getPlan()
+        self.jobs       = []        # Every job, in the order submitted
+        self.queue      = []        # Jobs waiting for a machine
+        self.busy       = {}        # machine name -> running Job
+        self.faulted    = set()     # Machines held after an error
+        self.listeners  = []
+        self.running    = False
+        self.threads    = []
+        self.cond       = threading.Condition()
+        self.metrics    = FleetMetrics(self)
+        self.hardware   = None      # Name of the local hardware machine
+
+    """
+    ----------------------------------
+     Machines
+    ----------------------------------
+    """
+    def addMachine(self, machine):
+        if machine.name in self.machines:
+            raise ValueError("machine {} already added".format(machine.name))
+        self.machines[machine.name] = machine
+        self.order.append(machine.name)
+        if self.running:
+            self.startWorker(machine)
+        return machine
+
+    def addLocal(self, name, simulate=False, sc=None):
+        if sc is None and not simulate and self.hardware is not None:
+            raise ValueError("machine {} already uses this host's "
+                             "hardware".format(self.hardware))
+        machine = self.addMachine(LocalMachine(name, sc=sc,
+                                               simulate=simulate))
+        if not machine.sc.simulate:
+            self.hardware = name
+        if self.plan_dir and machine.sc.plan_cache is None:
+            machine.sc.openPlanCache(self.plan_dir)
+        return machine
+
+    def addRemote(self, name, address, timeout=10.0):
+        return self.addMachine(RemoteMachine(name, address, timeout))
+
+    # Lets a machine take jobs again after an error
+    def clearFault(self, name):
+        with self.cond:
+            self.faulted.discard(name)
+            self.cond.notify_all()
+
+    """
+    ----------------------------------
+     Recipes and plans
+    ----------------------------------
+    """
+    def addRecipe(self, name, option, params=None):
+        from seeder_cli import checkRecipe
+        params = dict(params or {})
+        checkRecipe(option, params)
+        self.recipes[name] = (option, params)
+        self.plans.pop(name, None)
+
+    # Loads a recipe file (see seeder_cli.py); option is used if the file
+    # does not give one
+    def loadRecipe(self, name, fn, option=None):
+        from seeder_cli import readRecipe
+        recipe_option, params = readRecipe(fn)
+        self.addRecipe(name, recipe_option or option or 1, params)
+
+    """ Returns the plan of a recipe, computed on first use: its option,
+    parameters and predicted cycle time in seconds.
+    """
+    def getPlan(self, name):
+        plan = self.plans.get(name)
+        if plan is None:
+            from seeder_sweep import TimingController, evaluate
+            option, params = self.recipes[name]
+            # A controller per call; evaluate() may run on several threads
+            cycle = evaluate(option, params, sc=TimingController())["time"]
+            plan = {"option": option, "params": params, "cycle": cycle}
+            self.plans[name] = plan
+        return plan
+
+    """
+    ----------------------------------
+     Jobs
+    ----------------------------------
+    """
+    def addListener(self, callback):
+        self.listeners.append(callback)
+
+    def emit(self, job):
+        event = job.summary()
+        event["event"] = "job"
+        event["time"] = time()
+        for callback in list(self.listeners):
+            try:
+                callback(event)
+            except Exception:
+                pass
+
+    """ Queues trays of a recipe. With batch, the trays are queued as jobs
+    of at most batch trays each, so several machines can share them. With
+    machine, only that machine runs them. Returns the list of jobs.
+    """
+    def submit(self, recipe, trays=1, machine=None, batch=None):
+        if recipe not in self.recipes:
+            raise ValueError("unknown recipe {}".format(recipe))
+        if machine is not None and machine not in self.machines:
+            raise ValueError("unknown machine {}".format(machine))
+        option, params = self.recipes[recipe]
+        self.getPlan(recipe)
+        jobs = []
+        with self.cond:
+            left = trays
+            while left > 0:
+                count = min(left, batch or left)
+                job = Job(len(self.jobs) + 1, recipe, option, params,
+                          count, machine)
+                self.jobs.append(job)
+                self.queue.append(job)
+                jobs.append(job)
+                left -= count
+            self.cond.notify_all()
+        for job in jobs:
+            self.emit(job)
+        return jobs
+
+    # First queued job the machine may run. Call with the lock held.
+    def nextJob(self, name):
+        if name in self.faulted:
+            return None
+        for job in self.queue:
+            if job.target is None or job.target == name:
+                return job
+        return None
+
+    def start(self):
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        for name in self.order:
+            self.startWorker(self.machines[name])
+
+    def startWorker(self, machine):
+        th = threading.Thread(target=self.work, args=(machine,))
+        th.daemon = True
+        th.start()
+        self.threads.append(th)
+
+    # Worker thread of one machine
+    def work(self, machine):
+        while True:
+            with self.cond:
+                job = self.nextJob(machine.name)
+                while job is None and self.running:
+                    self.cond.wait()
+                    job = self.nextJob(machine.name)
+                if not self.running:
+                    return
+                self.queue.remove(job)
+                self.busy[machine.name] = job
+                job.machine = machine.name
+                job.state = "running"
+                job.t_start = time()
+            self.emit(job)
+            result = machine.run(job.option, job.trays, job.params or None)
+            with self.cond:
+                job.state = result["state"]
+                job.error = result.get("error", "")
+                job.t_end = time()
+                del self.busy[machine.name]
+                if job.state == "error":
+                    self.faulted.add(machine.name)
+                self.cond.notify_all()
+            self.emit(job)
+
+    """ Waits until no job is queued or running (or the timeout passes).
+    Jobs that only a faulted machine may run are not waited for. Returns
+    True if the fleet is idle.
+    """
+    def wait(self, timeout=None):
+        end = None if timeout is None else time() + timeout
+        with self.cond:
+            while self.busy or any(self.runnable(job) for job in self.queue):
+                left = None if end is None else end - time()
+                if left is not None and left <= 0:
+                    return False
+                self.cond.wait(left if left is not None else 1.0)
+        return True
+
+    # Call with the lock held
+    def runnable(self, job):
+        names = [job.target] if job.target else self.order
+        return any(name not in self.faulted for name in names)
+
+    """ Stops the running jobs. With cancel, the queued jobs are dropped. """
+    def stopAll(self, cancel=True):
+        with self.cond:
+            if cancel:
+                cancelled = self.queue
+                self.queue = []
+                for job in cancelled:
+                    job.state = "cancelled"
+            else:
+                cancelled = []
+            names = list(self.busy)
+            self.cond.notify_all()
+        for job in cancelled:
+            self.emit(job)
+        for name in names:
+            self.machines[name].stop()
+
+    def close(self):
+        self.stopAll()
+        with self.cond:
+            self.running = False
+            self.cond.notify_all()
+        for th in self.threads:
+            th.join(5.0)
+        for name in self.order:
+            self.machines[name].close()
+        self.metrics.stopHTTP()
+
+    """
+    ----------------------------------
+     Status and metrics
+    ----------------------------------
+    """
+    """ Status of every machine and of the queue. A machine that does not
+    answer has "up": False.
+    """
+    def status(self):
+        with self.cond:
+            busy = dict((name, job.number) for name, job in self.busy.items())
+            queued = [job.summary() for job in self.queue]
+            faulted = sorted(self.faulted)
+            counts = {}
+            for job in self.jobs:
+                counts[job.state] = counts.get(job.state, 0) + 1
+            queue_seconds = sum(self.plans[job.recipe]["cycle"] * job.trays
+                                for job in self.queue)
+        machines = {}
+        totals = {"trays_done": 0, "seeds": 0, "trays_per_hour": 0.0}
+        for name in self.order:
+            try:
+                status = self.machines[name].status()
+                status["up"] = True
+            except (IOError, RuntimeError) as e:
+                status = {"up": False, "error": str(e)}
+            status["job"] = busy.get(name)
+            status["faulted"] = name in faulted
+            for key in totals:
+                totals[key] += status.get(key) or 0
+            machines[name] = status
+        # Predicted time to clear the queue on the machines that can run it
+        available = len([n for n in self.order if n not in faulted]) or 1
+        totals["queue_seconds"] = queue_seconds / available
+        return {"machines": machines, "jobs": counts, "queued": queued,
+                "totals": totals}
+
+    # Metrics of every machine in the Prometheus text format, labelled by
+    # machine, with one HELP / TYPE header per metric
+    def renderMetrics(self):
+        return self.metrics.render()
+
+
+"""
+----------------------------------
+ Command line
+----------------------------------
+"""
+def main(argv=None):
+    import argparse
+    import signal
+    parser = argparse.ArgumentParser(description="Seeder fleet coordinator")
+    parser.add_argument("--local", action="append", default=[],
+                        help="Name of a machine run in this process")
+    parser.add_argument("--remote", action="append", default=[],
+                        help="name=unix:/path or name=host:port of a "
+                             "seeder_server.py")
+    parser.add_argument("--simulate", action="store_true",
+                        help="Simulate the local machines")
+    parser.add_argument("--recipe", action="append", default=[],
+                        help="name=file.json (see seeder_cli.py)")
+    parser.add_argument("--run", action="append", default=[],
+                        help="recipe:trays or recipe:trays@machine; "
+                             "recipes option1-option5 are built in")
+    parser.add_argument("--plan-cache",
+                        help="Motion plan cache directory of local machines")
+    parser.add_argument("--batch", type=int,
+                        help="Split each run into jobs of this many trays")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="Serve the fleet's metrics on this HTTP port")
+    parser.add_argument("--metrics-file",
+                        help="Write the fleet's metrics here at the end")
+    args = parser.parse_args(argv)
+
+    fleet = Fleet(plan_dir=args.plan_cache)
+    try:
+        for name in args.local:
+            fleet.addLocal(name, simulate=args.simulate)
+        for item in args.remote:
+            name, address = item.split("=", 1)
+            fleet.addRemote(name, address)
+        for item in args.recipe:
+            name, fn = item.split("=", 1)
+            fleet.loadRecipe(name, fn)
+        if not fleet.order:
+            raise ValueError("no machines given")
+        for item in args.run:
+            machine = None
+            if "@" in item:
+                item, machine = item.split("@", 1)
+            recipe, trays = item.rsplit(":", 1) if ":" in item else (item, 1)
+            fleet.submit(recipe, int(trays), machine=machine,
+                         batch=args.batch)
+    except (IOError, ValueError) as e:
+        print("seeder_fleet: {}".format(e))
+        return 3
+
+    def report(event):
+        print("job {job} {recipe} x{trays} on {machine}: {state}{0}".format(
+                " ({})".format(event["error"]) if event["error"] else "",
+                **event))
+    fleet.addListener(report)
+
+    def requestStop(signum, frame):
+        print("Signal {} received, stopping".format(signum))
+        fleet.stopAll()
+    signal.signal(signal.SIGTERM, requestStop)
+    signal.signal(signal.SIGINT, requestStop)
+
+    if args.metrics_port:
+        fleet.metrics.serveHTTP(args.metrics_port)
+    t0 = time()
+    fleet.start()
+    while not fleet.wait(timeout=1.0):
+        pass
+    elapsed = time() - t0
+
+    status = fleet.status()
+    if args.metrics_file:
+        fleet.metrics.dump(args.metrics_file)
+    fleet.close()
+    for name in fleet.order:
+        trays = sum(job.trays for job in fleet.jobs
+                    if job.machine == name and job.state == "done")
+        print("{}: {} tray(s) done".format(name, trays))
+    done = sum(job.trays for job in fleet.jobs if job.state == "done")
+    print("{} tray(s) in {:.1f} s".format(done, elapsed))
+    counts = status["jobs"]
+    if counts.get("error"):
+        return 1
+    if counts.get("stopped") or counts.get("cancelled") or \
+            counts.get("queued"):
+        return 2
+    return 0
+
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main())
@@ -0,0 +1,143 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Append-only journal of completed process phases and rows.
+
+The SeederController writes one short line per completed phase or row,
+with the relay states and motor positions at that point. After a stop or
+fault, SeederController.resume() reads the journal back, restores the
+machine state and skips straight to the first unfinished phase or row.
+
+Lines are written straight to the OS, so a crash of the program loses
+nothing. fsync is only done every batch_size records (and at the end or
+stop of a run), so a power cut can lose at most the last batch, which is
+then simply redone.
+
+Written for Python 2.7 and 3. Four spaces per indentation.
+
+Line format (JSON):
+    {"p": "begin", "o": 2, "n": 12, "t": ...}     Start of a process loop,
+                                                    with "pr": {...} if the
+                                                    option's parameters were
+                                                    overridden, and
+                                                    "nr": 1 if the loop
+                                                    cannot be resumed
+    {"p": "seedRow", "r": 3, "rl": "10000110", "pos": [..], "t": ...}
+    {"p": "end", "t": ...}                          Process loop finished
+"""
+
+from time import time
+import json
+import os
+
+
+class RunJournal():
+    """Journal file for one controller."""
+
+    def __init__(self, fn="seeder_journal.txt", batch_size=8):
+        self.fn         = fn
+        self.batch_size = batch_size
+        self.fd         = None
+        self.unsynced   = 0
+
+    def open(self, truncate=False):
+        self.close()
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND
+        if truncate:
+            flags |= os.O_TRUNC
+        self.fd = os.open(self.fn, flags, 0o644)
+
+    def close(self):
+        if self.fd is not None:
+            self.sync()
+            os.close(self.fd)
+            self.fd = None
+
+    def sync(self):
+        if self.fd is not None and self.unsynced:
+            os.fsync(self.fd)
+            self.unsynced = 0
+
+    def write(self, record, sync=False):
+        if self.fd is None:
+            self.open()
+        record["t"] = round(time(), 3)
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        os.write(self.fd, line.encode("utf-8"))
+        self.unsynced += 1
+        if sync or self.unsynced >= self.batch_size:
+            self.sync()
+
+    """
+    ----------------------------------
+     Records
+    ----------------------------------
+    """
+    def begin(self, option, num_rows, params=None, resumable=True):
+        self.open(truncate=True)
+        record = {"p": "begin", "o": option, "n": num_rows}
+        if params:
+            record["pr"] = params
+        if not resumable:
+            record["nr"] = 1
+        self.write(record, sync=True)
+
+    def resumed(self):
+        self.write({"p": "resume"}, sync=True)
+
+    def checkpoint(self, phase, row, relays, positions):
+        self.write({"p": phase, "r": row, "rl": relays, "pos": positions})
+
+    def end(self):
+        self.write({"p": "end"}, sync=True)
+
+    """ Reads the journal back.
+
+    Returns None if there is nothing to resume, otherwise a dict with the
+    option, num_rows, parameter overrides, set of completed (phase, row)
+    pairs and the relay and position state of the last checkpoint.
+    """
+    def load(self):
+        try:
+            fh = open(self.fn, 'r')
+            lines = fh.readlines()
+            fh.close()
+        except IOError:
+            return None
+
+        run = None
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break   # Partly written last line
+            phase = record.get("p")
+            if phase == "begin" and record.get("nr"):
+                run = None      # A run that cannot be resumed
+            elif phase == "begin":
+                run = {"option": record["o"], "num_rows": record["n"],
+                       "params": record.get("pr"), "done": set(),
+                       "relays": None, "positions": None}
+            elif run is None or phase == "resume":
+                continue
+            elif phase == "end":
+                run = None
+            else:
+                run["done"].add((phase, record.get("r", 0)))
+                run["relays"] = record.get("rl")
+                run["positions"] = record.get("pos")
+        return run
+
+
+class NullJournal(RunJournal):
+    """Run journal that keeps nothing, for simulated runs (sweeps, captured
+    plans). Sweep processes must not share a journal file.
+    """
+
+    def open(self, truncate=False):
+        pass
+
+    def write(self, record, sync=False):
+        pass
+
+    def load(self):
+        return None
@@ -0,0 +1,306 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Throughput counters and latency histograms for the seeding machine.
+
+The SeederController keeps one SeederMetrics object and updates it from
+runStepper, setRelay and the process phases. The values can be read in the
+Prometheus text format over HTTP, or dumped to a file.
+
+Several threads update the same series (the parallel fillTray and
+cleanTray moves both set relays and phases), and the HTTP thread renders
+while they do, so each metric has a lock held for the update or for
+copying its values. Histograms use fixed buckets, so an observation is a
+bisect and an increment.
+
+Written for Python 2.7 and 3. Four spaces per indentation.
+"""
+
+from bisect import bisect_left
+from time import time
+import os
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+def formatLabels(labelnames, key):
+    if not labelnames:
+        return ""
+    pairs = ['{}="{}"'.format(n, v) for n, v in zip(labelnames, key)]
+    return "{" + ",".join(pairs) + "}"
+
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter():
+    """Monotonic counter, optionally split by labels."""
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name       = name
+        self.help_text  = help_text
+        self.labelnames = tuple(labelnames)
+        self.values     = {}
+        self.lock       = threading.Lock()
+
+    def inc(self, amount=1, *labels):
+        key = tuple(str(l) for l in labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(tuple(str(l) for l in labels), 0)
+
+    # Sum over all label values
+    def total(self):
+        with self.lock:
+            return sum(self.values.values())
+
+    def clear(self):
+        with self.lock:
+            self.values = {}
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        lines = []
+        for key, value in items:
+            lines.append("{}{} {}".format(self.name,
+                    formatLabels(self.labelnames, key), formatValue(value)))
+        return lines
+
+
+class Gauge(Counter):
+    """Value that can go up and down."""
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        key = tuple(str(l) for l in labels)
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram():
+    """Fixed-bucket histogram, optionally split by labels."""
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets, labelnames=()):
+        self.name       = name
+        self.help_text  = help_text
+        self.buckets    = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        self.series     = {}    # key -> [bucket counts..., +Inf count]
+        self.sums       = {}
+        self.lock       = threading.Lock()
+
+    def observe(self, value, *labels):
+        key = tuple(str(l) for l in labels)
+        n = bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.series.get(key)
+            if counts is None:
+                counts = [0] * (len(self.buckets) + 1)
+                self.series[key] = counts
+                self.sums[key] = 0.0
+            counts[n] += 1
+            self.sums[key] += value
+
+    def count(self, *labels):
+        with self.lock:
+            return sum(self.series.get(tuple(str(l) for l in labels), ()))
+
+    def render(self):
+        with self.lock:
+            items = sorted((key, list(counts), self.sums[key])
+                           for key, counts in self.series.items())
+        lines = []
+        names = self.labelnames + ("le",)
+        for key, counts, value_sum in items:
+            total = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                total += n
+                lines.append("{}_bucket{} {}".format(self.name,
+                        formatLabels(names, key + (formatValue(bound),)),
+                        total))
+            labels = formatLabels(self.labelnames, key)
+            lines.append("{}_sum{} {}".format(self.name, labels,
+                                             repr(value_sum)))
+            lines.append("{}_count{} {}".format(self.name, labels, total))
+        return lines
+
+
+class SeederMetrics():
+    """Metric set kept by the SeederController."""
+
+    PHASE_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250)
+    CYCLE_BUCKETS = (60, 120, 180, 240, 300, 450, 600, 900, 1200, 1800)
+
+    def __init__(self):
+        self.steps = Counter("seeder_motor_steps_total",
+                "Steps issued per motor.", ("motor",))
+        self.moves = Counter("seeder_motor_moves_total",
+                "Moves started per motor.", ("motor",))
+        self.relays = Counter("seeder_relay_actuations_total",
+                "Relay commands per relay and state.", ("relay", "state"))
+        self.phases = Histogram("seeder_phase_seconds",
+                "Duration of each process phase.", self.PHASE_BUCKETS,
+                ("phase",))
+        self.trays = Counter("seeder_trays_total",
+                "Trays completed per option.", ("option",))
+        self.cycles = Histogram("seeder_tray_cycle_seconds",
+                "Time from start to end of a process loop.",
+                self.CYCLE_BUCKETS)
+        self.trays_per_hour = Gauge("seeder_trays_per_hour",
+                "Rate implied by the last completed tray.")
+        self.seeds = Counter("seeder_seeds_placed_total",
+                "Seeds released into the tray.")
+        self.stops = Counter("seeder_stops_total",
+                "Process loops ended by the stop signal.")
+        self.gpio_saved = Counter("seeder_gpio_writes_saved_total",
+                "GPIO writes skipped because the pin already had the level.")
+        self.gpio_mismatches = Counter("seeder_gpio_shadow_mismatches_total",
+                "Output pins found at a level other than the one written.",
+                ("pin",))
+        self.deadline_misses = Counter("seeder_step_deadline_misses_total",
+                "Step edges sent later than the tolerance, per motor.",
+                ("motor",))
+        self.backoffs = Counter("seeder_speed_backoffs_total",
+                "Moves slowed down after missed step deadlines, per motor.",
+                ("motor",))
+        self.all_metrics = [self.steps, self.moves, self.relays,
+                self.phases, self.trays, self.cycles, self.trays_per_hour,
+                self.seeds, self.stops, self.gpio_saved, self.gpio_mismatches,
+                self.deadline_misses, self.backoffs]
+        self.phase      = ""
+        self.phase_t0   = 0.0
+        self.cycle_t0   = 0.0
+        self.running    = False     # A process loop is under way
+        self.lock       = threading.Lock()
+        self.http       = None
+
+    """
+    ----------------------------------
+     Update hooks (called by the controller)
+    ----------------------------------
+    """
+    def stepsIssued(self, motor_id, steps):
+        self.moves.inc(1, motor_id)
+        self.steps.inc(steps, motor_id)
+
+    def relaySet(self, relay, state):
+        self.relays.inc(1, relay, state)
+
+    # Closes the timing of the previous phase and starts the next one
+    def phaseChanged(self, phase, now=None):
+        now = time() if now is None else now
+        with self.lock:
+            if self.phase:
+                self.phases.observe(now - self.phase_t0, self.phase)
+            self.phase = phase
+            self.phase_t0 = now
+
+    def processStarted(self, now=None):
+        self.cycle_t0 = time() if now is None else now
+        self.running = True
+
+    def processFinished(self, option, now=None):
+        now = time() if now is None else now
+        self.running = False
+        self.phaseChanged("", now)
+        cycle = now - self.cycle_t0
+        self.trays.inc(1, option)
+        self.cycles.observe(cycle)
+        if cycle > 0:
+            self.trays_per_hour.set(3600.0 / cycle)
+
+    def seedPlaced(self):
+        self.seeds.inc()
+
+    def deadlinesMissed(self, motor_id, misses):
+        if misses:
+            self.deadline_misses.inc(misses, motor_id)
+
+    def speedBackedOff(self, motor_id):
+        self.backoffs.inc(1, motor_id)
+
+    def gpioWriteSaved(self):
+        self.gpio_saved.inc()
+
+    def gpioMismatch(self, pin):
+        self.gpio_mismatches.inc(1, pin)
+
+    # Every motor thread raises on the stop signal; count it once per
+    # process loop, also when no phase is set (releaseAll, settle_start)
+    def processStopped(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+        if self.phase:
+            self.phaseChanged("")
+        self.stops.inc()
+
+    """
+    ----------------------------------
+     Export
+    ----------------------------------
+    """
+    def render(self):
+        lines = []
+        for m in self.all_metrics:
+            lines.append("# HELP {} {}".format(m.name, m.help_text))
+            lines.append("# TYPE {} {}".format(m.name, m.kind))
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+    # Writes the metrics to a file. The rename keeps readers from seeing
+    # a half written file.
+    def dump(self, fn):
+        tmp_fn = fn + ".tmp"
+        fh = open(tmp_fn, 'w')
+        fh.write(self.render())
+        fh.close()
+        os.rename(tmp_fn, fn)
+
+    """ Serves the metrics at http://<host>:<port>/metrics from a daemon
+    thread. Returns the HTTP server object.
+
+    >>> sc.metrics.serveHTTP(9100)
+    """
+    def serveHTTP(self, port=9100, host=""):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type",
+                                 "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass    # Keep scrapes out of the console
+
+        self.http = HTTPServer((host, port), Handler)
+        th = threading.Thread(target=self.http.serve_forever)
+        th.daemon = True
+        th.start()
+        return self.http
+
+    def stopHTTP(self):
+        if self.http:
+            self.http.shutdown()
+            self.http.server_close()
+            self.http = None
@@ -0,0 +1,350 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Real-time motion worker for the GPIO stepper motors.
+
+Step timing in SeederController.runGPIO_Stepper shares the GIL with the Tk
+main loop, the logger and the other motor threads, so any of them can
+stretch a pulse. The MotionWorker moves pulse generation into a child
+process that can be pinned to a CPU and given real-time priority. It has no
+other work to do.
+
+The parent posts move commands into a single-producer/single-consumer ring
+in shared memory and the child posts results into a completion table, also
+in shared memory. Neither side takes a lock across the process boundary.
+Each index or slot has one writer, and the writer fills a slot before it
+publishes the index or id. The child also keeps live motor positions and
+per-motor abort flags in the same block. The child runs all active moves
+from one loop, always serving the motor with the earliest pending edge,
+so moves on different motors still overlap.
+
+The controller API does not change:
+
+    >>> sc.startMotionWorker(cpu=3, rt_priority=50)
+    >>> sc.runStepper(1, steps=2000, speed=60)   # Pulsed by the worker
+    >>> sc.stopMotionWorker()
+
+Benchmark of pulse lateness in-thread vs. worker, under GIL load:
+
+    python3 seeder_motion.py --bench
+
+Written for Python 2.7 and 3 (CPU pinning and real-time scheduling need
+Python 3 on Linux). Four spaces per indentation.
+"""
+
+import gc
+import multiprocessing
+import os
+import struct
+import threading
+
+try:
+    from time import perf_counter as clock
+except ImportError:
+    from time import time as clock
+from time import sleep
+
+"""
+Shared memory layout
+"""
+MAX_MOTORS      = 8
+RING_SIZE       = 64            # Command slots
+TABLE_SIZE      = 64            # Completion slots (by cmd_id % TABLE_SIZE)
+
+OFF_HEAD        = 0             # u64 commands written (parent)
+OFF_TAIL        = 64            # u64 commands taken (worker)
+OFF_STATE       = 128           # u32 worker state, see STATE_*
+OFF_ABORT       = 192           # u8 per motor (parent sets, worker clears)
+OFF_POSITION    = 256           # i64 per motor (worker)
+OFF_RING        = 512
+CMD_FMT         = "<IIiiiidd"   # cmd_id, op, motor, steps, dir_code, sign,
+CMD_SIZE        = 48            #   half period (s), late tolerance (s)
+OFF_TABLE       = OFF_RING + RING_SIZE * CMD_SIZE
+DONE_FMT        = "<Iiddi"      # status, steps done, max late, mean late,
+DONE_SIZE       = 32            #   misses (cmd_id u32 in front, written last)
+SHM_SIZE        = OFF_TABLE + TABLE_SIZE * DONE_SIZE
+
+OP_MOVE         = 1
+OP_QUIT         = 2
+
+STATUS_DONE     = 0
+STATUS_ABORTED  = 1
+
+STATE_RUNNING   = 1             # Bit flags
+STATE_PINNED    = 2
+STATE_REALTIME  = 4
+
+SPIN_TIME       = 0.0002        # Busy wait this long before an edge (s)
+IDLE_SLEEP      = 0.0005        # Poll period with no active moves (s)
+
+
+def setupRealtime(cpu, rt_priority):
+    state = 0
+    if cpu is not None and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, set([cpu]))
+            state |= STATE_PINNED
+        except (OSError, ValueError):
+            pass
+    if rt_priority and hasattr(os, "sched_setscheduler"):
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO,
+                                  os.sched_param(rt_priority))
+            state |= STATE_REALTIME
+        except (OSError, ValueError):
+            pass    # Needs root or CAP_SYS_NICE
+    return state
+
+
+def motionWorkerMain(shm, dir_pins, step_pins, simulate, cpu, rt_priority):
+    """Child process entry point."""
+    buf = memoryview(shm).cast("B") if hasattr(memoryview, "cast") else shm
+    if simulate:
+        from seeder_controller import GPIO_empty
+        gpio = GPIO_empty()
+    else:
+        import RPi.GPIO as gpio
+    gpio.setmode(gpio.BCM)
+    gpio.setwarnings(False)
+    for pin in list(dir_pins) + list(step_pins):
+        gpio.setup(pin, gpio.OUT)
+    high, low = gpio.HIGH, gpio.LOW
+    output = gpio.output
+    dir_levels = {}     # motor -> direction level last written
+
+    state = STATE_RUNNING | setupRealtime(cpu, rt_priority)
+    gc.disable()    # No collector pauses between edges
+    struct.pack_into("<I", buf, OFF_STATE, state)
+
+    tail = 0
+    active = {}     # motor -> [cmd_id, steps_left, next_high, next_time,
+                    #           delay, sign, done, late_max, late_sum,
+                    #           tolerance, misses]
+    while True:
+        # Take new commands
+        head = struct.unpack_from("<Q", buf, OFF_HEAD)[0]
+        while tail < head:
+            (cmd_id, op, mtr, steps, dir_code, sign, delay,
+             tolerance) = struct.unpack_from(
+                    CMD_FMT, buf, OFF_RING + (tail % RING_SIZE) * CMD_SIZE)
+            tail += 1
+            struct.pack_into("<Q", buf, OFF_TAIL, tail)
+            if op == OP_QUIT:
+                struct.pack_into("<I", buf, OFF_STATE, 0)
+                return
+            if dir_levels.get(mtr) != dir_code:
+                output(dir_pins[mtr], dir_code)
+                dir_levels[mtr] = dir_code
+            active[mtr] = [cmd_id, steps, True, clock(), delay, sign, 0,
+                           0.0, 0.0, tolerance, 0]
+
+        if not active:
+            sleep(IDLE_SLEEP)
+            continue
+
+        # Serve the motor with the earliest edge
+        mtr = min(active, key=lambda m: active[m][3])
+        move = active[mtr]
+        wait = move[3] - clock()
+        if wait > SPIN_TIME:
+            sleep(wait - SPIN_TIME)
+            continue    # Re-check for commands and earlier edges
+        while clock() < move[3]:
+            pass
+
+        finished = move[1] <= 0
+        aborted = False
+        if move[2] and not finished and buf[OFF_ABORT + mtr]:
+            aborted = True
+        if not finished and not aborted:
+            output(step_pins[mtr], high if move[2] else low)
+            late = clock() - move[3]
+            if late > move[7]:
+                move[7] = late
+            move[8] += late
+            if move[9] and late > move[9]:
+                move[10] += 1
+            if not move[2]:
+                move[1] -= 1
+                move[6] += 1
+                off = OFF_POSITION + 8 * mtr
+                pos = struct.unpack_from("<q", buf, off)[0]
+                struct.pack_into("<q", buf, off, pos + move[5])
+            move[2] = not move[2]
+            move[3] += move[4]
+            continue
+
+        # Post the result, id last so the parent sees a complete record
+        del active[mtr]
+        buf[OFF_ABORT + mtr] = 0
+        edges = max(1, 2 * move[6])
+        off = OFF_TABLE + (move[0] % TABLE_SIZE) * DONE_SIZE
+        status = STATUS_ABORTED if aborted else STATUS_DONE
+        struct.pack_into(DONE_FMT, buf, off + 4, status, move[6], move[7],
+                         move[8] / edges, move[10])
+        struct.pack_into("<I", buf, off, move[0])
+
+
+class MotionWorker():
+    """Parent side of the motion worker."""
+
+    def __init__(self, dir_pins, step_pins, simulate=False, cpu=None,
+                                                    rt_priority=None):
+        if len(step_pins) > MAX_MOTORS:
+            raise ValueError("at most {} motors".format(MAX_MOTORS))
+        self.shm = multiprocessing.RawArray("B", SHM_SIZE)
+        self.buf = memoryview(self.shm).cast("B") \
+                if hasattr(memoryview, "cast") else self.shm
+        self.head = 0
+        self.next_id = 1
+        self.lock = threading.Lock()    # Parent threads share the producer
+        self.last_result = {}           # motor index -> last result dict
+        self.process = multiprocessing.Process(target=motionWorkerMain,
+                args=(self.shm, list(dir_pins), list(step_pins), simulate,
+                      cpu, rt_priority))
+        self.process.daemon = True
+        self.process.start()
+        for x in range(1000):
+            if self.state() & STATE_RUNNING:
+                break
+            sleep(0.005)
+        else:
+            self.process.terminate()
+            raise RuntimeError("motion worker did not start")
+
+    def state(self):
+        return struct.unpack_from("<I", self.buf, OFF_STATE)[0]
+
+    def getPosition(self, mtr_index):
+        return struct.unpack_from("<q", self.buf,
+                                  OFF_POSITION + 8 * mtr_index)[0]
+
+    def abort(self, mtr_index):
+        self.buf[OFF_ABORT + mtr_index] = 1
+
+    def post(self, op, mtr_index=0, steps=0, dir_code=0, sign=1, delay=0.0,
+                                                            tolerance=0.0):
+        with self.lock:
+            while self.head - struct.unpack_from("<Q", self.buf,
+                                                 OFF_TAIL)[0] >= RING_SIZE:
+                sleep(IDLE_SLEEP)   # Ring full
+            cmd_id = self.next_id
+            self.next_id += 1
+            struct.pack_into(CMD_FMT, self.buf,
+                    OFF_RING + (self.head % RING_SIZE) * CMD_SIZE,
+                    cmd_id, op, mtr_index, steps, dir_code, sign, delay,
+                    tolerance)
+            self.head += 1
+            struct.pack_into("<Q", self.buf, OFF_HEAD, self.head)
+        return cmd_id
+
+    """ Runs one move and waits for it. Returns the number of steps done.
+    The move is aborted before its next step once should_abort() is true.
+    Edges later than tolerance seconds are counted as misses.
+    """
+    def run(self, mtr_index, steps, dir_code, sign, delay, should_abort=None,
+                                                            tolerance=0.0):
+        self.buf[OFF_ABORT + mtr_index] = 0
+        cmd_id = self.post(OP_MOVE, mtr_index, steps, dir_code, sign, delay,
+                           tolerance)
+        off = OFF_TABLE + (cmd_id % TABLE_SIZE) * DONE_SIZE
+        while struct.unpack_from("<I", self.buf, off)[0] != cmd_id:
+            if should_abort is not None and should_abort():
+                self.abort(mtr_index)
+            if not self.process.is_alive():
+                raise RuntimeError("motion worker died")
+            sleep(IDLE_SLEEP)
+        status, done, late_max, late_mean, misses = struct.unpack_from(
+                DONE_FMT, self.buf, off + 4)
+        self.last_result[mtr_index] = {"status": status, "steps": done,
+                "late_max": late_max, "late_mean": late_mean,
+                "misses": misses}
+        return done
+
+    def close(self):
+        if self.process.is_alive():
+            self.post(OP_QUIT)
+            self.process.join(2.0)
+            if self.process.is_alive():
+                self.process.terminate()
+
+
+"""
+----------------------------------
+ Benchmark
+----------------------------------
+"""
+def bench(steps=2000, rpm=60, load_threads=2):
+    from seeder_controller import SeederController, GPIO_empty
+
+    class TimingGPIO(GPIO_empty):
+        # Records the time of every step pin edge
+        def __init__(self, pin):
+            GPIO_empty.__init__(self)
+            self.pin = pin
+            self.edges = []
+
+        def output(self, pin, level):
+            if pin == self.pin:
+                self.edges.append(clock())
+
+    def gilLoad(flag):
+        while not flag.is_set():
+            sum(i * i for i in range(20000))
+
+    sc = SeederController(simulate=True)
+    sc.verbose = False
+    sc.log = lambda *args, **kwargs: None
+    sc.motor_speed[0] = rpm
+    delay = 30.0 / (sc.steps_per_rev[0] * rpm)
+
+    flag = threading.Event()
+    load = [threading.Thread(target=gilLoad, args=(flag,))
+            for x in range(load_threads)]
+    for th in load:
+        th.start()
+    try:
+        # In-thread, the way runGPIO_Stepper has always run
+        sc.gpio = TimingGPIO(sc.step_pin[0])
+        sc.runStepper(1, steps=steps)
+        edges = sc.gpio.edges
+        late = [max(0.0, t - (edges[0] + k * delay))
+                for k, t in enumerate(edges)]
+        thread_max, thread_mean = max(late), sum(late) / len(late)
+
+        # Motion worker process
+        sc.startMotionWorker(cpu=(os.cpu_count() or 1) - 1
+                             if hasattr(os, "cpu_count") else None,
+                             rt_priority=50)
+        sc.runStepper(1, steps=steps)
+        result = sc.motion_worker.last_result[0]
+        worker_state = sc.motion_worker.state()
+        sc.stopMotionWorker()
+    finally:
+        flag.set()
+        for th in load:
+            th.join()
+
+    print("Pulse lateness, {} steps at {} rpm ({:.0f} us half period),"
+          " {} GIL load threads".format(steps, rpm, delay * 1e6, load_threads))
+    print("  in-thread : max {:8.1f} us  mean {:8.1f} us".format(
+          thread_max * 1e6, thread_mean * 1e6))
+    print("  worker    : max {:8.1f} us  mean {:8.1f} us  (pinned={}, "
+          "realtime={})".format(result["late_max"] * 1e6,
+          result["late_mean"] * 1e6, bool(worker_state & STATE_PINNED),
+          bool(worker_state & STATE_REALTIME)))
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Seeder motion worker")
+    parser.add_argument("--bench", action="store_true",
+                        help="Compare pulse jitter in-thread vs. worker")
+    parser.add_argument("--steps", type=int, default=2000)
+    parser.add_argument("--rpm", type=int, default=60)
+    parser.add_argument("--load", type=int, default=2,
+                        help="Number of GIL-bound load threads")
+    args = parser.parse_args()
+    if args.bench:
+        bench(args.steps, args.rpm, args.load)
+    else:
+        parser.print_help()
@@ -0,0 +1,516 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Several trays in flight on the conveyor at once.
+
+runOptionN() takes one tray from fillTray to returnToZero before the next
+tray can start, although the conveyor (motor 1) holds more than one tray.
+A TrayPipeline loads the next tray onto the fill station as soon as the
+tray ahead of it has moved tray_pitch steps on and made its last reverse
+move (the short one in setTray), so filling and cleaning of tray N+1
+overlap with dibbling and seeding of tray N. tray_pitch is at least the
+tray length, the conveyor travel from a tray's first row to its last plus
+one row, so trays never overlap.
+
+Each tray runs the command sequence of its option, captured once on a
+simulated controller (CaptureController). The sequence is split into
+stationary work at a conveyor position (relays, hopper, brush, seedhead,
+settle times) and conveyor moves to the next position. All trays share the
+conveyor, so conveyor moves are arbitrated:
+
+  * Stationary work runs first, oldest tray first, while the conveyor
+    stands still.
+  * The conveyor then runs the shortest move any tray asks for, and
+    every other tray moving the same way covers that distance of its
+    own move. Its speed is the slowest any of those trays asks for.
+  * While a tray is being filled (fillTray, hopper relays closed), the
+    conveyor only runs its fill moves. Trays moving the same way ride
+    along and pick where the fill pauses; a move the other way waits
+    until the fill is over.
+  * Moves that run alongside a conveyor move (the hopper while filling,
+    the brush while cleaning) are split in proportion to the distance.
+  * A tray carried the other way by another tray's move just has
+    further to go to its next position.
+  * When a tray is finished, the relays it was the last to close are
+    opened, as releaseAll() does at the end of a single tray.
+
+The controller tracks which tray is at which station in tray_stations and
+emits a "tray" event when a tray moves on to the next station.
+
+With a plan cache (see seeder_plans.py), the sequence is loaded from it
+instead of being captured.
+
+Pipelined runs are not journaled row by row, and their journal is marked
+so that resume() does not continue one. Tray sensors are not used; their
+moves run their maximum distance.
+
+Written for Python 2.7 and 3. Four spaces per indentation.
+
+>>> sc.runPipeline(2, trays=10)
+"""
+
+import os
+
+from seeder_controller import SeederController
+from seeder_journal import NullJournal
+
+"""
+Stations along the conveyor, and the phases done at each.
+"""
+STATIONS = (
+    ("fill",    ("fillTray",)),
+    ("clean",   ("cleanTray",)),
+    ("dibble",  ("setTray", "forwardDibbler", "dippleRow")),
+    ("seed",    ("advanceToSeeder", "activateVacuum", "setRow",
+                 "rotateToTray", "releaseSeed")),
+    ("exit",    ("returnToZero",)),
+)
+CONVEYOR = 1    # motor_id of the conveyor
+REST_CLOSED = (1,)  # Relays releaseAll() leaves closed
+
+
+def getStation(phase):
+    for station, phases in STATIONS:
+        if phase in phases:
+            return station
+    return None
+
+
+class CaptureController(SeederController):
+    """Simulated controller that records the commands of a process loop.
+
+    Commands are appended to ops as tuples:
+        ("relay", relay, mode)
+        ("move", motor_id, steps, direction, style, rpm)
+        ("parallel", (move, ...))       Non-blocking moves, then a wait
+        ("settle", seconds)
+        ("phase", phase, row)
+        ("release",)                    releaseAll()
+        ("releaseStepper", motor_id)
+        ("seed",)                       A seed was released
+        ("checkpoint", phase, row)      A step is complete (run journal)
+        ("mark", name, motor_id, position)  markPosition(); position None
+                                        is where the motor is
+    """
+
+    def __init__(self, config_fn="seeder_config.txt"):
+        self.ops = []
+        self.pending = []
+        self.speed_set = set()  # Motors given a speed in the option
+        self.inherited = set()  # Motors run at the speed they started with
+        SeederController.__init__(self, config_fn=config_fn, simulate=True)
+        self.journal = NullJournal()
+        self.log_fn = os.devnull
+        self.metrics.seedPlaced = lambda: self.ops.append(("seed",))
+
+    def log(self, text_str, log_only=False, mode='a'):
+        pass
+
+    def beginProcess(self, option, num_rows=None, params=None,
+                                                        resumable=True):
+        self.stop = False
+        self.option = option
+        if num_rows is not None:
+            self.num_rows = num_rows
+
+    def endProcess(self, option):
+        pass
+
+    def setPhase(self, phase, row=None):
+        self.phase = phase
+        self.row = row or 0
+        self.ops.append(("phase", phase, row))
+
+    def settle(self, seconds):
+        self.ops.append(("settle", seconds))
+
+    def setRelay(self, relay, mode="on"):
+        self.ops.append(("relay", relay, mode))
+
+    def releaseAll(self):
+        self.ops.append(("release",))
+
+    def releaseStepper(self, motor_id):
+        self.ops.append(("releaseStepper", motor_id))
+
+    def checkpoint(self, phase, row=0):
+        self.ops.append(("checkpoint", phase, row))
+
+    def markPosition(self, name, motor_id, position=None):
+        SeederController.markPosition(self, name, motor_id, position)
+        self.ops.append(("mark", name, motor_id, position))
+
+    # Captured runs are never cut short, so returnToZero keeps its fixed
+    # step count
+    def getExitSteps(self):
+        return self.conveyor_exit_steps
+
+    # Resolves speed=0 to the motor's current speed
+    def captureMove(self, motor_id, steps, direction, style, speed):
+        if speed > 0:
+            self.speed_set.add(motor_id)
+        elif motor_id not in self.speed_set:
+            self.inherited.add(motor_id)
+        self.setSpeed(motor_id, speed)
+        rpm = self.motor_speed[self.getIndex(motor_id)]
+        self.position[motor_id] += self.getDirectionSign(direction) * steps
+        return (motor_id, steps, direction, style, rpm)
+
+    def runStepper(self, motor_id, steps=0, direction="Forward",
+                                            style="Double",
+                                            speed=0):
+        if steps == 0:
+            return 0
+        self.ops.append(("move",) + self.captureMove(motor_id, steps,
+                                                direction, style, speed))
+        return steps
+
+    def runStepperUntil(self, motor_id, input_pin, edge="rising",
+                                            max_steps=0,
+                                            direction="Forward",
+                                            style="Double",
+                                            speed=0):
+        return self.runStepper(motor_id, steps=max_steps,
+                               direction=direction, style=style, speed=speed)
+
+    def startStepperNoBlock(self, motor_id, steps=0, direction="Forward",
+                                            style="Double",
+                                            speed=0):
+        if steps:
+            self.pending.append(self.captureMove(motor_id, steps, direction,
+                                                 style, speed))
+
+    def waitForMotors(self):
+        if self.pending:
+            self.ops.append(("parallel", tuple(self.pending)))
+        self.pending = []
+
+
+""" Records the commands of an option on a CaptureController.
+
+>>> captureOption(2)[:4]
+[('release',), ('settle', 10.0), ('phase', 'fillTray', None),
+ ('relay', 8, 'Close')]
+"""
+def captureOption(option, params=None, capture=None):
+    if capture is None:
+        capture = CaptureController()
+    capture.ops = []
+    capture.position = dict((m, 0) for m in capture.motor_id)
+    capture.named_positions = {}
+    capture.speed_set = set()
+    capture.inherited = set()
+    getattr(capture, "runOption{}".format(option))(params)
+    return capture.ops
+
+
+""" Returns the conveyor travel of one tray of an option, from where it
+is marked as "tray_start" to the end of its last move.
+"""
+def trayTravel(option, params=None):
+    x = None
+    for op in captureOption(option, params):
+        if op[0] == "mark" and op[1:3] == ("tray_start", CONVEYOR):
+            x = 0
+        elif x is not None and op[0] in ("move", "parallel"):
+            moves = [op[1:]] if op[0] == "move" else op[1]
+            for motor_id, steps, direction, style, rpm in moves:
+                if motor_id == CONVEYOR:
+                    x += -steps if "rev" in direction.lower() else steps
+    return x
+
+
+""" Runs one captured command on a controller. """
+def runOp(sc, op):
+    kind = op[0]
+    if kind == "relay":
+        sc.setRelay(op[1], mode=op[2])
+    elif kind == "move":
+        motor_id, steps, direction, style, rpm = op[1:]
+        sc.runStepper(motor_id, steps=steps, direction=direction,
+                      style=style, speed=rpm)
+    elif kind == "parallel":
+        for motor_id, steps, direction, style, rpm in op[1]:
+            sc.startStepperNoBlock(motor_id, steps=steps,
+                    direction=direction, style=style, speed=rpm)
+        sc.waitForMotors()
+    elif kind == "settle":
+        sc.settle(op[1])
+    elif kind == "phase":
+        sc.setPhase(op[1], op[2])
+    elif kind == "release":
+        sc.releaseAll()
+    elif kind == "releaseStepper":
+        sc.releaseStepper(op[1])
+    elif kind == "seed":
+        sc.metrics.seedPlaced()
+    elif kind == "checkpoint":
+        sc.checkpoint(op[1], op[2])
+    elif kind == "mark":
+        sc.markPosition(op[1], op[2], position=op[3])
+
+
+""" Splits captured commands into the prologue run once before the first
+tray, the program of one tray and the epilogue run once after the last.
+
+Program entries are ("work", op) for stationary work and
+("convey", target, rpm, companions) for conveyor moves, where target is
+the conveyor position relative to where the tray was loaded and
+companions are the moves that run alongside.
+"""
+def buildProgram(ops):
+    first = 0
+    while first < len(ops) and ops[first][0] in ("release", "settle"):
+        first += 1
+    last = len(ops)
+    while last > first and ops[last-1][0] == "release":
+        last -= 1
+
+    program = []
+    x = 0
+    for op in ops[first:last]:
+        moves = None
+        if op[0] == "move" and op[1] == CONVEYOR:
+            moves = [op[1:]]
+        elif op[0] == "parallel" and CONVEYOR in [m[0] for m in op[1]]:
+            moves = list(op[1])
+        if moves is None:
+            program.append(("work", op))
+            continue
+        conveyor = [m for m in moves if m[0] == CONVEYOR][0]
+        motor_id, steps, direction, style, rpm = conveyor
+        sign = -1 if "rev" in direction.lower() else 1
+        x += sign * steps
+        companions = [m for m in moves if m is not conveyor]
+        program.append(("convey", x, rpm, companions))
+    return ops[:first], program, ops[last:]
+
+
+class Tray():
+    """One tray in the pipeline."""
+
+    def __init__(self, number, program):
+        self.number     = number
+        self.program    = program
+        self.cursor     = 0         # Next program entry
+        self.x          = 0         # Conveyor travel since loading
+        self.station    = None
+        self.phase      = None
+        self.companions = None      # Companion steps left of this move
+
+    def done(self):
+        return self.cursor >= len(self.program)
+
+    def entry(self):
+        return self.program[self.cursor]
+
+    # Steps the conveyor still has to run for the current move
+    def delta(self):
+        return self.entry()[1] - self.x
+
+
+class TrayPipeline():
+    """Runs a number of trays of one option with several in flight."""
+
+    def __init__(self, sc, option, params=None, trays=2, max_in_flight=2,
+                                                        tray_pitch=None):
+        self.sc             = sc
+        self.option         = option
+        self.params         = params
+        self.num_rows       = sc.getOptionParams(option, params)["num_rows"]
+        self.trays          = trays
+        self.max_in_flight  = max_in_flight
+        if sc.plan_cache is not None:
+            ops = sc.plan_cache.load(sc, option, params).ops()
+        else:
+            ops = captureOption(option, params)
+        # Trays are not journaled or position tracked one by one
+        ops = [op for op in ops if op[0] not in ("checkpoint", "mark")]
+        self.prologue, self.program, self.epilogue = buildProgram(ops)
+        self.tray_length    = self.trayLength()
+        self.load_cursor    = self.lastReverse()
+        if tray_pitch is None:
+            # Load the next tray once this one is through cleaning
+            tray_pitch = max(self.stationStart("dibble"), self.tray_length)
+        if tray_pitch < self.tray_length:
+            raise ValueError("tray_pitch {} is less than the tray length "
+                             "{}".format(tray_pitch, self.tray_length))
+        self.tray_pitch     = tray_pitch
+        self.active         = []        # Trays in flight, oldest first
+        self.relay_owner    = {}        # relay -> tray that closed it
+        self.loaded         = 0
+        self.finished       = 0
+
+    # Conveyor travel of a tray when it starts work at a station
+    def stationStart(self, station):
+        x = 0
+        for entry in self.program:
+            if entry[0] == "convey":
+                x = entry[1]
+            elif entry[1][0] == "phase" and getStation(entry[1][1]) == station:
+                return x
+        return x
+
+    """ Returns the conveyor travel a tray takes up: the distance from its
+    first to its last row, plus one row pitch.
+    """
+    def trayLength(self):
+        length = 0
+        for phase in ("dippleRow", "setRow"):
+            rows = []
+            x = 0
+            for entry in self.program:
+                if entry[0] == "convey":
+                    x = entry[1]
+                elif entry[1][0] == "phase" and entry[1][1] == phase:
+                    rows.append(x)
+            if len(rows) > 1:
+                span = rows[-1] - rows[0]
+                length = max(length, span + span // (len(rows) - 1))
+        return length
+
+    # Program entry after the tray's last reverse conveyor move
+    def lastReverse(self):
+        x = 0
+        last = 0
+        for n, entry in enumerate(self.program):
+            if entry[0] == "convey":
+                if entry[1] < x:
+                    last = n + 1
+                x = entry[1]
+        return last
+
+    def run(self):
+        sc = self.sc
+        sc.beginProcess(self.option, num_rows=self.num_rows,
+                        params=self.params, resumable=False)
+        sc.tray_stations = {}
+        for op in self.prologue:
+            self.doWork(None, op)
+
+        while self.finished < self.trays:
+            sc.checkStop()
+            newest = self.active[-1] if self.active else None
+            if (self.loaded < self.trays
+                    and len(self.active) < self.max_in_flight
+                    and (newest is None or newest.done()
+                         or (newest.x >= self.tray_pitch
+                             and newest.cursor >= self.load_cursor))):
+                self.loadTray()
+            for tray in list(self.active):
+                self.runWork(tray)
+            for tray in [t for t in self.active if t.done()]:
+                self.unloadTray(tray)
+            if self.active:
+                self.advance()
+
+        for op in self.epilogue:
+            self.doWork(None, op)
+        sc.endProcess(self.option)
+
+    def loadTray(self):
+        self.loaded += 1
+        tray = Tray(self.loaded, self.program)
+        self.active.append(tray)
+        self.sc.log("\nLoad tray {}".format(tray.number))
+
+    def unloadTray(self, tray):
+        self.active.remove(tray)
+        self.finished += 1
+        self.sc.tray_stations.pop(tray.number, None)
+        # The machine is left as releaseAll() would leave it for this
+        # tray, without touching relays a later tray has closed since
+        for relay, owner in sorted(self.relay_owner.items()):
+            if owner == tray.number:
+                if relay not in REST_CLOSED:
+                    self.sc.setRelay(relay, "Open")
+                del self.relay_owner[relay]
+        self.sc.log("\nTray {} finished".format(tray.number))
+        self.sc.emit("tray", tray=tray.number, station=None)
+        # Trays per hour follow the time between finished trays. The last
+        # tray is counted by endProcess().
+        if self.finished < self.trays:
+            self.sc.metrics.processFinished(self.option)
+            self.sc.metrics.processStarted()
+
+    # Runs a tray's stationary work up to its next conveyor move
+    def runWork(self, tray):
+        while not tray.done():
+            entry = tray.entry()
+            if entry[0] == "work":
+                self.doWork(tray, entry[1])
+            elif tray.delta() != 0:
+                break
+            tray.cursor += 1
+            tray.companions = None
+
+    def doWork(self, tray, op):
+        sc = self.sc
+        kind = op[0]
+        runOp(sc, op)
+        if kind == "relay" and tray is not None:
+            cmd = op[2].lower()
+            if ("on" in cmd) or ("close" in cmd):
+                self.relay_owner[op[1]] = tray.number
+            else:
+                self.relay_owner.pop(op[1], None)
+        elif kind == "phase":
+            if tray is not None:
+                tray.phase = op[1]
+            station = getStation(op[1])
+            if tray is not None and station and station != tray.station:
+                tray.station = station
+                sc.tray_stations[tray.number] = station
+                sc.log("  Tray {} at {}".format(tray.number, station),
+                                                            log_only=True)
+                sc.emit("tray", tray=tray.number, station=station)
+
+    # Adds a companion move, merged with one already on the same motor
+    def addRun(self, runs, move, steps):
+        for n, run in enumerate(runs):
+            if run[0] == move[0]:
+                runs[n] = (run[0], run[1] + steps) + tuple(run[2:])
+                return
+        runs.append((move[0], steps) + tuple(move[2:]))
+
+    """ Runs one arbitrated conveyor move for all trays in flight. """
+    def advance(self):
+        filling = [t for t in self.active if t.phase == "fillTray"]
+        if filling:
+            lead = filling[0]
+        else:
+            # The shortest move first, so a tray carried the other way by
+            # it has the least distance to make up
+            lead = min(self.active, key=lambda t: abs(t.delta()))
+        sign = 1 if lead.delta() > 0 else -1
+        moving = [t for t in self.active if t.delta() * sign > 0]
+        step = min(abs(t.delta()) for t in moving)
+        newest = self.active[-1]
+        if (sign > 0 and self.loaded < self.trays
+                and newest.x < self.tray_pitch):
+            # Stop where the next tray can be loaded
+            step = min(step, self.tray_pitch - newest.x)
+        rpm = min(t.entry()[2] for t in moving)
+
+        direction = "Forward" if sign > 0 else "Reverse"
+        runs = [(CONVEYOR, step, direction, "Double", rpm)]
+        for tray in moving:
+            if tray.companions is None:
+                tray.companions = [list(m) for m in tray.entry()[3]]
+            share = float(step) / abs(tray.delta())
+            for move in tray.companions:
+                steps = move[1] if share >= 1 else int(round(move[1] * share))
+                if steps > 0:
+                    self.addRun(runs, move, steps)
+                    move[1] -= steps
+
+        sc = self.sc
+        if len(runs) == 1:
+            sc.runStepper(CONVEYOR, steps=step, direction=direction,
+                                                        speed=rpm)
+        else:
+            for motor_id, steps, direction, style, speed in runs:
+                sc.startStepperNoBlock(motor_id, steps=steps,
+                        direction=direction, style=style, speed=speed)
+            sc.waitForMotors()
+        for tray in self.active:
+            tray.x += sign * step
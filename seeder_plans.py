@@ -0,0 +1,442 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""On-disk cache of compiled motion plans.
+
+A plan is the command sequence of one tray of an option (relays, moves
+with their resolved speeds, settle times, phases, journal checkpoints), as
+captured on a CaptureController (see seeder_pipeline.py). It is stored as
+fixed-size binary records, one file per plan, and loaded with mmap, so a
+cached plan is ready without running the option on a simulated controller.
+
+Plans are keyed by a hash of the option, its resolved parameters, the
+motor configuration they were compiled for and the controller, pipeline
+and plan source, plus the start speeds of the motors the option runs
+without setting a speed (the only speeds a plan inherits; see
+openPlanCache()). A change to
+any of them gives a new key, so a stale plan is never loaded; it is no
+longer used and ages out. Each load marks the file as recently used, and
+the least recently used plans are removed when the cache grows past
+max_bytes.
+
+Plans do not follow tray sensors. A controller with sensors fitted runs
+its options directly instead.
+
+Written for Python 2.7 and 3. Four spaces per indentation.
+
+>>> sc.openPlanCache("seeder_plans")
+>>> sc.runPlanned(2)
+
+    python seeder_plans.py list seeder_plans
+    python seeder_plans.py show seeder_plans/<key>_<speeds>.plan
+
+File format (little endian):
+    b"SDPL", u16 version, u32 metadata length, metadata (JSON: key, option,
+    parameters, motor configuration, start speeds, string table)
+    records of REC_FMT: op (u8), motor or relay (u8), string index (i16),
+                        steps or row (i32), extra (i32), value (f64)
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+MAGIC       = b"SDPL"
+VERSION     = 1
+HEAD_FMT    = "<4sHI"
+HEAD_SIZE   = struct.calcsize(HEAD_FMT)
+REC_FMT     = "<BBhiid"
+REC_SIZE    = struct.calcsize(REC_FMT)
+SUFFIX      = ".plan"
+
+OP_RELAY        = 0     # relay, mode (string)
+OP_MOVE         = 1     # motor, direction (string), steps, style (string),
+                        # rpm
+OP_PARALLEL     = 2     # Number of OP_MOVE records that follow, run
+                        # together and waited for
+OP_SETTLE       = 3     # seconds
+OP_PHASE        = 4     # phase (string), row (-1 for None)
+OP_RELEASE      = 5
+OP_RELEASE_STEPPER = 6  # motor
+OP_SEED         = 7
+OP_CHECKPOINT   = 8     # phase (string), row
+OP_MARK         = 9     # motor, name (string), extra 1 if position is given
+
+# Controller settings a plan depends on. The motor speeds are not among
+# them: an option sets most of its own, and the key only holds the start
+# speeds of the motors it runs without setting one (see speedKey()).
+PLAN_CONFIG = ("motor_id", "steps_per_rev", "conveyor_exit_steps")
+
+# Modules whose source decides what a plan holds
+PLAN_MODULES = ("seeder_controller", "seeder_pipeline", "seeder_plans")
+
+code_hash = None
+
+
+# Hash of the source of PLAN_MODULES, so plans are recompiled when any of
+# them changes
+def getCodeHash():
+    global code_hash
+    if code_hash is None:
+        import importlib
+        sha = hashlib.sha1()
+        for name in PLAN_MODULES:
+            fn = importlib.import_module(name).__file__
+            if fn.endswith((".pyc", ".pyo")):
+                fn = fn[:-1]
+            try:
+                fh = open(fn, 'rb')
+                sha.update(fh.read())
+                fh.close()
+            except IOError:
+                pass
+        code_hash = sha.hexdigest()
+    return code_hash
+
+
+""" Returns (base key, metadata) of the plan of an option on a controller,
+without the motor speeds.
+"""
+def planKey(sc, option, params=None):
+    meta = {"option": option,
+            "params": sc.getOptionParams(option, params),
+            "config": dict((name, getattr(sc, name)) for name in PLAN_CONFIG),
+            "code": getCodeHash(),
+            "version": VERSION}
+    text = json.dumps(meta, sort_keys=True).encode("utf-8")
+    return hashlib.sha1(text).hexdigest(), meta
+
+
+""" Returns (key, start speeds) of a plan: its base key and the start
+speeds (sc.plan_speed) of the motors it runs without setting a speed.
+"""
+def speedKey(sc, base, motors):
+    speeds = dict((str(m), sc.plan_speed[sc.getIndex(m)])
+                  for m in sorted(motors))
+    text = json.dumps(speeds, sort_keys=True).encode("utf-8")
+    return "{}_{}".format(base, hashlib.sha1(text).hexdigest()[:16]), speeds
+
+
+""" Captures the commands of an option for a controller's configuration,
+from its start speeds. Returns (commands, motors run at their start speed).
+"""
+def compilePlan(sc, option, params=None):
+    from seeder_pipeline import CaptureController, captureOption
+    capture = CaptureController()
+    for name in PLAN_CONFIG:
+        value = getattr(sc, name)
+        setattr(capture, name, list(value) if isinstance(value, list)
+                                           else value)
+    capture.motor_speed = list(sc.plan_speed)
+    ops = captureOption(option, params, capture)
+    return ops, sorted(capture.inherited)
+
+
+""" Packs captured commands into records. Returns (bytes, string table). """
+def encodeOps(ops):
+    strings = []
+    index = {}
+    def intern(text):
+        if text not in index:
+            index[text] = len(strings)
+            strings.append(text)
+        return index[text]
+
+    def move(m):
+        motor_id, steps, direction, style, rpm = m
+        return struct.pack(REC_FMT, OP_MOVE, motor_id, intern(direction),
+                           steps, intern(style), rpm)
+
+    buf = bytearray()
+    for op in ops:
+        kind = op[0]
+        if kind == "relay":
+            buf += struct.pack(REC_FMT, OP_RELAY, op[1], intern(op[2]),
+                               0, 0, 0.0)
+        elif kind == "move":
+            buf += move(op[1:])
+        elif kind == "parallel":
+            buf += struct.pack(REC_FMT, OP_PARALLEL, 0, -1, len(op[1]), 0,
+                               0.0)
+            for m in op[1]:
+                buf += move(m)
+        elif kind == "settle":
+            buf += struct.pack(REC_FMT, OP_SETTLE, 0, -1, 0, 0, op[1])
+        elif kind == "phase":
+            buf += struct.pack(REC_FMT, OP_PHASE, 0, intern(op[1]),
+                               -1 if op[2] is None else op[2], 0, 0.0)
+        elif kind == "release":
+            buf += struct.pack(REC_FMT, OP_RELEASE, 0, -1, 0, 0, 0.0)
+        elif kind == "releaseStepper":
+            buf += struct.pack(REC_FMT, OP_RELEASE_STEPPER, op[1], -1, 0, 0,
+                               0.0)
+        elif kind == "seed":
+            buf += struct.pack(REC_FMT, OP_SEED, 0, -1, 0, 0, 0.0)
+        elif kind == "checkpoint":
+            buf += struct.pack(REC_FMT, OP_CHECKPOINT, 0, intern(op[1]),
+                               op[2], 0, 0.0)
+        elif kind == "mark":
+            buf += struct.pack(REC_FMT, OP_MARK, op[2], intern(op[1]), 0,
+                               0 if op[3] is None else 1, op[3] or 0)
+        else:
+            raise ValueError("cannot store command {}".format(kind))
+    return bytes(buf), strings
+
+
+class MotionPlan():
+    """A plan file, mapped into memory."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.data = None
+        fh = open(fn, 'rb')
+        try:
+            self.data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fh.close()
+        magic, version, meta_len = struct.unpack_from(HEAD_FMT, self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            self.close()
+            raise ValueError("{} is not a seeder plan".format(fn))
+        self.meta = json.loads(
+                self.data[HEAD_SIZE:HEAD_SIZE + meta_len].decode("utf-8"))
+        self.start = HEAD_SIZE + meta_len
+        self.count = (len(self.data) - self.start) // REC_SIZE
+        self.option = self.meta["option"]
+        self.num_rows = self.meta["params"]["num_rows"]
+
+    def close(self):
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+    def record(self, n):
+        return struct.unpack_from(REC_FMT, self.data,
+                                  self.start + n * REC_SIZE)
+
+    def move(self, n):
+        op, motor_id, direction, steps, style, rpm = self.record(n)
+        strings = self.meta["strings"]
+        return (motor_id, steps, strings[direction], strings[style], rpm)
+
+    """ Yields the commands as captured (see CaptureController). """
+    def iterOps(self):
+        strings = self.meta["strings"]
+        n = 0
+        while n < self.count:
+            op, a, s, steps, extra, value = self.record(n)
+            n += 1
+            if op == OP_RELAY:
+                yield ("relay", a, strings[s])
+            elif op == OP_MOVE:
+                yield ("move",) + self.move(n - 1)
+            elif op == OP_PARALLEL:
+                yield ("parallel", tuple(self.move(n + k)
+                                         for k in range(steps)))
+                n += steps
+            elif op == OP_SETTLE:
+                yield ("settle", value)
+            elif op == OP_PHASE:
+                yield ("phase", strings[s], None if steps < 0 else steps)
+            elif op == OP_RELEASE:
+                yield ("release",)
+            elif op == OP_RELEASE_STEPPER:
+                yield ("releaseStepper", a)
+            elif op == OP_SEED:
+                yield ("seed",)
+            elif op == OP_CHECKPOINT:
+                yield ("checkpoint", strings[s], steps)
+            elif op == OP_MARK:
+                yield ("mark", strings[s], a,
+                       int(value) if extra else None)
+
+    def ops(self):
+        return list(self.iterOps())
+
+
+class PlanCache():
+    """Directory of plan files with a size cap."""
+
+    def __init__(self, directory="seeder_plans", max_bytes=16 << 20):
+        self.directory  = directory
+        self.max_bytes  = max_bytes
+        self.plans      = {}    # key -> MotionPlan mapped by this process
+        self.start_motors = {}  # base key -> motors in speedKey()
+        self.hits       = 0
+        self.misses     = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    """ Returns the MotionPlan of an option on a controller, compiling and
+    storing it if it is not cached.
+    """
+    def load(self, sc, option, params=None):
+        base, meta = planKey(sc, option, params)
+        motors = self.start_motors.get(base)
+        if motors is None:
+            motors = self.findStartMotors(base)
+        plan = None
+        if motors is not None:
+            key, speeds = speedKey(sc, base, motors)
+            plan = self.plans.get(key)
+            if plan is None:
+                plan = self.get(key)
+        if plan is None:
+            self.misses += 1
+            sc.log("  Compiling plan {} for Option {}".format(base[:12],
+                                                option), log_only=True)
+            ops, motors = compilePlan(sc, option, params)
+            key, speeds = speedKey(sc, base, motors)
+            self.put(key, dict(meta, base=base, start_speeds=speeds), ops)
+            plan = self.get(key)
+        else:
+            self.hits += 1
+        self.start_motors[base] = motors
+        self.plans[key] = plan
+        return plan
+
+    # Motors whose start speed is in the key of a stored plan with this
+    # base key, or None
+    def findStartMotors(self, base):
+        for name in os.listdir(self.directory):
+            if not (name.startswith(base + "_") and name.endswith(SUFFIX)):
+                continue
+            try:
+                plan = MotionPlan(os.path.join(self.directory, name))
+            except (IOError, OSError, ValueError):
+                continue
+            speeds = plan.meta.get("start_speeds")
+            plan.close()
+            if speeds is not None:
+                return sorted(int(m) for m in speeds)
+        return None
+
+    # Maps a cached plan, or returns None. A damaged file is removed.
+    def get(self, key):
+        fn = self.path(key)
+        try:
+            plan = MotionPlan(fn)
+        except (IOError, OSError):
+            return None
+        except ValueError:
+            self.remove(fn)
+            return None
+        if plan.meta.get("key") != key:
+            plan.close()
+            self.remove(fn)
+            return None
+        try:
+            os.utime(fn, None)      # Most recently used
+        except OSError:
+            pass
+        return plan
+
+    def put(self, key, meta, ops):
+        data, strings = encodeOps(ops)
+        meta = dict(meta, key=key, strings=strings)
+        meta_text = json.dumps(meta, sort_keys=True).encode("utf-8")
+        fn = self.path(key)
+        # Written under a temporary name so no process maps half a plan
+        tmp_fn = "{}.{}.tmp".format(fn, os.getpid())
+        fh = open(tmp_fn, 'wb')
+        fh.write(struct.pack(HEAD_FMT, MAGIC, VERSION, len(meta_text)))
+        fh.write(meta_text)
+        fh.write(data)
+        fh.close()
+        os.rename(tmp_fn, fn)
+        self.evict(keep=fn)
+
+    def remove(self, fn):
+        try:
+            os.remove(fn)
+        except OSError:
+            pass
+
+    """ Returns (mtime, size, path) of every plan, least recently used
+    first.
+    """
+    def entries(self):
+        out = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            fn = os.path.join(self.directory, name)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            out.append((st.st_mtime, st.st_size, fn))
+        out.sort()
+        return out
+
+    # Removes the least recently used plans until the cache fits
+    def evict(self, keep=None):
+        entries = self.entries()
+        total = sum(size for mtime, size, fn in entries)
+        for mtime, size, fn in entries:
+            if total <= self.max_bytes:
+                break
+            if fn == keep:
+                continue
+            self.remove(fn)     # Processes that mapped it keep their copy
+            total -= size
+
+    def clear(self):
+        for mtime, size, fn in self.entries():
+            self.remove(fn)
+        self.close()
+
+    def close(self):
+        for plan in self.plans.values():
+            plan.close()
+        self.plans = {}
+
+
+""" Runs one tray from a plan, with the journal and progress events of
+runOptionN().
+"""
+def runPlan(sc, plan, params=None):
+    from seeder_pipeline import runOp
+    sc.beginProcess(plan.option, num_rows=plan.num_rows, params=params)
+    for op in plan.iterOps():
+        runOp(sc, op)
+    sc.endProcess(plan.option)
+
+
+if __name__ == "__main__":
+    import argparse
+    from time import ctime
+    parser = argparse.ArgumentParser(description="Seeder motion plans")
+    sub = parser.add_subparsers(dest="cmd")
+    p = sub.add_parser("list")
+    p.add_argument("directory")
+    p = sub.add_parser("show")
+    p.add_argument("fn")
+    p = sub.add_parser("clear")
+    p.add_argument("directory")
+    args = parser.parse_args()
+
+    if args.cmd == "list":
+        cache = PlanCache(args.directory)
+        for mtime, size, fn in reversed(cache.entries()):
+            plan = MotionPlan(fn)
+            print("{}  Option {}  {:6d} bytes  used {}".format(
+                    os.path.basename(fn)[:12], plan.option, size,
+                    ctime(mtime)))
+            plan.close()
+    elif args.cmd == "show":
+        plan = MotionPlan(args.fn)
+        print("Option {}, {} records".format(plan.option, plan.count))
+        print("Config: {}".format(json.dumps(plan.meta["config"],
+                                             sort_keys=True)))
+        for op in plan.iterOps():
+            print("  {}".format(op))
+        plan.close()
+    elif args.cmd == "clear":
+        PlanCache(args.directory).clear()
+    else:
+        parser.print_help()
@@ -0,0 +1,299 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Record, replay and compare the GPIO and MotorHAT command stream.
+
+A Recorder wraps the controller's GPIO backend and MotorHAT steppers and
+captures every GPIO.setup / GPIO.output call and every stepper step call,
+with its time, into a compact binary file. The recording can be pushed
+back through the simulated backend, summarised, or compared against
+another recording. After a recipe or motion code change, a diff shows in
+seconds whether the pulse counts per pin and the relay order are
+unchanged, and how far each relay event moved in time.
+
+Written for Python 2.7 and 3. Four spaces per indentation.
+
+>>> sc.startRecording("option2.rec")
+>>> sc.runOption2()
+>>> sc.stopRecording()
+
+    python seeder_record.py summary option2.rec
+    python seeder_record.py diff before.rec after.rec
+    python seeder_record.py replay option2.rec --realtime
+
+File format (little endian):
+    b"SDRC", u16 version, u32 metadata length, metadata (JSON: pin roles)
+    records of REC_FMT: time since start (f64), op (u8), pin or motor (u16),
+                        value (i32), extra (i32)
+"""
+
+import json
+import struct
+import threading
+from time import sleep, time
+
+MAGIC       = b"SDRC"
+VERSION     = 1
+HEAD_FMT    = "<4sHI"
+REC_FMT     = "<dBHii"
+REC_SIZE    = struct.calcsize(REC_FMT)
+
+OP_INITIAL  = 0     # Output level when recording started (pin, level)
+OP_SETUP    = 1     # GPIO.setup (pin, mode, initial or -1)
+OP_OUTPUT   = 2     # GPIO.output (pin, level)
+OP_STEP     = 3     # MotorHAT step (motor_id, numsteps, dir << 8 | style)
+
+FLUSH_SIZE  = 65536
+
+
+class RecordingGPIO():
+    """GPIO backend proxy that records setup and output calls."""
+
+    def __init__(self, inner, recorder):
+        self.inner = inner
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def setup(self, pin, mode, *args, **kwargs):
+        initial = kwargs.get("initial", args[0] if args else None)
+        self.recorder.add(OP_SETUP, pin, mode, -1 if initial is None
+                                                         else initial)
+        return self.inner.setup(pin, mode, *args, **kwargs)
+
+    def output(self, pin, level):
+        self.recorder.add(OP_OUTPUT, pin, level)
+        self.inner.output(pin, level)
+
+
+class RecordingStepper():
+    """MotorHAT stepper proxy that records step calls."""
+
+    def __init__(self, inner, motor_id, recorder):
+        self.inner = inner
+        self.motor_id = motor_id
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.inner, name)
+
+    def step(self, numsteps, direction, style):
+        self.recorder.add(OP_STEP, self.motor_id, numsteps,
+                          (direction << 8) | style)
+        return self.inner.step(numsteps, direction, style)
+
+
+class Recorder():
+    """Writes one recording file."""
+
+    def __init__(self, fn, meta=None):
+        self.fn = fn
+        self.fh = open(fn, 'wb')
+        meta_text = json.dumps(meta or {}).encode("utf-8")
+        self.fh.write(struct.pack(HEAD_FMT, MAGIC, VERSION, len(meta_text)))
+        self.fh.write(meta_text)
+        self.buf = bytearray()
+        self.t0 = time()
+        self.count = 0
+        self.lock = threading.Lock()    # Motor threads record concurrently
+
+    def add(self, op, pin, value, extra=0):
+        rec = struct.pack(REC_FMT, time() - self.t0, op, pin,
+                          int(value), int(extra))
+        with self.lock:
+            self.buf += rec
+            self.count += 1
+            if len(self.buf) >= FLUSH_SIZE:
+                self.flush()
+
+    # Call with the lock held
+    def flush(self):
+        if self.fh is not None and self.buf:
+            self.fh.write(self.buf)
+            self.buf = bytearray()
+
+    def close(self):
+        with self.lock:
+            if self.fh is not None:
+                self.flush()
+                self.fh.close()
+                self.fh = None
+
+
+"""
+----------------------------------
+ Reading and analysis
+----------------------------------
+"""
+def load(fn):
+    """Returns (metadata dict, list of (t, op, pin, value, extra))."""
+    fh = open(fn, 'rb')
+    data = fh.read()
+    fh.close()
+    head_size = struct.calcsize(HEAD_FMT)
+    magic, version, meta_len = struct.unpack_from(HEAD_FMT, data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("{} is not a seeder recording".format(fn))
+    meta = json.loads(data[head_size:head_size + meta_len].decode("utf-8"))
+    start = head_size + meta_len
+    count = (len(data) - start) // REC_SIZE
+    records = [struct.unpack_from(REC_FMT, data, start + n * REC_SIZE)
+               for n in range(count)]
+    return meta, records
+
+
+def summarize(meta, records):
+    """Pulse counts per step pin, relay event order and MotorHAT steps."""
+    pin_names = {}
+    for kind in ("step_pin", "relay_pin", "dir_pin"):
+        for name, pin in meta.get(kind, {}).items():
+            pin_names[pin] = (kind, int(name))
+    levels = {}
+    pulses = {}         # motor_id -> rising edges on its step pin
+    relays = []         # (t, relay, "on"/"off") in order
+    mh_steps = {}       # motor_id -> steps
+    for t, op, pin, value, extra in records:
+        if op == OP_INITIAL:
+            levels[pin] = value
+            continue
+        if op == OP_STEP:
+            mh_steps[pin] = mh_steps.get(pin, 0) + value
+            continue
+        if op != OP_OUTPUT:
+            continue
+        old = levels.get(pin)
+        levels[pin] = value
+        kind, number = pin_names.get(pin, ("other", pin))
+        if kind == "step_pin":
+            if value and not old:
+                pulses[number] = pulses.get(number, 0) + 1
+        elif kind == "relay_pin" and value != old:
+            # LOW = ON/Closed. Only changes count, so recordings made with
+            # and without the controller's write cache compare equal.
+            relays.append((t, number, "off" if value else "on"))
+    duration = records[-1][0] if records else 0.0
+    return {"pulses": pulses, "relays": relays, "motorhat_steps": mh_steps,
+            "duration": duration, "records": len(records)}
+
+
+def diff(fn_a, fn_b):
+    """Compares two recordings. Returns (identical, list of report lines)."""
+    a = summarize(*load(fn_a))
+    b = summarize(*load(fn_b))
+    lines = []
+    same = True
+
+    motors = sorted(set(a["pulses"]) | set(b["pulses"]) |
+                    set(a["motorhat_steps"]) | set(b["motorhat_steps"]))
+    for motor_id in motors:
+        pa = a["pulses"].get(motor_id, 0) + a["motorhat_steps"].get(motor_id, 0)
+        pb = b["pulses"].get(motor_id, 0) + b["motorhat_steps"].get(motor_id, 0)
+        mark = "  " if pa == pb else "!!"
+        same = same and pa == pb
+        lines.append("{} motor {}: {} -> {} steps".format(mark, motor_id,
+                                                          pa, pb))
+
+    seq_a = [(r, s) for t, r, s in a["relays"]]
+    seq_b = [(r, s) for t, r, s in b["relays"]]
+    if seq_a == seq_b:
+        shifts = [tb - ta for (ta, r, s), (tb, r2, s2)
+                  in zip(a["relays"], b["relays"])]
+        worst = max(range(len(shifts)), key=lambda n: abs(shifts[n])) \
+                if shifts else None
+        lines.append("   relay order: identical ({} events)".format(
+                                                            len(seq_a)))
+        if worst is not None:
+            t, relay, state = b["relays"][worst]
+            lines.append("   largest timing shift: {:+.3f} s at event {} "
+                         "(relay {} {})".format(shifts[worst], worst + 1,
+                                                relay, state))
+    else:
+        same = False
+        n = 0
+        while n < min(len(seq_a), len(seq_b)) and seq_a[n] == seq_b[n]:
+            n += 1
+        lines.append("!! relay order differs at event {}: {} vs {}".format(
+                n + 1, seq_a[n] if n < len(seq_a) else "end",
+                seq_b[n] if n < len(seq_b) else "end"))
+        lines.append("   relay events: {} -> {}".format(len(seq_a),
+                                                       len(seq_b)))
+    lines.append("   duration: {:.3f} s -> {:.3f} s ({:+.3f} s)".format(
+            a["duration"], b["duration"], b["duration"] - a["duration"]))
+    return same, lines
+
+
+def replay(fn, gpio=None, realtime=False, speed=1.0, steppers=None):
+    """Pushes a recording through a GPIO backend and MotorHAT steppers
+    (motor_id -> stepper), the simulated ones by default. Steps of a motor
+    without a stepper are skipped with a warning. With realtime, the
+    original timing is reproduced, scaled by speed. Returns the backend.
+    """
+    meta, records = load(fn)
+    if gpio is None:
+        from seeder_controller import GPIO_empty, Adafruit_MotorHAT_empty
+        gpio = GPIO_empty()
+        if steppers is None:
+            hat = Adafruit_MotorHAT_empty(addr=0x60)
+            steppers = dict((r[2], hat.getStepper(200, 0))
+                            for r in records if r[1] == OP_STEP)
+    steppers = steppers or {}
+    skipped = {}        # motor_id -> steps not replayed
+    start = time()
+    for t, op, pin, value, extra in records:
+        if realtime:
+            wait = start + t / speed - time()
+            if wait > 0:
+                sleep(wait)
+        if op in (OP_INITIAL, OP_OUTPUT):
+            gpio.output(pin, value)
+        elif op == OP_SETUP:
+            if extra >= 0:
+                gpio.setup(pin, value, initial=extra)
+            else:
+                gpio.setup(pin, value)
+        elif op == OP_STEP:
+            if pin in steppers:
+                steppers[pin].step(value, extra >> 8, extra & 0xff)
+            else:
+                skipped[pin] = skipped.get(pin, 0) + value
+    for motor_id in sorted(skipped):
+        print("  Warning: {} MotorHAT steps of motor {} not replayed "
+              "(no stepper given)".format(skipped[motor_id], motor_id))
+    return gpio
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="Seeder command recordings")
+    sub = parser.add_subparsers(dest="cmd")
+    p = sub.add_parser("summary")
+    p.add_argument("fn")
+    p = sub.add_parser("diff")
+    p.add_argument("fn_a")
+    p.add_argument("fn_b")
+    p = sub.add_parser("replay")
+    p.add_argument("fn")
+    p.add_argument("--realtime", action="store_true")
+    p.add_argument("--speed", type=float, default=1.0)
+    args = parser.parse_args()
+
+    if args.cmd == "summary":
+        s = summarize(*load(args.fn))
+        print("{} records, {:.3f} s".format(s["records"], s["duration"]))
+        for motor_id in sorted(s["pulses"]):
+            print("  motor {}: {} steps".format(motor_id,
+                                                s["pulses"][motor_id]))
+        for motor_id in sorted(s["motorhat_steps"]):
+            print("  motor {}: {} MotorHAT steps".format(motor_id,
+                                              s["motorhat_steps"][motor_id]))
+        print("  {} relay events".format(len(s["relays"])))
+    elif args.cmd == "diff":
+        same, lines = diff(args.fn_a, args.fn_b)
+        print("\n".join(lines))
+        sys.exit(0 if same else 1)
+    elif args.cmd == "replay":
+        gpio = replay(args.fn, realtime=args.realtime, speed=args.speed)
+        print("Final levels: {}".format(sorted(gpio.levels.items())))
+    else:
+        parser.print_help()
@@ -0,0 +1,335 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Headless command server for the seeding machine.
+
+Owns one SeederController and accepts commands over a Unix or TCP socket so
+that the line PLC, dashboards and test scripts can drive the seeder without
+the Tk GUI.
+
+Requires Python 3 (asyncio). Four spaces per indentation.
+
+Protocol: one JSON object per line in each direction.
+
+    {"cmd": "start", "option": 2}           Run a process loop (option 1-5)
+    {"cmd": "start", "option": 2, "trays": 10, "params": {...}}
+                                            Several trays, pipelined, with
+                                            parameter overrides
+    {"cmd": "resume"}                       Continue a stopped process loop
+    {"cmd": "stop"}                         Stop the running command
+    {"cmd": "jog", "motor": 1, "steps": 100, "direction": "Forward",
+                   "speed": 20, "style": "Double"}
+    {"cmd": "relay", "relay": 7, "mode": "Close"}
+    {"cmd": "status"}
+    {"cmd": "metrics"}                      Prometheus text, in "text"
+    {"cmd": "subscribe"} / {"cmd": "unsubscribe"}
+
+Every command gets one reply {"ok": true, ...} or {"ok": false, "error": ..}
+echoing its "id" if one was given. Subscribed clients are also sent the
+controller's progress events ({"event": "log" | "phase" | "process" |
+"tray" | "job", ...}).
+
+Motion runs on a single worker thread. Controller events are handed to the
+event loop with call_soon_threadsafe and queued per client; a client that
+does not keep up loses its oldest events rather than slowing the machine.
+
+>>> python3 seeder_server.py --simulate --unix /tmp/seeder.sock
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import traceback
+
+from seeder_controller import SeederController, StopRequested
+
+
+class SeederServer():
+    """Socket front end for one SeederController."""
+
+    def __init__(self, sc, queue_size=1000):
+        self.sc             = sc
+        self.queue_size     = queue_size    # Events buffered per subscriber
+        self.clients        = set()         # Connected stream writers
+        self.subscribers    = {}            # writer -> asyncio.Queue
+        self.dropped        = 0             # Events lost to slow clients
+        self.job            = None          # Name of the running command
+        self.last_error     = ""
+        self.loop           = None
+        self.server         = None
+        # One worker: the controller only ever runs one command at a time
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    """
+    ----------------------------------
+     Server lifetime
+    ----------------------------------
+    """
+    async def start(self, unix_path=None, host="127.0.0.1", port=8765):
+        self.loop = asyncio.get_running_loop()
+        self.sc.addListener(self.onControllerEvent)
+        if unix_path:
+            if os.path.exists(unix_path):
+                os.remove(unix_path)
+            self.server = await asyncio.start_unix_server(
+                    self.handleClient, path=unix_path)
+        else:
+            self.server = await asyncio.start_server(
+                    self.handleClient, host=host, port=port)
+        return self.server
+
+    async def close(self):
+        self.sc.removeListener(self.onControllerEvent)
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in list(self.clients):
+            writer.close()
+        self.executor.shutdown(wait=False)
+
+    async def serveForever(self, **kwargs):
+        server = await self.start(**kwargs)
+        async with server:
+            await server.serve_forever()
+
+    """
+    ----------------------------------
+     Events
+    ----------------------------------
+    """
+    # Called from the controller thread. Never blocks.
+    def onControllerEvent(self, event):
+        if self.loop is None or not self.subscribers:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.broadcast, dict(event))
+        except RuntimeError:
+            pass    # Loop already closed
+
+    def broadcast(self, event):
+        for queue in self.subscribers.values():
+            if queue.full():
+                queue.get_nowait()      # Drop the oldest event
+                self.dropped += 1
+            queue.put_nowait(event)
+
+    async def pumpEvents(self, writer, queue):
+        try:
+            while True:
+                event = await queue.get()
+                writer.write(self.encode(event))
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+
+    """
+    ----------------------------------
+     Client handling
+    ----------------------------------
+    """
+    @staticmethod
+    def encode(msg):
+        return (json.dumps(msg) + "\n").encode("utf-8")
+
+    async def handleClient(self, reader, writer):
+        pump = None
+        self.clients.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line.decode("utf-8"))
+                    if not isinstance(request, dict):
+                        raise ValueError("request must be a JSON object")
+                except ValueError as e:
+                    reply = {"ok": False, "error": "bad request: {}".format(e)}
+                else:
+                    cmd = request.get("cmd")
+                    if cmd == "subscribe" and pump is None:
+                        queue = asyncio.Queue(maxsize=self.queue_size)
+                        self.subscribers[writer] = queue
+                        pump = asyncio.ensure_future(
+                                self.pumpEvents(writer, queue))
+                        reply = {"ok": True}
+                    elif cmd == "unsubscribe" and pump is not None:
+                        self.subscribers.pop(writer, None)
+                        pump.cancel()
+                        pump = None
+                        reply = {"ok": True}
+                    else:
+                        reply = self.dispatch(request)
+                    if "id" in request:
+                        reply["id"] = request["id"]
+                writer.write(self.encode(reply))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.discard(writer)
+            self.subscribers.pop(writer, None)
+            if pump is not None:
+                pump.cancel()
+            writer.close()
+
+    def dispatch(self, request):
+        cmd = request.get("cmd")
+        try:
+            if cmd == "status":
+                return self.cmdStatus()
+            elif cmd == "stop":
+                return self.cmdStop()
+            elif cmd == "metrics":
+                return {"ok": True, "text": self.sc.metrics.render()}
+            elif cmd == "start":
+                return self.cmdStart(int(request["option"]),
+                                     int(request.get("trays", 1)),
+                                     request.get("params"))
+            elif cmd == "resume":
+                return self.submit("resume", self.sc.resume)
+            elif cmd == "jog":
+                return self.cmdJog(request)
+            elif cmd == "relay":
+                return self.cmdRelay(int(request["relay"]),
+                                     request.get("mode", "Open"))
+            elif cmd in ("subscribe", "unsubscribe"):
+                return {"ok": True}     # Already (un)subscribed
+            return {"ok": False, "error": "unknown command: {}".format(cmd)}
+        except (KeyError, TypeError, ValueError) as e:
+            return {"ok": False, "error": "bad arguments: {!r}".format(e)}
+
+    """
+    ----------------------------------
+     Commands
+    ----------------------------------
+    """
+    def cmdStatus(self):
+        return {"ok": True,
+                "busy": self.job is not None,
+                "job": self.job,
+                "option": self.sc.option,
+                "phase": self.sc.phase,
+                "row": self.sc.row,
+                "num_rows": self.sc.num_rows,
+                "trays": self.sc.tray_stations,
+                "position": self.sc.position,
+                "stop": self.sc.stop,
+                "simulate": self.sc.simulate,
+                "trays_done": self.sc.metrics.trays.total(),
+                "seeds": self.sc.metrics.seeds.get(),
+                "trays_per_hour": self.sc.metrics.trays_per_hour.get(),
+                "last_error": self.last_error,
+                "dropped_events": self.dropped}
+
+    def cmdStop(self):
+        if self.job is None:
+            # Nothing running; make sure the machine is released
+            return self.submit("release", self.safeRelease)
+        self.sc.stop = True     # Picked up by checkStop() on the worker
+        return {"ok": True, "job": self.job}
+
+    def cmdStart(self, option, trays=1, params=None):
+        cmd = getattr(self.sc, "runOption{}".format(option), None)
+        if cmd is None:
+            raise ValueError("unknown option {}".format(option))
+        if params is not None and not isinstance(params, dict):
+            raise ValueError("params must be an object")
+        if trays > 1:
+            return self.submit("option{}x{}".format(option, trays),
+                    self.sc.runPipeline, option, trays=trays, params=params)
+        return self.submit("option{}".format(option), self.sc.runPlanned,
+                           option, params)
+
+    def cmdJog(self, request):
+        motor_id = int(request["motor"])
+        if motor_id not in self.sc.motor_id:
+            raise ValueError("unknown motor {}".format(motor_id))
+        kwargs = {"steps": int(request["steps"]),
+                  "direction": request.get("direction", "Forward"),
+                  "speed": int(request.get("speed", 0)),
+                  "style": request.get("style", "Double")}
+        return self.submit("jog", self.sc.runStepper, motor_id, **kwargs)
+
+    def cmdRelay(self, relay, mode):
+        if relay not in self.sc.relay_list:
+            raise ValueError("unknown relay {}".format(relay))
+        return self.submit("relay", self.sc.setRelay, relay, mode=mode)
+
+    def submit(self, name, fn, *args, **kwargs):
+        if self.job is not None:
+            return {"ok": False, "error": "busy: {}".format(self.job)}
+        self.job = name
+        self.sc.stop = False
+        future = self.loop.run_in_executor(
+                self.executor, self.runJob, name, fn, args, kwargs)
+        future.add_done_callback(self.jobDone)
+        self.broadcast({"event": "job", "state": "start", "job": name})
+        return {"ok": True, "job": name}
+
+    # Runs on the worker thread
+    def runJob(self, name, fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+            return {"state": "done", "job": name}
+        except StopRequested:
+            # Raised by checkStop(); leave the machine safe
+            self.safeRelease()
+            return {"state": "stopped", "job": name}
+        except Exception:
+            self.sc.log("\n  -- Error\n")
+            self.sc.log(traceback.format_exc())
+            self.safeRelease()
+            return {"state": "error", "job": name,
+                    "error": traceback.format_exc().strip().splitlines()[-1]}
+
+    def safeRelease(self):
+        self.sc.stop = False
+        try:
+            self.sc.releaseAll()
+        except Exception:
+            self.sc.log(traceback.format_exc())
+
+    def jobDone(self, future):
+        self.job = None
+        result = future.result()
+        self.last_error = result.get("error", "")
+        result["event"] = "job"
+        self.broadcast(result)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Seeder command server")
+    parser.add_argument("--unix", help="Unix socket path to listen on")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--simulate", action="store_true",
+                        help="Use the simulated hardware backend")
+    parser.add_argument("--metrics-port", type=int, default=0,
+                        help="Serve Prometheus metrics on this HTTP port")
+    parser.add_argument("--plan-cache",
+                        help="Keep compiled motion plans in this directory")
+    parser.add_argument("--status-file", 
+                        help="Publish the shared-memory status block here")
+    args = parser.parse_args(argv)
+
+    sc = SeederController(simulate=args.simulate)
+    sc.verbose = False
+    if args.metrics_port:
+        sc.metrics.serveHTTP(args.metrics_port)
+    if args.status_file:
+        sc.openStatusBlock(args.status_file)
+    if args.plan_cache:
+        sc.openPlanCache(args.plan_cache)
+    server = SeederServer(sc)
+    try:
+        asyncio.run(server.serveForever(unix_path=args.unix,
+                                        host=args.host, port=args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
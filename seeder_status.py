@@ -0,0 +1,174 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Shared-memory machine status block.
+
+The SeederController publishes its current option, phase, row, relay
+states and motor positions into a small fixed-layout struct in a
+memory-mapped file. The GUI, the metrics exporter or a monitor in another
+process can then read it at any rate, with no locks and no calls into the
+controller.
+
+The block is a seqlock. The writer makes the sequence counter odd, updates
+the fields in place and makes it even again. A reader copies the fields and
+retries if the counter was odd or changed while it read. The controller
+publishes on phase changes, relay changes and at the end of each move,
+never from inside the step loop.
+
+Written for Python 2.7 and 3. Four spaces per indentation.
+
+>>> sc.openStatusBlock()                 # Writer, in the controller
+>>> StatusReader().read()                # Reader, in any process
+{'option': 2, 'phase': 'setRow', 'row': 5, ...}
+
+Monitor from a shell:
+
+    python seeder_status.py [path]
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+import threading
+from time import sleep, time
+
+if os.path.isdir("/dev/shm"):
+    DEFAULT_FN = "/dev/shm/seeder_status"
+else:
+    DEFAULT_FN = os.path.join(tempfile.gettempdir(), "seeder_status")
+
+"""
+Layout (little endian)
+"""
+MAGIC       = b"SDST"
+VERSION     = 1
+BLOCK_SIZE  = 256
+MAX_MOTORS  = 8
+MAX_RELAYS  = 16
+HEADER_FMT  = "<4sHHI"          # magic, version, reserved, seq
+OFF_SEQ     = 8
+OFF_BODY    = 16
+BODY_FMT    = "<HHHHHH24sIId8q" # option, row, num_rows, flags, relays,
+                                # reserved, phase, trays, seeds, updated,
+                                # positions
+FLAG_RUNNING    = 1             # Inside a process loop
+FLAG_STOP       = 2             # Stop signal set
+FLAG_SIMULATE   = 4
+FLAG_WORKER     = 8             # Motion worker process in use
+
+
+def openBlock(fn, create):
+    if create:
+        fd = os.open(fn, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(fd, BLOCK_SIZE)
+    else:
+        fd = os.open(fn, os.O_RDONLY)
+    try:
+        access = mmap.ACCESS_WRITE if create else mmap.ACCESS_READ
+        return mmap.mmap(fd, BLOCK_SIZE, access=access)
+    finally:
+        os.close(fd)
+
+
+class StatusWriter():
+    """Controller side of the status block."""
+
+    def __init__(self, fn=DEFAULT_FN):
+        self.fn = fn
+        self.mm = openBlock(fn, create=True)
+        self.seq = 0
+        # Motor threads publish too; the seqlock needs one writer at a time
+        self.lock = threading.Lock()
+        struct.pack_into(HEADER_FMT, self.mm, 0, MAGIC, VERSION, 0, self.seq)
+
+    def publish(self, sc):
+        positions = [sc.position[m] for m in sc.motor_id][:MAX_MOTORS]
+        positions += [0] * (MAX_MOTORS - len(positions))
+        relays = 0
+        for n, relay in enumerate(sc.relay_list[:MAX_RELAYS]):
+            if sc.relay_state[relay] == "on":
+                relays |= 1 << n
+        flags = 0
+        if sc.journaling:
+            flags |= FLAG_RUNNING
+        if sc.stop:
+            flags |= FLAG_STOP
+        if sc.simulate:
+            flags |= FLAG_SIMULATE
+        if sc.motion_worker is not None:
+            flags |= FLAG_WORKER
+        trays = sc.metrics.trays.total()
+        seeds = sc.metrics.seeds.get()
+        with self.lock:
+            self.seq += 1       # Odd: update in progress
+            struct.pack_into("<I", self.mm, OFF_SEQ, self.seq)
+            struct.pack_into(BODY_FMT, self.mm, OFF_BODY,
+                    sc.option, sc.row, sc.num_rows, flags, relays, 0,
+                    sc.phase.encode("ascii", "replace")[:24],
+                    trays, seeds, time(), *positions)
+            self.seq += 1       # Even: consistent
+            struct.pack_into("<I", self.mm, OFF_SEQ, self.seq)
+
+    def close(self):
+        self.mm.close()
+
+
+class StatusReader():
+    """Lock-free reader of the status block, for any process."""
+
+    def __init__(self, fn=DEFAULT_FN):
+        self.fn = fn
+        self.mm = openBlock(fn, create=False)
+        magic, version = struct.unpack_from(HEADER_FMT, self.mm, 0)[:2]
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("{} is not a seeder status block".format(fn))
+
+    """ Returns a consistent snapshot as a dict, or None if the writer kept
+    the block busy for all retries.
+    """
+    def read(self, retries=100):
+        for x in range(retries):
+            seq = struct.unpack_from("<I", self.mm, OFF_SEQ)[0]
+            if seq & 1:
+                continue
+            body = struct.unpack_from(BODY_FMT, self.mm, OFF_BODY)
+            if struct.unpack_from("<I", self.mm, OFF_SEQ)[0] == seq:
+                break
+        else:
+            return None
+        flags = body[3]
+        return {"seq": seq,
+                "option": body[0],
+                "row": body[1],
+                "num_rows": body[2],
+                "running": bool(flags & FLAG_RUNNING),
+                "stop": bool(flags & FLAG_STOP),
+                "simulate": bool(flags & FLAG_SIMULATE),
+                "motion_worker": bool(flags & FLAG_WORKER),
+                "relays": [(body[4] >> n) & 1 for n in range(MAX_RELAYS)],
+                "phase": body[6].rstrip(b"\0").decode("ascii"),
+                "trays": body[7],
+                "seeds": body[8],
+                "updated": body[9],
+                "positions": list(body[10:10 + MAX_MOTORS])}
+
+    def close(self):
+        self.mm.close()
+
+
+if __name__ == "__main__":
+    import sys
+    reader = StatusReader(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_FN)
+    last_seq = None
+    try:
+        while True:
+            status = reader.read()
+            if status and status["seq"] != last_seq:
+                last_seq = status["seq"]
+                print("option={option} phase={phase:<16} row={row}/{num_rows}"
+                      " relays={relays_str} pos={positions}".format(
+                      relays_str="".join(str(b) for b in status["relays"][:8]),
+                      **status))
+            sleep(0.1)
+    except KeyboardInterrupt:
+        pass
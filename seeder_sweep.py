@@ -0,0 +1,319 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Parameter sweep for the process loop options.
+
+Runs many variants of an option's parameters (see OPTION_PARAMS in
+seeder_controller.py) on a simulated controller with a virtual clock, and
+scores each variant by its predicted cycle time. Moves take
+steps * 60 / (steps_per_rev * rpm) seconds, parallel moves take as long as
+the longest of them, and settle waits take their given time. Nothing
+actually sleeps, so one variant takes milliseconds and a grid of thousands
+runs in seconds on all cores.
+
+A variant is valid if no motor is run faster than its maximum RPM and no
+settle time is below its minimum. The fastest valid variants are reported,
+and the best can be saved as a JSON file of overrides for runOptionN().
+
+Changing step counts moves where the dibbles and seeds land. Check a new
+step count on the machine, or compare recordings with seeder_record.py.
+
+Written for Python 2.7 and 3. Four spaces per indentation. The sweep runs
+on all cores only on Python 3.7 and later (ProcessPoolExecutor with an
+initializer); elsewhere the variants are scored one after the other.
+
+    python seeder_sweep.py --option 2 --vary speed_seedhead=180:260:20 \\
+            --vary settle_release=0.2,0.3,0.5 --max-rpm 4=240 \\
+            --min-settle settle_release=0.25 --save best.json
+"""
+
+import itertools
+import json
+import os
+import sys
+
+try:
+    from concurrent.futures import ProcessPoolExecutor
+except ImportError:
+    ProcessPoolExecutor = None  # Python 2.7 without the futures backport
+
+from seeder_controller import SeederController, OPTION_PARAMS
+from seeder_journal import NullJournal
+
+
+class TimingController(SeederController):
+    """Simulated controller that predicts run time instead of waiting."""
+
+    def __init__(self, config_fn="seeder_config.txt"):
+        self.clock          = 0.0       # Predicted seconds since the start
+        self.parallel       = []        # Durations of non-blocking moves
+        self.max_speed      = {}        # motor_id -> highest RPM used
+        self.settles        = []        # Settle waits, in order
+        self.phase_times    = []        # (phase, start time) in order
+        SeederController.__init__(self, config_fn=config_fn, simulate=True)
+        self.start_speed    = list(self.motor_speed)
+        self.journal        = NullJournal()
+        self.log_fn         = os.devnull
+
+    def log(self, text_str, log_only=False, mode='a'):
+        pass
+
+    def reset(self):
+        self.stop = False
+        self.clock = 0.0
+        self.parallel = []
+        self.max_speed = {}
+        self.settles = []
+        self.phase_times = []
+        # Moves with speed=0 keep the speed left by the previous move, so
+        # every variant must start from the same speeds
+        self.motor_speed = list(self.start_speed)
+        self.position = dict((m, 0) for m in self.motor_id)
+        self.named_positions = {}
+
+    # Simulated runs are never cut short, so returnToZero keeps its fixed
+    # step count
+    def getExitSteps(self):
+        return self.conveyor_exit_steps
+
+    def settle(self, seconds):
+        self.settles.append(seconds)
+        self.clock += seconds
+
+    def setPhase(self, phase, row=None):
+        if not self.phase_times or self.phase_times[-1][0] != phase:
+            self.phase_times.append((phase, self.clock))
+        SeederController.setPhase(self, phase, row)
+
+    def moveTime(self, motor_id, steps, speed):
+        self.setSpeed(motor_id, speed)
+        mtr_index = self.getIndex(motor_id)
+        rpm = self.motor_speed[mtr_index]
+        self.max_speed[motor_id] = max(rpm, self.max_speed.get(motor_id, 0))
+        return 60.0 * steps / (self.steps_per_rev[mtr_index] * rpm)
+
+    def runStepper(self, motor_id, steps=0, direction="Forward",
+                                            style="Double",
+                                            speed=0):
+        self.checkStop()
+        if steps == 0:
+            return 0
+        self.clock += self.moveTime(motor_id, steps, speed)
+        self.position[motor_id] += self.getDirectionSign(direction) * steps
+        self.moveFinished(motor_id, steps)
+        return steps
+
+    # No sensors in the simulation, so the full distance is run
+    def runStepperUntil(self, motor_id, input_pin, edge="rising",
+                                            max_steps=0,
+                                            direction="Forward",
+                                            style="Double",
+                                            speed=0):
+        return self.runStepper(motor_id, steps=max_steps,
+                               direction=direction, style=style, speed=speed)
+
+    def startStepperNoBlock(self, motor_id, steps=0, direction="Forward",
+                                            style="Double",
+                                            speed=0):
+        start = self.clock
+        self.runStepper(motor_id, steps, direction, style, speed)
+        self.parallel.append(self.clock - start)
+        self.clock = start
+
+    def waitForMotors(self):
+        self.clock += max(self.parallel or [0.0])
+        self.parallel = []
+
+
+"""
+----------------------------------
+ Sweep
+----------------------------------
+"""
+sweep_sc = None     # TimingController of this sweep process
+
+def initSweep():
+    global sweep_sc
+    sweep_sc = TimingController()
+
+
+""" Predicts the cycle time of one variant, on the given TimingController
+or this process's sweep controller.
+
+Returns a dict with the overrides, the predicted time, the phase times and
+a list of constraint violations (empty if the variant is valid).
+"""
+def evaluate(option, params, max_rpm=None, min_settle=None, sc=None):
+    if sc is None:
+        if sweep_sc is None:
+            initSweep()
+        sc = sweep_sc
+    sc.reset()
+    violations = []
+    p = sc.getOptionParams(option, params)
+    for name, seconds in sorted((min_settle or {}).items()):
+        if p[name] < seconds:
+            violations.append("{} {} < {}".format(name, p[name], seconds))
+
+    getattr(sc, "runOption{}".format(option))(params)
+
+    for motor_id, rpm in sorted(sc.max_speed.items()):
+        limit = (max_rpm or {}).get(motor_id)
+        if limit is not None and rpm > limit:
+            violations.append("motor {} {} rpm > {}".format(motor_id, rpm,
+                                                                    limit))
+    # Total time per phase, in order of the first use
+    phases = []
+    totals = {}
+    for n, (phase, start) in enumerate(sc.phase_times):
+        end = sc.phase_times[n+1][1] if n+1 < len(sc.phase_times) \
+                                                        else sc.clock
+        if phase not in totals:
+            phases.append(phase)
+            totals[phase] = 0.0
+        totals[phase] += end - start
+    phases = [(phase, round(totals[phase], 3)) for phase in phases if phase]
+    return {"params": params, "time": sc.clock, "phases": phases,
+            "violations": violations}
+
+
+def evaluateArgs(args):
+    return evaluate(*args)
+
+
+""" Every combination of the given values.
+
+>>> list(gridVariants({"a": [1, 2], "b": [3]}))
+[{'a': 1, 'b': 3}, {'a': 2, 'b': 3}]
+"""
+def gridVariants(space):
+    names = sorted(space)
+    for values in itertools.product(*[space[name] for name in names]):
+        yield dict(zip(names, values))
+
+
+""" Scores every variant of the grid, on all cores where the Python
+supports it.
+
+Returns (valid results sorted fastest first, number of invalid variants).
+"""
+def sweep(option, space, max_rpm=None, min_settle=None, workers=None,
+                                                        chunksize=16):
+    unknown = set(space) - set(OPTION_PARAMS[option])
+    if unknown:
+        raise ValueError("Unknown parameters for option {}: {}".format(
+                                        option, ", ".join(sorted(unknown))))
+    jobs = [(option, params, max_rpm, min_settle)
+            for params in gridVariants(space)]
+    if ProcessPoolExecutor is None or sys.version_info < (3, 7):
+        initSweep()
+        results = [evaluateArgs(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=initSweep) as pool:
+            results = list(pool.map(evaluateArgs, jobs,
+                                    chunksize=chunksize))
+    valid = [r for r in results if not r["violations"]]
+    valid.sort(key=lambda r: r["time"])
+    return valid, len(results) - len(valid)
+
+
+"""
+----------------------------------
+ Command line
+----------------------------------
+"""
+def parseValue(text):
+    for kind in (int, float):
+        try:
+            return kind(text)
+        except ValueError:
+            pass
+    return text
+
+
+""" Parses "name=a,b,c" or "name=start:stop:step" (stop included). """
+def parseVary(text):
+    name, values = text.split("=", 1)
+    if ":" in values:
+        start, stop, step = [parseValue(v) for v in values.split(":")]
+        out = []
+        value = start
+        while value <= stop + 1e-9:
+            out.append(round(value, 6))
+            value += step
+        return name, out
+    return name, [parseValue(v) for v in values.split(",")]
+
+
+""" Parses limits given as "key=value", or a bare value for every key.
+Raises ValueError for a key that is not in valid (if given).
+"""
+def parseLimits(items, keys, kind=str, valid=None):
+    limits = {}
+    for item in items or []:
+        if "=" in item:
+            key, value = item.split("=", 1)
+            key = kind(key)
+            if valid is not None and key not in valid:
+                raise ValueError("unknown limit {}".format(key))
+            limits[key] = float(value)
+        else:
+            for key in keys:
+                limits[key] = float(item)
+    return limits
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Seeder parameter sweep")
+    parser.add_argument("--option", type=int, default=2,
+                        choices=sorted(OPTION_PARAMS))
+    parser.add_argument("--vary", action="append", default=[],
+                        help="name=a,b,c or name=start:stop:step")
+    parser.add_argument("--max-rpm", action="append",
+                        help="motor_id=rpm, or rpm for all motors")
+    parser.add_argument("--min-settle", action="append",
+                        help="name=seconds, or seconds for every varied "
+                             "settle time")
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--save", help="Write the best overrides as JSON")
+    args = parser.parse_args()
+
+    space = dict(parseVary(v) for v in args.vary)
+    settles = [k for k in OPTION_PARAMS[args.option] if k.startswith("settle_")]
+    try:
+        max_rpm = parseLimits(args.max_rpm, [1, 2, 3, 4], kind=int,
+                              valid=[1, 2, 3, 4])
+        min_settle = parseLimits(args.min_settle,
+                                 [k for k in space if k.startswith("settle_")],
+                                 valid=settles)
+    except ValueError as e:
+        parser.error(str(e))
+
+    base = evaluate(args.option, {}, max_rpm, min_settle)
+    print("Option {} as set: {:.1f} s{}".format(args.option, base["time"],
+            "" if not base["violations"] else
+            " (violates {})".format("; ".join(base["violations"]))))
+
+    count = 1
+    for values in space.values():
+        count *= len(values)
+    print("Sweeping {} variants...".format(count))
+    valid, invalid = sweep(args.option, space, max_rpm, min_settle,
+                           workers=args.workers)
+    print("{} valid, {} violate the limits".format(len(valid), invalid))
+    for n, result in enumerate(valid[:args.top]):
+        print("{:2d}. {:8.1f} s  {:+7.1f} s  {}".format(n + 1, result["time"],
+                result["time"] - base["time"],
+                " ".join("{}={}".format(k, v)
+                         for k, v in sorted(result["params"].items()))))
+    if valid:
+        print("Phases of the best variant:")
+        for phase, seconds in valid[0]["phases"]:
+            print("    {:<16} {:8.1f} s".format(phase, seconds))
+        if args.save:
+            fh = open(args.save, 'w')
+            json.dump(valid[0]["params"], fh, indent=2, sort_keys=True)
+            fh.close()
+            print("Saved to {}".format(args.save))
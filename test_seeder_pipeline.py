@@ -0,0 +1,101 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""Tests of the tray pipeline on the simulated timing controller.
+
+Written for Python 2.7 and 3. Four spaces per indentation.
+
+    python -m unittest test_seeder_pipeline
+"""
+
+import unittest
+
+from seeder_controller import OPTION_PARAMS
+from seeder_pipeline import TrayPipeline, REST_CLOSED
+from seeder_sweep import TimingController
+
+TRAYS = 5
+
+
+class TraceController(TimingController):
+    """Timing controller that records conveyor moves made while the
+    hopper relays (6 and 8) are closed.
+    """
+
+    def __init__(self):
+        TimingController.__init__(self)
+        self.fill_moves = []
+
+    def runStepper(self, motor_id, steps=0, direction="Forward",
+                                            style="Double",
+                                            speed=0):
+        self.traceMove(motor_id, direction)
+        return TimingController.runStepper(self, motor_id, steps=steps,
+                        direction=direction, style=style, speed=speed)
+
+    def startStepperNoBlock(self, motor_id, steps=0, direction="Forward",
+                                            style="Double",
+                                            speed=0):
+        self.traceMove(motor_id, direction)
+        return TimingController.startStepperNoBlock(self, motor_id,
+                        steps=steps, direction=direction, style=style,
+                        speed=speed)
+
+    def traceMove(self, motor_id, direction):
+        if motor_id == 1 and "on" in (self.relay_state[6],
+                                      self.relay_state[8]):
+            self.fill_moves.append(direction)
+
+
+class CheckedPipeline(TrayPipeline):
+    """Pipeline that records relays left closed when a tray is finished,
+    other than those a tray still in flight has closed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        TrayPipeline.__init__(self, *args, **kwargs)
+        self.left_closed = []
+
+    def unloadTray(self, tray):
+        TrayPipeline.unloadTray(self, tray)
+        for relay in self.sc.relay_list:
+            if (self.sc.relay_state[relay] == "on"
+                    and relay not in self.relay_owner
+                    and relay not in REST_CLOSED):
+                self.left_closed.append((tray.number, relay))
+
+
+class TrayPipelineTest(unittest.TestCase):
+
+    def testFasterThanSequential(self):
+        for option in sorted(OPTION_PARAMS):
+            sequential = TimingController()
+            for tray in range(TRAYS):
+                getattr(sequential, "runOption{}".format(option))()
+            pipelined = TimingController()
+            pipelined.runPipeline(option, trays=TRAYS)
+            self.assertLess(pipelined.clock, sequential.clock,
+                            "Option {}".format(option))
+
+    def testNoReverseWhileFilling(self):
+        for option in sorted(OPTION_PARAMS):
+            sc = TraceController()
+            sc.runPipeline(option, trays=3)
+            self.assertNotIn("Reverse", sc.fill_moves,
+                             "Option {}".format(option))
+
+    def testRelaysReleasedPerTray(self):
+        for option in sorted(OPTION_PARAMS):
+            pipeline = CheckedPipeline(TimingController(), option, trays=3)
+            pipeline.run()
+            self.assertEqual(pipeline.left_closed, [],
+                             "Option {}".format(option))
+
+    def testPitchShorterThanTray(self):
+        sc = TimingController()
+        length = TrayPipeline(sc, 1).tray_length
+        self.assertRaises(ValueError, TrayPipeline, sc, 1,
+                          tray_pitch=length - 1)
+
+
+if __name__ == "__main__":
+    unittest.main()